@@ -0,0 +1,475 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from contextlib import contextmanager
+
+import psutil
+import requests
+
+import main
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DATASET_MARKER = ".benchmark-dataset.json"
+BENCH_USER, BENCH_PASSWORD = "bench", "bench_password"
+DEFAULT_THRESHOLD = 0.10  # Допустимое ухудшение при сравнении результатов
+
+
+# Приемник, который только считает записанные байты (чтобы не мерить скорость диска)
+class CountingWriter:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+# Исходный однопоточный путь: zipfile, ZIP_DEFLATED, compresslevel=9
+def legacy_archive(source_dir, fileobj):
+    with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zipf:
+        for file_path, arcname in main.iter_source_files(source_dir):
+            zipf.write(file_path, arcname=arcname)
+
+
+# Размер исходных данных
+def source_size(source_dir):
+    return sum(os.path.getsize(file_path) for file_path, arcname in main.iter_source_files(source_dir))
+
+
+# Один замер: время (wall и CPU) и размер архива
+def measure(name, func, source_dir, total_size):
+    sink = CountingWriter()
+    started, cpu_started = time.perf_counter(), time.process_time()
+    func(source_dir, sink)
+    wall, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+    return {
+        "name": name,
+        "wall_seconds": round(wall, 3),
+        "cpu_seconds": round(cpu, 3),
+        "archive_bytes": sink.size,
+        "ratio": round(sink.size / total_size, 4) if total_size else None,
+        "throughput_mb_s": round(total_size / wall / 2 ** 20, 2) if wall else None,
+    }
+
+
+# Сравнение параллельного движка сжатия с исходным однопоточным
+def compression_benchmark(source_dir, codecs, workers, block_size):
+    total_size = source_size(source_dir)
+    results = [measure("legacy zipfile deflate-9", legacy_archive, source_dir, total_size)]
+    for codec in codecs:
+        codec, _, level = codec.partition(':')
+        compression = {"codec": codec, "workers": workers, "block_size": block_size}
+        if level:
+            compression["level"] = int(level)
+        settings = main.compression_settings(compression)
+        name = f"{codec}-{settings['level']} x{settings['workers']}"
+        results.append(measure(name, lambda src, sink: main.write_archive(src, sink, compression), source_dir, total_size))
+    baseline = results[0]["wall_seconds"]
+    for result in results:
+        result["speedup"] = round(baseline / result["wall_seconds"], 2) if result["wall_seconds"] else None
+    return {"source_dir": source_dir, "source_bytes": total_size, "results": results}
+
+
+# Страница "базы данных": заголовок, записи из повторяющихся полей и случайных значений, пустой хвост.
+# Сжимается примерно вдвое, как страницы реальной БД транспортного модуля.
+def db_page(rng, page_size=8192):
+    header = b"PAGE" + rng.getrandbits(32).to_bytes(4, "little") + bytes(24)
+    records = bytearray()
+    fill = rng.randint(page_size // 2, page_size - len(header))
+    while len(records) < fill:
+        records += b"\x01\x00" + rng.randbytes(12) + b"status=OK;kpp=770101001;" + rng.randbytes(6)
+    return (header + records)[:page_size].ljust(page_size, b"\x00")
+
+
+# Небольшой файл: журнал или XML (хорошо сжимается) либо уже сжатые данные вроде jar (не сжимается)
+def small_file(rng, size):
+    if rng.random() < 0.25:
+        return rng.randbytes(size)
+    lines = bytearray()
+    while len(lines) < size:
+        lines += (
+            f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:"
+            f"{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} INFO transport doc={rng.getrandbits(48):012x} "
+            f"<Document><Identity>{rng.getrandbits(64):016x}</Identity></Document>\n"
+        ).encode()
+    return bytes(lines[:size])
+
+
+# Синтетический набор данных, похожий на каталог УТМ: несколько больших файлов БД
+# (large_share от общего объема) и много мелких. Одинаковые параметры дают одинаковые файлы,
+# поэтому результаты разных коммитов сравнимы. Готовый набор с теми же параметрами не пересоздается.
+# Удаляется только каталог с меткой набора: непустой каталог без метки — ошибка, а не данные на удаление.
+def generate_dataset(target_dir, total_size, large_files=3, large_share=0.8, small_size=16 * 1024, seed=1):
+    params = {
+        "total_size": total_size, "large_files": large_files, "large_share": large_share,
+        "small_size": small_size, "seed": seed,
+    }
+    marker = os.path.join(target_dir, DATASET_MARKER)
+    if os.path.exists(marker):
+        with open(marker, 'r') as f:
+            if json.load(f) == params:
+                return params
+        shutil.rmtree(target_dir)
+    elif os.path.isdir(target_dir) and os.listdir(target_dir):
+        raise ValueError(f"Каталог {target_dir} не пуст и не является набором данных бенчмарка")
+    rng = random.Random(seed)
+
+    large_size = int(total_size * large_share) // max(1, large_files)
+    db_dir = os.path.join(target_dir, "db")
+    os.makedirs(db_dir, exist_ok=True)
+    for index in range(large_files):
+        with open(os.path.join(db_dir, f"transport-{index}.db"), 'wb') as f:
+            written = 0
+            while written < large_size:
+                page = db_page(rng)[:large_size - written]
+                f.write(page)
+                written += len(page)
+
+    small_total = total_size - large_size * large_files
+    index = 0
+    while small_total > 0:
+        size = min(small_total, rng.randint(small_size // 4, small_size * 2))
+        sub_dir = os.path.join(target_dir, "logs" if index % 3 else "conf", f"{index // 100:03d}")
+        os.makedirs(sub_dir, exist_ok=True)
+        with open(os.path.join(sub_dir, f"file-{index:05d}.dat"), 'wb') as f:
+            f.write(small_file(rng, size))
+        small_total -= size
+        index += 1
+
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    return params
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Локальный сервер (uvicorn server:app) с отдельным каталогом бэкапов
+@contextmanager
+def local_server(work_dir):
+    server_dir = os.path.join(work_dir, "server")
+    os.makedirs(server_dir, exist_ok=True)
+    with open(os.path.join(server_dir, "server-config.json"), 'w') as f:
+        json.dump({"server_backup_dir": "backups", "users": {BENCH_USER: BENCH_PASSWORD}}, f)
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--app-dir", REPO_DIR, "--port", str(port),
+         "--log-level", "warning"],
+        cwd=server_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"{url}/list", auth=(BENCH_USER, BENCH_PASSWORD), timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("Сервер для бенчмарка не запустился")
+        yield url, psutil.Process(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+# Пиковое потребление памяти текущим процессом в МиБ
+def peak_rss_mb():
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (2 ** 20 if sys.platform == "darwin" else 1024), 1)  # macOS — байты, Linux — КиБ
+    info = psutil.Process().memory_info()
+    return round(getattr(info, "peak_wset", info.rss) / 2 ** 20, 1)
+
+
+# Сценарии. Каждый получает параметры прогона и возвращает объем входных и выходных данных.
+def case_legacy_archive(ctx):
+    path = os.path.join(ctx["work_dir"], "legacy.zip")
+    with open(path, 'wb') as f:
+        legacy_archive(ctx["source_dir"], f)
+    return ctx["source_bytes"], os.path.getsize(path)
+
+
+def case_create_backup(ctx):
+    path = main.create_backup(ctx["source_dir"], os.path.join(ctx["work_dir"], "archive"), compression=ctx["compression"])
+    return ctx["source_bytes"], os.path.getsize(path)
+
+
+def case_create_backup_encrypted(ctx):
+    path = main.create_backup(
+        ctx["source_dir"], os.path.join(ctx["work_dir"], "archive-enc"), ctx["key"], compression=ctx["compression"]
+    )
+    return ctx["source_bytes"], os.path.getsize(path)
+
+
+def case_encrypt_file(ctx):
+    path = main.encrypt_file(ctx["archive"], ctx["key"])
+    return os.path.getsize(ctx["archive"]), os.path.getsize(path)
+
+
+def case_decrypt_file(ctx):
+    path = main.decrypt_file(ctx["encrypted_archive"], ctx["key"], os.path.join(ctx["work_dir"], "decrypted.zip"))
+    return os.path.getsize(ctx["encrypted_archive"]), os.path.getsize(path)
+
+
+def case_upload(ctx):
+    size = os.path.getsize(ctx["encrypted_archive"])
+    name = main.upload_to_server(ctx["encrypted_archive"], ctx["server_url"], BENCH_USER, BENCH_PASSWORD,
+                                 ctx["client_timestamp"], ctx["upload"])
+    if not name:
+        raise RuntimeError("Загрузка не удалась")
+    return size, size
+
+
+def case_download(ctx):
+    path = main.download_backup(ctx["server_url"], BENCH_USER, BENCH_PASSWORD, ctx["backup_name"],
+                                os.path.join(ctx["work_dir"], "downloads"), ctx["download"])
+    if not path:
+        raise RuntimeError("Скачивание не удалось")
+    return os.path.getsize(path), os.path.getsize(path)
+
+
+def case_stream_backup(ctx):
+    report = main.RunReport()
+    config = {
+        "server_url": ctx["server_url"], "username": BENCH_USER, "password": BENCH_PASSWORD,
+        "source_dir": ctx["source_dir"], "compression": ctx["compression"],
+    }
+    if not main.stream_backup(config, ctx["key"], ctx["client_timestamp"] + 1, report=report):
+        raise RuntimeError("Потоковая загрузка не удалась")
+    return ctx["source_bytes"], report.stages.get("upload", {}).get("bytes_out", 0)
+
+
+CASES = {
+    "legacy_archive": case_legacy_archive,
+    "create_backup": case_create_backup,
+    "create_backup_encrypted": case_create_backup_encrypted,
+    "encrypt_file": case_encrypt_file,
+    "decrypt_file": case_decrypt_file,
+    "upload": case_upload,
+    "download": case_download,
+    "stream_backup": case_stream_backup,
+}
+SERVER_CASES = ("upload", "download", "stream_backup")
+
+
+# Выполнение сценария в отдельном процессе: пиковая память и время CPU относятся только к нему
+def run_case(name, ctx):
+    import logging
+    logging.disable(logging.INFO)  # Клиент пишет строку в лог на каждый файл архива
+    started, cpu_started = time.perf_counter(), time.process_time()
+    bytes_in, bytes_out = CASES[name](ctx)
+    wall, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+    return {
+        "name": name,
+        "wall_seconds": round(wall, 3),
+        "cpu_seconds": round(cpu, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "bytes_in": bytes_in,
+        "bytes_out": bytes_out,
+        "ratio": round(bytes_out / bytes_in, 4) if bytes_in else None,
+        "throughput_mb_s": round(bytes_in / wall / 2 ** 20, 2) if wall else None,
+    }
+
+
+def run_isolated(name, ctx, server_process=None):
+    server_cpu = sum(server_process.cpu_times()[:2]) if server_process else None
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        result = pool.apply(run_case, (name, ctx))
+    if server_process:
+        result["server_cpu_seconds"] = round(sum(server_process.cpu_times()[:2]) - server_cpu, 3)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Полный прогон: набор данных, архивация, шифрование, загрузка и скачивание через локальный сервер.
+# Временные файлы создаются в новом подкаталоге work_dir (или системного временного каталога),
+# и удаляется только он.
+def suite_benchmark(dataset_dir, total_size, cases, compression, work_dir=None, repeat=1):
+    dataset = generate_dataset(dataset_dir, total_size)
+    if work_dir:
+        os.makedirs(work_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="mini-backup-bench-", dir=work_dir)
+    try:
+        key_file = os.path.join(work_dir, "bench.key")
+        main.generate_key(key_file)
+        ctx = {
+            "source_dir": dataset_dir,
+            "source_bytes": source_size(dataset_dir),
+            "work_dir": work_dir,
+            "compression": compression,
+            "key": main.load_key(key_file),
+            "client_timestamp": 946684800,
+            "upload": {"parallel": 4},
+            "download": {"parallel": 4},
+        }
+        # Входные файлы для сценариев шифрования и передачи готовятся заранее и в замер не входят
+        ctx["archive"] = main.create_backup(dataset_dir, os.path.join(work_dir, "input"), compression=compression)
+        ctx["encrypted_archive"] = main.encrypt_file(ctx["archive"], ctx["key"])
+
+        results = []
+        local_cases = [name for name in cases if name not in SERVER_CASES]
+        server_cases = [name for name in cases if name in SERVER_CASES]
+        for name in local_cases:
+            results.extend(run_isolated(name, ctx) for _ in range(repeat))
+        if server_cases:
+            with local_server(work_dir) as (server_url, server_process):
+                ctx["server_url"] = server_url
+                ctx["backup_name"] = main.upload_to_server(
+                    ctx["encrypted_archive"], server_url, BENCH_USER, BENCH_PASSWORD, ctx["client_timestamp"] - 1
+                )
+                for name in server_cases:
+                    for attempt in range(repeat):
+                        ctx["client_timestamp"] += 2  # Каждая загрузка — под своим именем
+                        results.append(run_isolated(name, ctx, server_process))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "dataset": dict(dataset, source_bytes=ctx["source_bytes"]),
+        "compression": compression,
+        "results": best_results(results),
+    }
+
+
+# Из повторов одного сценария оставляется самый быстрый (меньше всего искажен фоновой нагрузкой)
+def best_results(results):
+    best = {}
+    for result in results:
+        if result["name"] not in best or result["wall_seconds"] < best[result["name"]]["wall_seconds"]:
+            best[result["name"]] = result
+    return list(best.values())
+
+
+# Сравнение двух прогонов: падение скорости или рост CPU/памяти больше threshold считается регрессией
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    if baseline.get("dataset") != current.get("dataset"):
+        print("Внимание: прогоны выполнены на разных наборах данных, сравнение неточное.")
+    previous = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    print(f"{'сценарий':<26} {'МиБ/с':>17} {'CPU, с':>17} {'память, МиБ':>17}")
+    for result in current["results"]:
+        old = previous.get(result["name"])
+        if old is None:
+            continue
+        checks = (
+            ("throughput_mb_s", -1),  # Меньше — хуже
+            ("cpu_seconds", 1),
+            ("peak_rss_mb", 1),
+        )
+        cells = []
+        for field, direction in checks:
+            before, after = old.get(field), result.get(field)
+            if not before or after is None:
+                cells.append(f"{'-':>17}")
+                continue
+            change = (after - before) / before
+            mark = "!" if change * direction > threshold else " "
+            if mark == "!":
+                regressions.append((result["name"], field, before, after))
+            cells.append(f"{before:>7} -> {after:<7}{mark}")
+        print(f"{result['name']:<26} {' '.join(cells)}")
+    for name, field, before, after in regressions:
+        print(f"Регрессия: {name} {field} {before} -> {after}")
+    return regressions
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_results(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарки бэкапа.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compression = commands.add_parser("compression", help="Сравнение кодеков сжатия на своем каталоге.")
+    compression.add_argument('source_dir', help="Каталог с данными для архивации.")
+    compression.add_argument('--codec', action='append', help="Кодек[:уровень], можно указать несколько (по умолчанию deflate:9).")
+    compression.add_argument('--workers', type=int, default=0, help="Количество потоков сжатия (0 — по числу ядер).")
+    compression.add_argument('--block-size', type=int, default=main.DEFAULT_COMPRESSION_BLOCK_SIZE, help="Размер блока сжатия.")
+    compression.add_argument('--json', help="Сохранить результаты в JSON-файл.")
+
+    suite = commands.add_parser("suite", help="Полный прогон на синтетическом наборе данных, похожем на УТМ.")
+    suite.add_argument('--dataset-dir', default="bench-dataset", help="Каталог набора данных (создается при необходимости).")
+    suite.add_argument('--size-mb', type=int, default=256, help="Общий объем набора данных в МиБ.")
+    suite.add_argument('--case', action='append', choices=sorted(CASES), help="Сценарий (по умолчанию все).")
+    suite.add_argument('--codec', default="deflate:9", help="Кодек[:уровень] для create_backup.")
+    suite.add_argument('--repeat', type=int, default=1, help="Повторов каждого сценария (берется лучший).")
+    suite.add_argument('--work-dir', help="Каталог для временных файлов (по умолчанию временный).")
+    suite.add_argument('--json', help="Сохранить результаты в JSON-файл.")
+    suite.add_argument('--compare', help="Сравнить с результатами из JSON-файла (код выхода 1 при регрессии).")
+    suite.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="Порог регрессии (доля).")
+
+    compare = commands.add_parser("compare", help="Сравнить два сохраненных прогона.")
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.command == "compression":
+        report = compression_benchmark(args.source_dir, args.codec or ["deflate:9"], args.workers, args.block_size)
+        for result in report["results"]:
+            print(f"{result['name']:<28} {result['wall_seconds']:>9.3f} s  {result['throughput_mb_s']:>9} MB/s  "
+                  f"ratio {result['ratio']}  speedup x{result['speedup']}")
+        if args.json:
+            save_results(report, args.json)
+    elif args.command == "suite":
+        codec, _, level = args.codec.partition(':')
+        compression = {"codec": codec, **({"level": int(level)} if level else {})}
+        report = suite_benchmark(
+            args.dataset_dir, args.size_mb * 2 ** 20, args.case or list(CASES), compression, args.work_dir, args.repeat
+        )
+        for result in report["results"]:
+            print(f"{result['name']:<26} {result['wall_seconds']:>9.3f} s  {result['throughput_mb_s']:>9} MB/s  "
+                  f"CPU {result['cpu_seconds']:>8.3f} s  RSS {result['peak_rss_mb']:>7} MB  ratio {result['ratio']}")
+        if args.json:
+            save_results(report, args.json)
+        if args.compare and compare_results(load_results(args.compare), report, args.threshold):
+            sys.exit(1)
+    else:
+        if compare_results(load_results(args.baseline), load_results(args.current), args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,152 @@
+from collections import OrderedDict
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import sys
+import threading
+import time
+from typing import Optional
+
+# Хранение и проверка учетных данных сервера. Пароли в конфигурации хранятся как хеши
+# ("scrypt$<n>$<r>$<p>$<соль>$<хеш>" или "pbkdf2_sha256$<итерации>$<соль>$<хеш>"), хеш для конфигурации
+# печатает `python credentials.py`. Проверка хеша намеренно дорогая, поэтому успешные проверки
+# кэшируются, а клиент на время запуска получает подписанный токен и дальше проверяется только HMAC.
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600000
+HASH_SCHEMES = ("scrypt", "pbkdf2_sha256")
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+# Хеш пароля для конфигурации сервера (users)
+def hash_password(password: str, scheme: str = "scrypt") -> str:
+    salt = secrets.token_bytes(16)
+    if scheme == "scrypt":
+        digest = hashlib.scrypt(
+            password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, maxmem=64 * 1024 * 1024
+        )
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64encode(salt)}${_b64encode(digest)}"
+    if scheme == "pbkdf2_sha256":
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS)
+        return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64encode(salt)}${_b64encode(digest)}"
+    raise ValueError(f"Неизвестная схема хеширования пароля: {scheme}")
+
+# Значение из конфигурации — хеш, а не пароль в открытом виде
+def is_hashed(stored: str) -> bool:
+    return stored.split("$", 1)[0] in HASH_SCHEMES and stored.count("$") >= 3
+
+# Проверка пароля по значению из конфигурации. Пароли в открытом виде (старые конфигурации)
+# сравниваются напрямую; некорректный хеш считается несовпадением.
+def verify_password(password: str, stored: str) -> bool:
+    if not is_hashed(stored):
+        return secrets.compare_digest(password.encode(), stored.encode())
+    try:
+        scheme, *params = stored.split("$")
+        if scheme == "scrypt":
+            n, r, p, salt, expected = params
+            expected = _b64decode(expected)
+            digest = hashlib.scrypt(
+                password.encode(), salt=_b64decode(salt), n=int(n), r=int(r), p=int(p),
+                maxmem=256 * int(n) * int(r) + 1024 * 1024, dklen=len(expected)
+            )
+        else:
+            iterations, salt, expected = params
+            expected = _b64decode(expected)
+            digest = hashlib.pbkdf2_hmac(
+                "sha256", password.encode(), _b64decode(salt), int(iterations), dklen=len(expected)
+            )
+    except (ValueError, TypeError):
+        return False
+    return hmac.compare_digest(digest, expected)
+
+# Кэш успешных проверок пароля: ограничен по размеру (вытесняется самая давняя запись) и по времени жизни.
+# Ключ — HMAC от имени, пароля и хранимого хеша на случайном ключе процесса, поэтому пароли в памяти
+# не лежат, а смена пароля в конфигурации делает старые записи недействительными.
+class VerificationCache:
+    def __init__(self, ttl: float = 300, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.key = secrets.token_bytes(32)
+        self.entries = OrderedDict()  # ключ -> время истечения
+        self.lock = threading.Lock()
+
+    def _key(self, username: str, password: str, stored: str) -> bytes:
+        message = b"\0".join(value.encode() for value in (username, password, stored))
+        return hmac.new(self.key, message, hashlib.sha256).digest()
+
+    # Проверка пароля с кэшем: повторная проверка тех же данных не пересчитывает хеш
+    def verify(self, username: str, password: str, stored: str) -> bool:
+        if self.ttl <= 0 or self.max_size <= 0:
+            return verify_password(password, stored)
+        key = self._key(username, password, stored)
+        now = time.monotonic()
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is not None:
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    return True
+                del self.entries[key]
+        if not verify_password(password, stored):
+            return False  # Неудачные проверки не кэшируются
+        with self.lock:
+            self.entries[key] = now + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return True
+
+# Подписанные токены доступа: "<данные в base64>.<HMAC-SHA256>". В данных имя пользователя, время
+# истечения и отпечаток хранимого хеша пароля — после смены пароля выданные токены перестают действовать.
+class TokenSigner:
+    def __init__(self, secret: bytes, ttl: float = 3600):
+        self.secret = secret
+        self.ttl = ttl
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self.secret, payload.encode(), hashlib.sha256).digest())
+
+    def _fingerprint(self, stored: str) -> str:
+        return _b64encode(hmac.new(self.secret, stored.encode(), hashlib.sha256).digest()[:8])
+
+    def issue(self, username: str, stored: str) -> str:
+        payload = _b64encode(json.dumps(
+            {"user": username, "exp": int(time.time() + self.ttl), "cred": self._fingerprint(stored)},
+            separators=(",", ":")
+        ).encode())
+        return f"{payload}.{self._sign(payload)}"
+
+    # Имя пользователя из действительного токена или None. users — текущие учетные данные сервера.
+    def verify(self, token: str, users: dict) -> Optional[str]:
+        payload, _, signature = token.partition(".")
+        if not signature or not hmac.compare_digest(signature.encode(), self._sign(payload).encode()):
+            return None
+        try:
+            data = json.loads(_b64decode(payload))
+            username, expires, fingerprint = str(data["user"]), float(data["exp"]), str(data["cred"])
+        except (ValueError, KeyError, TypeError):
+            return None
+        stored = users.get(username)
+        if stored is None or expires < time.time():
+            return None
+        if not hmac.compare_digest(fingerprint.encode(), self._fingerprint(stored).encode()):
+            return None
+        return username
+
+# Печать хеша пароля для раздела users конфигурации сервера:
+#   python credentials.py [scrypt|pbkdf2_sha256]
+if __name__ == "__main__":
+    import getpass
+
+    password = getpass.getpass("Пароль: ")
+    if password != getpass.getpass("Повторите пароль: "):
+        sys.exit("Пароли не совпадают")
+    print(hash_password(password, *sys.argv[1:2]))
@@ -0,0 +1,138 @@
+import argparse
+import os
+from collections import Counter
+import statistics
+import threading
+import time
+
+import requests
+from requests.auth import HTTPBasicAuth
+import urllib3
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)  # Самоподписанные сертификаты
+
+
+# Генератор тела загрузки: size байт кусками по 1 МиБ (одни и те же случайные данные)
+def generate_body(size, block=os.urandom(1024 * 1024)):
+    sent = 0
+    while sent < size:
+        data = block[:min(len(block), size - sent)]
+        sent += len(data)
+        yield data
+
+
+# Одна загрузка через /upload-stream; у каждой свой client_timestamp, чтобы имена не совпадали.
+# Обрыв соединения под нагрузкой тоже результат: он записывается как неудачная загрузка.
+def upload_worker(args, auth, index, results):
+    started = time.perf_counter()
+    try:
+        response = requests.post(
+            f"{args.server_url}/upload-stream",
+            data=generate_body(args.size_mb * 1024 * 1024),
+            params={"client_timestamp": args.base_timestamp + index},
+            headers={"Content-Type": "application/octet-stream"},
+            auth=auth,
+            verify=False,
+        )
+    except requests.RequestException as e:
+        results.append({"status": type(e).__name__, "seconds": time.perf_counter() - started, "auth": auth})
+        return
+    results.append({
+        "status": response.status_code,
+        "seconds": time.perf_counter() - started,
+        "name": os.path.basename(response.json().get("path", "")) if response.status_code == 200 else None,
+        "auth": auth,
+    })
+
+
+# Замер задержки другого эндпоинта, пока идут загрузки (неудачные запросы не учитываются)
+def probe_worker(args, auth, stop, latencies):
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            requests.get(f"{args.server_url}{args.probe}", auth=auth, verify=False)
+        except requests.RequestException:
+            pass
+        else:
+            latencies.append(time.perf_counter() - started)
+        time.sleep(args.probe_interval)
+
+
+# Пользователи из --user ИМЯ:ПАРОЛЬ (или --username/--password, если --user не задан)
+def parse_users(args):
+    if not args.user:
+        return [HTTPBasicAuth(args.username, args.password)]
+    users = []
+    for value in args.user:
+        username, separator, password = value.partition(":")
+        if not separator:
+            raise SystemExit(f"Ожидается --user ИМЯ:ПАРОЛЬ, получено {value!r}")
+        users.append(HTTPBasicAuth(username, password))
+    return users
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест загрузки бэкапов.")
+    parser.add_argument('server_url', help="Адрес сервера, например https://localhost.")
+    parser.add_argument('--username', default="admin")
+    parser.add_argument('--password', default="admin_password")
+    parser.add_argument('--user', action='append', metavar="ИМЯ:ПАРОЛЬ",
+                        help="Пользователь для загрузок; можно указать несколько раз, загрузки распределяются "
+                             "между ними по кругу. Сервер ограничивает загрузки одного пользователя "
+                             "(upload_limits.max_per_user), поэтому с одним пользователем тест измеряет "
+                             "этот лимит, а не пропускную способность сервера.")
+    parser.add_argument('--uploads', type=int, default=32, help="Количество одновременных загрузок.")
+    parser.add_argument('--size-mb', type=int, default=64, help="Размер одной загрузки в МиБ.")
+    parser.add_argument('--probe', default="/list", help="Эндпоинт, задержку которого измеряем во время загрузок.")
+    parser.add_argument('--probe-interval', type=float, default=0.1)
+    parser.add_argument('--base-timestamp', type=int, default=946684800, help="Начальный client_timestamp загрузок.")
+    parser.add_argument('--keep', action='store_true', help="Не удалять загруженные бэкапы после теста.")
+    args = parser.parse_args()
+
+    users = parse_users(args)
+    if len(users) == 1:
+        print(f"Все загрузки от одного пользователя {users[0].username}: результат ограничен upload_limits.max_per_user")
+    stop = threading.Event()
+    latencies, results = [], []
+    probe = threading.Thread(target=probe_worker, args=(args, users[0], stop, latencies))
+    uploads = [
+        threading.Thread(target=upload_worker, args=(args, users[index % len(users)], index, results))
+        for index in range(args.uploads)
+    ]
+
+    started = time.perf_counter()
+    probe.start()
+    for thread in uploads:
+        thread.start()
+    for thread in uploads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    probe.join()
+
+    ok = [result for result in results if result["status"] == 200]
+    total_mb = len(ok) * args.size_mb
+    print(f"Загрузок: {len(ok)}/{args.uploads} успешно, {total_mb} МиБ за {elapsed:.2f} с ({total_mb / elapsed:.1f} МиБ/с)")
+    failed = Counter(str(result["status"]) for result in results if result["status"] != 200)
+    if failed:
+        print("Неудачные загрузки: " + ", ".join(f"{status} — {count}" for status, count in sorted(failed.items())))
+    if ok:
+        print(f"Время успешной загрузки: медиана {statistics.median(r['seconds'] for r in ok):.2f} с, "
+              f"максимум {max(r['seconds'] for r in ok):.2f} с")
+    if latencies:
+        print(f"Задержка {args.probe} ({len(latencies)} запросов): p50 {percentile(latencies, 50) * 1000:.1f} мс, "
+              f"p95 {percentile(latencies, 95) * 1000:.1f} мс, p99 {percentile(latencies, 99) * 1000:.1f} мс, "
+              f"максимум {max(latencies) * 1000:.1f} мс")
+
+    if not args.keep:
+        for result in ok:
+            requests.delete(f"{args.server_url}/delete/{result['name']}", auth=result["auth"], verify=False)
+
+
+if __name__ == "__main__":
+    main()
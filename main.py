@@ -2,21 +2,131 @@ import os
 import subprocess
 import json
 from datetime import datetime, timedelta
-import schedule
 import time
 from cryptography.fernet import Fernet
 import argparse
+import atexit
 import logging
 import requests
-from requests.auth import HTTPBasicAuth
+from requests.auth import AuthBase, HTTPBasicAuth
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import base64
+import bisect
+import errno
+import fnmatch
+import hashlib
+import hmac
+import io
+import queue
+import random
+import shutil
+import struct
+import sys
+import threading
 import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from requests.adapters import HTTPAdapter
+
+try:
+    import zstandard  # Необязательная зависимость для кодека zstd
+except ImportError:
+    zstandard = None
+try:
+    import fcntl  # Клонирование файлов (reflink) через ioctl FICLONE, только Linux
+except ImportError:
+    fcntl = None
 import time  # Для работы с Unix timestamp
 
+# Потоковый формат шифрования: заголовок + последовательность чанков AES-256-GCM.
+# Заголовок: магия (4 байта), версия (1 байт), размер чанка (4 байта), префикс nonce (7 байт).
+# Nonce чанка: префикс (7 байт) + номер чанка (4 байта) + флаг последнего чанка (1 байт).
+STREAM_MAGIC = b"MBKS"
+STREAM_VERSION = 1
+STREAM_HEADER = struct.Struct(">4sBI7s")
+STREAM_TAG_SIZE = 16
+DEFAULT_STREAM_CHUNK_SIZE = 1024 * 1024  # 1 МиБ открытого текста на чанк
+STREAM_ENCRYPTION = "aes-256-gcm-stream"  # Обозначение формата в каталоге бэкапов на сервере
+
+# Формат чанка при дедупликации: заголовок (магия, версия, nonce, длина шифртекста) + AES-256-GCM.
+# Nonce вычисляется из содержимого (HMAC), поэтому одинаковые данные дают одинаковые чанки.
+CHUNK_MAGIC = b"MBKC"
+CHUNK_VERSION = 1
+CHUNK_HEADER = struct.Struct(">4sB12sI")
+CHUNK_ENCRYPTION = "aes-256-gcm-chunk"
+
+# Параметры дедупликации по умолчанию
+DEFAULT_DEDUP_MIN_SIZE = 512 * 1024
+DEFAULT_DEDUP_MAX_SIZE = 4 * 1024 * 1024
+DEFAULT_DEDUP_BATCH_SIZE = 8  # Сколько чанков проверяется на сервере одним запросом
+DEDUP_ANCHOR = b"\xa5\x5a"  # Граница чанка — после этой пары байт (в среднем раз в 64 КиБ)
+# Запасная граница для данных без якоря (текст, почти пустые страницы базы): каждый из
+# DEDUP_FALLBACK_WINDOW последних байт переводится своей таблицей в случайный байт, байты
+# складываются XOR, граница — после DEDUP_FALLBACK_PATTERN в полученной строке
+# (в среднем раз в 64 КиБ на случайных данных)
+DEDUP_FALLBACK_WINDOW = 8
+DEDUP_FALLBACK_TABLES = [
+    bytes(hashlib.sha256(bytes([shift, value])).digest()[0] for value in range(256))
+    for shift in range(DEDUP_FALLBACK_WINDOW)
+]
+DEDUP_FALLBACK_PATTERN = b"\0\0"
+DEDUP_FALLBACK_BLOCK = 64 * 1024  # Запасная граница ищется блоками, до первого совпадения
+
+# Параметры конвейера бэкапа по умолчанию
+DEFAULT_PIPELINE_QUEUE_SIZE = 8  # Максимум кусков в каждой очереди между стадиями
+DEFAULT_PIPELINE_CHUNK_SIZE = 1024 * 1024
+SPOOL_DIR_NAME = "spool"
+
+# Режим снимка: каталог для копии source_dir и способ копирования по умолчанию
+SNAPSHOT_DIR_NAME = "snapshot"
+DEFAULT_SNAPSHOT_METHOD = "auto"
+FICLONE = 0x40049409
+
+# Параметры загрузки по частям по умолчанию
+DEFAULT_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_UPLOAD_PARALLEL = 4
+DEFAULT_UPLOAD_RETRIES = 5
+BUSY_STATUSES = (429, 503)  # Сервер занят: повтор через Retry-After
+MAX_RETRY_DELAY = 300
+LIST_PAGE_SIZE = 1000  # Сколько бэкапов запрашивать из /list за раз
+TOKEN_REFRESH_MARGIN = 60  # За сколько секунд до истечения токен доступа получается заново
+
+# Параметры скачивания по умолчанию: файл качается диапазонами, готовые диапазоны запоминаются
+DEFAULT_DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_DOWNLOAD_PARALLEL = 1
+DEFAULT_DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+DEFAULT_REMOTE_READ_SIZE = 256 * 1024  # Минимальный диапазон при чтении бэкапа на сервере как файла
+
+# Параметры сжатия по умолчанию
+DEFAULT_COMPRESSION_CODEC = "deflate"
+DEFAULT_COMPRESSION_LEVELS = {"deflate": 9, "zstd": 3, "store": 0}
+DEFAULT_COMPRESSION_BLOCK_SIZE = 1024 * 1024  # Большие файлы сжимаются независимыми блоками
+ZIP_METHODS = {"deflate": zipfile.ZIP_DEFLATED, "zstd": 93, "store": zipfile.ZIP_STORED}
+# Адаптивное сжатие: файл, который по образцам сжимается хуже store_threshold, кладется в архив
+# без сжатия; так же (deflate уровня 0) пишутся несжимаемые блоки внутри сжимаемых файлов
+DEFAULT_STORE_THRESHOLD = 0.95
+COMPRESSIBILITY_SAMPLE_SIZE = 64 * 1024
+COMPRESSIBILITY_SAMPLES = 4
+BLOCK_SAMPLE_SIZE = 16 * 1024
+INCOMPRESSIBLE_EXTENSIONS = frozenset((
+    '.zip', '.jar', '.war', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.cab',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.avi', '.mkv', '.enc',
+))
+
+# Инкрементальные бэкапы
+MANIFEST_ARCNAME = ".mini-backup/manifest.json"  # Служебный манифест внутри архива
+DEFAULT_MANIFEST_FILE = "manifest.json"  # Состояние файлов после последнего бэкапа (в backup_dir)
+DEFAULT_CHECKSUMS_FILE = "checksums.json"  # SHA-256 загруженных на сервер бэкапов (в backup_dir)
+DEFAULT_FULL_EVERY = 7  # Каждый N-й бэкап — полный
+
 # Настройка логирования
 def setup_logging():
     logging.basicConfig(
@@ -41,30 +151,165 @@ def load_key(key_file):
     with open(key_file, 'rb') as f:
         return f.read()
 
-# Шифрование файла
-def encrypt_file(file_path, key):
-    fernet = Fernet(key)
+# Ключи AES-256-GCM выводятся из ключа Fernet, чтобы не менять формат файла ключа
+def derive_key(key, info):
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info)
+    return hkdf.derive(base64.urlsafe_b64decode(key))
+
+def derive_stream_key(key):
+    return derive_key(key, b"mini-backup stream v1")
+
+def _stream_nonce(prefix, index, final):
+    if index >= 2 ** 32:
+        raise ValueError("Превышено максимальное количество чанков в потоке")
+    return prefix + struct.pack(">IB", index, 1 if final else 0)
+
+# Потоковое шифрование: файлоподобный объект, который шифрует данные чанками по мере записи.
+# В памяти держится не больше одного чанка, поэтому его можно передать прямо в ZipFile.
+class EncryptingWriter:
+    def __init__(self, fileobj, key, chunk_size=DEFAULT_STREAM_CHUNK_SIZE, report=None):
+        self.fileobj = fileobj
+        self.report = report or RunReport()
+        self.chunk_size = chunk_size
+        self.aesgcm = AESGCM(derive_stream_key(key))
+        self.nonce_prefix = os.urandom(7)
+        self.header = STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, chunk_size, self.nonce_prefix)
+        self.buffer = bytearray()
+        self.index = 0
+        self.closed = False
+        self.fileobj.write(self.header)
+
+    def _write_chunk(self, data, final):
+        nonce = _stream_nonce(self.nonce_prefix, self.index, final)
+        encrypted = self.report.call('encrypt', self.aesgcm.encrypt, nonce, bytes(data), self.header)
+        self.report.add('encrypt', bytes_in=len(data), bytes_out=len(encrypted))
+        self.fileobj.write(encrypted)
+        self.index += 1
+
+    def write(self, data):
+        self.buffer += data
+        # Последний чанк пишется только при закрытии, поэтому полный чанк отдаем,
+        # лишь когда за ним уже есть данные
+        while len(self.buffer) > self.chunk_size:
+            self._write_chunk(self.buffer[:self.chunk_size], final=False)
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if not self.closed:
+            self._write_chunk(self.buffer, final=True)
+            self.buffer = bytearray()
+            self.closed = True
+            self.fileobj.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+# Проверка, записан ли файл в потоковом формате
+def is_stream_encrypted(file_path):
     with open(file_path, 'rb') as f:
-        original_data = f.read()
-    encrypted_data = fernet.encrypt(original_data)
+        return f.read(len(STREAM_MAGIC)) == STREAM_MAGIC
+
+# Потоковая расшифровка из src в dst с проверкой тега каждого чанка и признака конца потока
+def decrypt_stream(src, dst, key):
+    header = src.read(STREAM_HEADER.size)
+    if len(header) != STREAM_HEADER.size:
+        raise ValueError("Поврежденный заголовок зашифрованного файла")
+    magic, version, chunk_size, nonce_prefix = STREAM_HEADER.unpack(header)
+    if magic != STREAM_MAGIC:
+        raise ValueError("Файл не является потоково зашифрованным бэкапом")
+    if version != STREAM_VERSION:
+        raise ValueError(f"Неподдерживаемая версия формата шифрования: {version}")
+    aesgcm = AESGCM(derive_stream_key(key))
+    block_size = chunk_size + STREAM_TAG_SIZE
+    index = 0
+    current = src.read(block_size)
+    while True:
+        following = src.read(block_size)
+        final = not following
+        if len(current) < STREAM_TAG_SIZE:
+            raise ValueError("Зашифрованный файл обрезан")
+        nonce = _stream_nonce(nonce_prefix, index, final)
+        dst.write(aesgcm.decrypt(nonce, current, header))
+        if final:
+            return
+        current = following
+        index += 1
+
+# Детерминированное шифрование чанков для дедупликации (nonce = HMAC от открытого текста)
+class ChunkSealer:
+    def __init__(self, key):
+        self.aesgcm = AESGCM(derive_key(key, b"mini-backup chunk v1"))
+        self.nonce_key = derive_key(key, b"mini-backup chunk nonce v1")
+
+    def seal(self, data):
+        nonce = hmac.new(self.nonce_key, data, hashlib.sha256).digest()[:12]
+        ciphertext = self.aesgcm.encrypt(nonce, data, CHUNK_MAGIC)
+        return CHUNK_HEADER.pack(CHUNK_MAGIC, CHUNK_VERSION, nonce, len(ciphertext)) + ciphertext
+
+# Расшифровка последовательности чанков (так сервер отдает бэкап, собранный из чанков)
+def decrypt_chunk_stream(src, dst, key):
+    aesgcm = AESGCM(derive_key(key, b"mini-backup chunk v1"))
+    while True:
+        header = src.read(CHUNK_HEADER.size)
+        if not header:
+            return
+        if len(header) != CHUNK_HEADER.size:
+            raise ValueError("Зашифрованный файл обрезан")
+        magic, version, nonce, length = CHUNK_HEADER.unpack(header)
+        if magic != CHUNK_MAGIC or version != CHUNK_VERSION:
+            raise ValueError("Поврежденный заголовок чанка")
+        ciphertext = src.read(length)
+        if len(ciphertext) != length:
+            raise ValueError("Зашифрованный файл обрезан")
+        dst.write(aesgcm.decrypt(nonce, ciphertext, CHUNK_MAGIC))
+
+# Шифрование файла (потоковое, с постоянным потреблением памяти)
+def encrypt_file(file_path, key, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
     encrypted_file_path = file_path + '.enc'
-    with open(encrypted_file_path, 'wb') as f:
-        f.write(encrypted_data)
+    with open(file_path, 'rb') as src, open(encrypted_file_path, 'wb') as dst:
+        with EncryptingWriter(dst, key, chunk_size) as writer:
+            while True:
+                data = src.read(chunk_size)
+                if not data:
+                    break
+                writer.write(data)
     logging.info(f"Файл {file_path} зашифрован и сохранен как {encrypted_file_path}")
     return encrypted_file_path
 
-# Расшифровка файла
-def decrypt_file(file_path, key):
-    fernet = Fernet(key)
+# Расшифровка файла (потоковый формат, чанки дедупликации или старые бэкапы в формате Fernet)
+def decrypt_file(file_path, key, decrypted_file_path=None):
+    decrypted_file_path = decrypted_file_path or file_path[:-4]  # Убираем расширение .enc
     with open(file_path, 'rb') as f:
-        encrypted_data = f.read()
-    decrypted_data = fernet.decrypt(encrypted_data)
-    decrypted_file_path = file_path[:-4]  # Убираем расширение .enc
-    with open(decrypted_file_path, 'wb') as f:
-        f.write(decrypted_data)
+        magic = f.read(len(STREAM_MAGIC))
+    if magic == STREAM_MAGIC:
+        with open(file_path, 'rb') as src, open(decrypted_file_path, 'wb') as dst:
+            decrypt_stream(src, dst, key)
+    elif magic == CHUNK_MAGIC:
+        with open(file_path, 'rb') as src, open(decrypted_file_path, 'wb') as dst:
+            decrypt_chunk_stream(src, dst, key)
+    else:
+        fernet = Fernet(key)
+        with open(file_path, 'rb') as f:
+            encrypted_data = f.read()
+        decrypted_data = fernet.decrypt(encrypted_data)
+        with open(decrypted_file_path, 'wb') as f:
+            f.write(decrypted_data)
     logging.info(f"Файл {file_path} расшифрован и сохранен как {decrypted_file_path}")
     return decrypted_file_path
 
+# Проверка, зашифрован ли скачанный бэкап (потоковый формат или токен Fernet)
+def is_encrypted_backup(file_path):
+    with open(file_path, 'rb') as f:
+        head = f.read(len(STREAM_MAGIC))
+    return head in (STREAM_MAGIC, CHUNK_MAGIC) or head.startswith(b'gAAAA')
+
 # Загрузка конфигурации
 def load_config(config_file):
     with open(config_file, 'r') as f:
@@ -81,43 +326,1232 @@ def run_script(script_path):
         return True  # Возвращаем True, если скрипт выполнен успешно
     return True  # Если скрипт не указан, считаем, что все в порядке
 
-# Создание бэкапа с максимальным сжатием
-def create_backup(source_dir, backup_dir):
+# Отчет о запуске бэкапа: длительность и объем данных каждой стадии.
+# Стадии конвейера работают одновременно, поэтому для них seconds — суммарное время работы
+# стадии (для сжатия — по всем потокам), а не время от начала до конца бэкапа.
+class RunReport:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.fields = {"status": "running"}
+        self.stages = {}
+
+    def add(self, stage, **counters):
+        with self.lock:
+            values = self.stages.setdefault(stage, {})
+            for name, value in counters.items():
+                values[name] = values.get(name, 0) + value
+
+    def set(self, **fields):
+        with self.lock:
+            self.fields.update(fields)
+
+    # Замер блока кода как стадии
+    @contextmanager
+    def stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, seconds=time.perf_counter() - started)
+
+    # Замер вызова функции (например, в пуле потоков)
+    def call(self, stage, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.add(stage, seconds=time.perf_counter() - started)
+
+    # Замер времени получения элементов из итератора (обход каталога, чтение файла)
+    def iterate(self, stage, iterable):
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, seconds=time.perf_counter() - started)
+                return
+            self.add(stage, seconds=time.perf_counter() - started)
+            yield item
+
+    # Снимок счетчиков стадий: при повторе попытки счетчики неудачной попытки откатываются к нему
+    def checkpoint(self):
+        with self.lock:
+            return {name: dict(values) for name, values in self.stages.items()}
+
+    def rollback(self, checkpoint):
+        with self.lock:
+            self.stages = {name: dict(values) for name, values in checkpoint.items()}
+
+    def finish(self, status, error=None):
+        self.finished = time.time()
+        self.set(status=status)
+        if error:
+            self.set(error=str(error))
+
+    def as_dict(self):
+        with self.lock:
+            stages = {name: dict(values) for name, values in self.stages.items()}
+            fields = dict(self.fields)
+        for values in stages.values():
+            size = values.get('bytes_in') or values.get('bytes_out')
+            if values.get('seconds') and size:
+                values['mb_per_s'] = round(size / values['seconds'] / 2 ** 20, 2)
+            if 'seconds' in values:
+                values['seconds'] = round(values['seconds'], 3)
+        compress = stages.get('compress', {})
+        finished = self.finished or time.time()
+        return {
+            **fields,
+            "started": datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            "finished": datetime.fromtimestamp(finished).isoformat(timespec='seconds'),
+            "seconds": round(finished - self.started, 3),
+            "compression_ratio": (
+                round(compress['bytes_out'] / compress['bytes_in'], 4) if compress.get('bytes_in') else None
+            ),
+            "stages": stages,
+        }
+
+    # Сохранение отчета в JSON: report.dir из конфигурации или <backup_dir>/reports
+    def write(self, config):
+        report_config = config.get('report', {})
+        if not report_config.get('enabled', True):
+            return None
+        report_dir = report_config.get('dir') or os.path.join(config.get('backup_dir', '.'), 'reports')
+        os.makedirs(report_dir, exist_ok=True)
+        prefix = f"run_{config['job_name']}_" if config.get('job_name') else "run_"
+        path = os.path.join(report_dir, f"{prefix}{datetime.fromtimestamp(self.started).strftime('%Y%m%d%H%M%S')}.json")
+        report = self.as_dict()
+        with open(path, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        summary = ", ".join(f"{name} {values.get('seconds', 0):.1f} с" for name, values in report['stages'].items())
+        logging.info(f"Отчет о бэкапе сохранен в {path}: {summary}")
+        return path
+
+# Файлоподобный объект, который считает SHA-256 записываемых данных и передает их дальше
+class HashingWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+# SHA-256 файла (для бэкапов, контрольная сумма которых не была посчитана при создании)
+def file_sha256(file_path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Создание бэкапа с максимальным сжатием.
+# Если передан ключ, архив сразу пишется в зашифрованном виде, без временного .zip на диске.
+def create_backup(source_dir, backup_dir, key=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE, timestamp=None,
+                  compression=None, plan=None, report=None):
+    report = report or RunReport()
     if not os.path.exists(backup_dir):
         os.makedirs(backup_dir)
         logging.info(f"Создана директория для бэкапов: {backup_dir}")
 
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    timestamp = (timestamp or datetime.now()).strftime("%Y%m%d%H%M%S")
     backup_file = os.path.join(backup_dir, f"backup_{timestamp}.zip")
+    if key:
+        backup_file += '.enc'
 
-    # Создание ZIP-архива с максимальным сжатием
-    with zipfile.ZipFile(backup_file, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zipf:
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, start=source_dir)  # Относительный путь в архиве
-                zipf.write(file_path, arcname=arcname)
-                logging.info(f"Добавлен файл в архив: {file_path}")
+    # Контрольная сумма считается по ходу записи, без повторного чтения файла
+    with open(backup_file, 'wb') as f:
+        hasher = HashingWriter(f)
+        if key:
+            with EncryptingWriter(hasher, key, chunk_size, report) as writer:
+                write_archive(source_dir, writer, compression, plan, report)
+        else:
+            write_archive(source_dir, hasher, compression, plan, report)
+    report.set(sha256=hasher.hexdigest())
 
     logging.info(f"Создан бэкап с максимальным сжатием: {backup_file}")
     return backup_file
 
-# Загрузка на собственный сервер
-def upload_to_server(file_path, server_url, username, password, client_timestamp=None):
-    with open(file_path, 'rb') as f:
-        files = {"file": f}
-        data = {"client_timestamp": client_timestamp} if client_timestamp else None
-        response = requests.post(
-            f"{server_url}/upload",
-            files=files,
-            data=data,
-            auth=HTTPBasicAuth(username, password),
-            verify=False  # Отключение проверки SSL (для самоподписанных сертификатов)
+# Итоговые параметры сжатия из секции "compression" конфигурации
+def compression_settings(compression=None):
+    compression = compression or {}
+    codec = compression.get('codec', DEFAULT_COMPRESSION_CODEC)
+    if codec not in ZIP_METHODS:
+        raise ValueError(f"Неизвестный кодек сжатия: {codec}")
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError("Для кодека zstd установите пакет zstandard")
+    return {
+        'codec': codec,
+        'level': compression.get('level', DEFAULT_COMPRESSION_LEVELS[codec]),
+        'workers': compression.get('workers') or os.cpu_count() or 1,
+        'block_size': compression.get('block_size', DEFAULT_COMPRESSION_BLOCK_SIZE),
+        'adaptive': compression.get('adaptive', True),
+        'store_threshold': compression.get('store_threshold', DEFAULT_STORE_THRESHOLD),
+    }
+
+# Доля размера данных после быстрого сжатия (deflate уровня 1) — оценка сжимаемости
+def sample_ratio(data):
+    return len(zlib.compress(data, 1)) / len(data) if len(data) else 0
+
+# Кодек для файла: уже сжатые форматы (по расширению) и файлы, образцы которых из начала,
+# середины и конца почти не сжимаются, сохраняются без сжатия. Мелкие файлы не проверяются:
+# их сжатие дешево, а несжимаемые блоки все равно отсекает compress_block.
+def choose_file_codec(f, arcname, size, settings):
+    codec = settings['codec']
+    if not settings['adaptive'] or codec == 'store':
+        return codec
+    if os.path.splitext(arcname)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return 'store'
+    if size < COMPRESSIBILITY_SAMPLE_SIZE * COMPRESSIBILITY_SAMPLES:
+        return codec
+    sample = bytearray()
+    for index in range(COMPRESSIBILITY_SAMPLES):
+        f.seek(size * index // COMPRESSIBILITY_SAMPLES)
+        sample += f.read(COMPRESSIBILITY_SAMPLE_SIZE)
+    f.seek(0)
+    return 'store' if sample_ratio(sample) > settings['store_threshold'] else codec
+
+
+# Сжатие одного блока независимо от остальных. Блоки deflate завершаются Z_SYNC_FLUSH
+# (последний — Z_FINISH), поэтому их конкатенация — корректный поток deflate, как в pigz.
+# Блоки zstd — отдельные кадры, которые декодер читает подряд. Если задан store_threshold
+# и начало блока почти не сжимается, блок deflate пишется без сжатия (уровень 0) —
+# zstd такие данные распознает сам и быстро.
+def compress_block(codec, level, data, final, store_threshold=None):
+    if codec == 'deflate':
+        if (store_threshold and len(data) >= 2 * BLOCK_SAMPLE_SIZE
+                and sample_ratio(data[:BLOCK_SAMPLE_SIZE]) > store_threshold):
+            level = 0
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return bytes(data)
+
+# Запись в ZIP (с дескрипторами данных и ZIP64) в поток без перемотки.
+# Сжатые данные поступают уже готовыми, поэтому их можно получать из пула потоков.
+class ZipStreamWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.entries = []
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def start_entry(self, entry):
+        entry.started = True
+        entry.header_offset = self.offset
+        extra = b''
+        if entry.zip64:
+            # Размеры будут в дескрипторе данных; поле ZIP64 сообщает, что они 8-байтовые
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+        self._write(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, entry.version, entry.flags, entry.method,
+            entry.dos_time, entry.dos_date, 0, 0, 0, len(entry.name_bytes), len(extra)
+        ))
+        self._write(entry.name_bytes + extra)
+
+    def write(self, data):
+        self._write(data)
+
+    def end_entry(self, entry):
+        if entry.zip64:
+            self._write(struct.pack('<IIQQ', 0x08074b50, entry.crc, entry.compress_size, entry.file_size))
+        else:
+            if entry.file_size > zipfile.ZIP64_LIMIT or entry.compress_size > zipfile.ZIP64_LIMIT:
+                raise ValueError(f"Файл {entry.name} вырос во время архивации и требует ZIP64")
+            self._write(struct.pack('<IIII', 0x08074b50, entry.crc, entry.compress_size, entry.file_size))
+        self.entries.append(entry)
+
+    # Запись небольшой записи целиком из памяти (служебные файлы архива)
+    def add_bytes(self, name, data, codec=DEFAULT_COMPRESSION_CODEC, level=None):
+        entry = ZipEntry(name, len(data), time.time(), 0o100644, codec)
+        self.start_entry(entry)
+        compressed = compress_block(codec, DEFAULT_COMPRESSION_LEVELS[codec] if level is None else level, data, True)
+        entry.crc = zlib.crc32(data)
+        entry.file_size = len(data)
+        entry.compress_size = len(compressed)
+        self.write(compressed)
+        self.end_entry(entry)
+
+    def close(self):
+        cd_offset = self.offset
+        for entry in self.entries:
+            sizes = [entry.file_size, entry.compress_size, entry.header_offset]
+            zip64_fields = [value for value in sizes if value >= zipfile.ZIP64_LIMIT]
+            extra = b''
+            if zip64_fields:
+                extra = struct.pack('<HH', 1, 8 * len(zip64_fields)) + struct.pack(f'<{len(zip64_fields)}Q', *zip64_fields)
+            file_size, compress_size, header_offset = [min(value, 0xFFFFFFFF) for value in sizes]
+            version = max(entry.version, zipfile.ZIP64_VERSION if zip64_fields else 0)
+            self._write(struct.pack(
+                '<IBBHHHHHIIIHHHHHII', 0x02014b50, version, entry.create_system, version,
+                entry.flags, entry.method, entry.dos_time, entry.dos_date, entry.crc,
+                compress_size, file_size, len(entry.name_bytes), len(extra), 0, 0, 0,
+                entry.external_attr, header_offset
+            ))
+            self._write(entry.name_bytes + extra)
+        cd_size = self.offset - cd_offset
+        count = len(self.entries)
+        if count >= 0xFFFF or cd_offset >= zipfile.ZIP64_LIMIT or cd_size >= zipfile.ZIP64_LIMIT:
+            zip64_offset = self.offset
+            self._write(struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, zipfile.ZIP64_VERSION, zipfile.ZIP64_VERSION,
+                0, 0, count, count, cd_size, cd_offset
+            ))
+            self._write(struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1))
+        self._write(struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(cd_size, 0xFFFFFFFF), min(cd_offset, 0xFFFFFFFF), 0
+        ))
+        self.fileobj.flush()
+
+# Метаданные одной записи ZIP
+class ZipEntry:
+    def __init__(self, name, file_size, mtime, mode, codec):
+        self.name = name
+        self.name_bytes = name.encode('utf-8')
+        self.file_size = 0
+        self.compress_size = 0
+        self.crc = 0
+        self.header_offset = 0
+        self.started = False
+        self.method = ZIP_METHODS[codec]
+        # Как и zipfile, заранее включаем ZIP64 для файлов, близких к пределу в 4 ГиБ
+        self.zip64 = file_size * 1.05 > zipfile.ZIP64_LIMIT
+        self.version = 63 if codec == 'zstd' else (zipfile.ZIP64_VERSION if self.zip64 else 20)
+        self.flags = 0x08 | (0x800 if not name.isascii() else 0)  # Дескриптор данных, UTF-8 имя
+        self.create_system = 0 if sys.platform == 'win32' else 3
+        self.external_attr = (mode & 0xFFFF) << 16
+        date_time = time.localtime(mtime)
+        year = max(date_time.tm_year, 1980)
+        self.dos_date = (year - 1980) << 9 | date_time.tm_mon << 5 | date_time.tm_mday
+        self.dos_time = date_time.tm_hour << 11 | date_time.tm_min << 5 | date_time.tm_sec // 2
+
+# Обход source_dir: пары (полный путь, имя в архиве)
+def iter_source_files(source_dir):
+    for root, dirs, files in os.walk(source_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+            arcname = os.path.relpath(file_path, start=source_dir).replace(os.sep, '/')  # Относительный путь в архиве
+            yield file_path, arcname
+
+# Кольцо буферов для чтения блоков: буфер снова используется, когда блок, прочитанный в него,
+# уже сжат и записан (в работе одновременно не больше size - 2 блоков, плюс блок, прочитанный
+# наперед, и текущий), поэтому память под блоки не выделяется заново на каждое чтение
+class BufferRing:
+    def __init__(self, size, block_size):
+        self.buffers = [None] * size
+        self.block_size = block_size
+        self.index = 0
+        self.zero = bytes(block_size)  # Блок "дыры" разреженного файла, общий для всех файлов
+
+    def next(self):
+        slot = self.index % len(self.buffers)
+        self.index += 1
+        if self.buffers[slot] is None:
+            self.buffers[slot] = bytearray(self.block_size)
+        return self.buffers[slot]
+
+# Чтение файла блоками через readinto в буферы из кольца. Блоки, целиком лежащие в "дыре"
+# разреженного файла (SEEK_DATA/SEEK_HOLE), не читаются с диска и отдаются общим блоком нулей.
+class BlockReader:
+    def __init__(self, f, ring):
+        self.f = f
+        self.ring = ring
+        self.block_size = ring.block_size
+        self.fd = f.fileno()
+        stat = os.fstat(self.fd)
+        self.size = stat.st_size
+        self.position = 0
+        self.hole_bytes = 0
+        # Дыры ищем только в файлах, занимающих на диске меньше своего размера
+        blocks = getattr(stat, 'st_blocks', None)
+        self.sparse = (hasattr(os, 'SEEK_DATA') and blocks is not None
+                       and blocks * 512 < self.size and self.size > self.block_size)
+
+    # Смещение следующих данных; для файловых систем без SEEK_DATA — всегда текущее
+    def _next_data(self):
+        try:
+            offset = os.lseek(self.fd, self.position, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # Дальше до конца файла только дыра
+                offset = self.size
+            else:
+                self.sparse = False
+                offset = self.position
+        os.lseek(self.fd, self.position, os.SEEK_SET)
+        return offset
+
+    def read(self):
+        end = self.position + self.block_size
+        if self.sparse and end <= self.size and self._next_data() >= end:
+            self.position = end
+            self.hole_bytes += self.block_size
+            os.lseek(self.fd, self.position, os.SEEK_SET)
+            return memoryview(self.ring.zero)
+        buffer = self.ring.next()
+        view = memoryview(buffer)
+        filled = 0
+        while filled < self.block_size:
+            count = self.f.readinto(view[filled:])
+            if not count:
+                break
+            filled += count
+        self.position += filled
+        return view[:filled]
+
+# Чтение файла блоками с признаком последнего блока
+def _read_blocks(reader):
+    current = reader.read()
+    while True:
+        following = reader.read() if len(current) == reader.block_size else b''
+        yield current, not following
+        if not following:
+            return
+        current = following
+
+# Запись ZIP-архива в файлоподобный объект. Файлы читаются последовательно, блоки
+# сжимаются в пуле потоков (zlib и zstd отпускают GIL), а результат пишется строго по порядку.
+# Если передан план инкрементального бэкапа, в архив попадают только новые и измененные файлы.
+def write_archive(source_dir, fileobj, compression=None, plan=None, report=None):
+    report = report or RunReport()
+    settings = compression_settings(compression)
+    codec, level = settings['codec'], settings['level']
+    max_in_flight = settings['workers'] * 2
+    writer = ZipStreamWriter(fileobj)
+    pending = deque()
+    ring = BufferRing(max_in_flight + 2, settings['block_size'])
+    store_threshold = settings['store_threshold'] if settings['adaptive'] else None
+    zero_blocks = {}  # Сжатые блоки нулей: дыры разреженных файлов сжимаются один раз
+
+    def submit(file_codec, block, final):
+        if block.obj is not ring.zero:
+            return pool.submit(
+                report.call, 'compress', compress_block, file_codec, level, block, final, store_threshold
+            )
+        if (file_codec, final) not in zero_blocks:
+            zero_blocks[file_codec, final] = compress_block(file_codec, level, block, final)
+        future = Future()
+        future.set_result(zero_blocks[file_codec, final])
+        return future
+
+    def drain_one():
+        entry, future, block, final, file_path = pending.popleft()
+        if not entry.started:
+            writer.start_entry(entry)
+        compressed = future.result()
+        report.add('compress', bytes_in=len(block), bytes_out=len(compressed))
+        entry.crc = zlib.crc32(block, entry.crc)
+        if plan:
+            entry.sha256.update(block)
+        entry.file_size += len(block)
+        entry.compress_size += len(compressed)
+        writer.write(compressed)
+        if final:
+            writer.end_entry(entry)
+            if plan:
+                plan.record_hash(entry.name, entry.sha256.hexdigest())
+            logging.info(f"Добавлен файл в архив: {file_path}")
+
+    with ThreadPoolExecutor(max_workers=settings['workers']) as pool:
+        for file_path, arcname in report.iterate('walk', iter_source_files(source_dir)):
+            st = report.call('walk', os.stat, file_path)
+            if plan and not plan.include(arcname, st):
+                report.add('walk', files_skipped=1)
+                continue
+            report.add('walk', files=1, bytes_in=st.st_size)
+            with open(file_path, 'rb', buffering=0) as f:
+                file_codec = report.call('compress', choose_file_codec, f, arcname, st.st_size, settings)
+                if file_codec != codec:
+                    report.add('compress', stored_files=1)
+                entry = ZipEntry(arcname, st.st_size, st.st_mtime, st.st_mode, file_codec)
+                if plan:
+                    entry.sha256 = hashlib.sha256()
+                reader = BlockReader(f, ring)
+                for block, final in report.iterate('read', _read_blocks(reader)):
+                    report.add('read', bytes_in=len(block))
+                    future = submit(file_codec, block, final)
+                    pending.append((entry, future, block, final, file_path))
+                    while len(pending) >= max_in_flight:
+                        drain_one()
+                if reader.hole_bytes:
+                    report.add('read', sparse_bytes=reader.hole_bytes)
+        while pending:
+            drain_one()
+    if plan:
+        writer.add_bytes(MANIFEST_ARCNAME, plan.manifest_bytes())
+    writer.close()
+    report.add('archive', bytes_out=writer.offset)
+
+# План инкрементального бэкапа: какие файлы изменились относительно прошлого состояния
+class BackupPlan:
+    def __init__(self, kind, previous_files, chain, created):
+        self.kind = kind  # "full" или "incremental"
+        self.previous_files = previous_files
+        self.chain = chain  # Имена бэкапов на сервере от последнего полного до предыдущего
+        self.created = created
+        self.files = {}
+        self.changed = []
+
+    # Решение, нужно ли архивировать файл (новый или изменились размер/mtime)
+    def include(self, arcname, st):
+        previous = self.previous_files.get(arcname)
+        if (self.kind == 'incremental' and previous
+                and previous['size'] == st.st_size and previous['mtime'] == st.st_mtime_ns):
+            self.files[arcname] = previous
+            return False
+        self.files[arcname] = {"size": st.st_size, "mtime": st.st_mtime_ns}
+        self.changed.append(arcname)
+        return True
+
+    # Сброс результатов обхода перед повторной архивацией
+    def reset(self):
+        self.files = {}
+        self.changed = []
+
+    def record_hash(self, arcname, sha256):
+        self.files[arcname]["sha256"] = sha256
+
+    def deleted(self):
+        if self.kind != 'incremental':
+            return []
+        return sorted(name for name in self.previous_files if name not in self.files)
+
+    def manifest_bytes(self):
+        return json.dumps({
+            "version": 1,
+            "kind": self.kind,
+            "created": self.created,
+            "chain": self.chain if self.kind == 'incremental' else [],
+            "changed": self.changed,
+            "deleted": self.deleted(),
+            "files": self.files,
+        }, ensure_ascii=False).encode('utf-8')
+
+# Путь к файлу состояния инкрементальных бэкапов
+def manifest_path(config):
+    incremental = config.get('incremental', {})
+    return incremental.get('manifest_file') or os.path.join(config['backup_dir'], DEFAULT_MANIFEST_FILE)
+
+# Подготовка плана: полный бэкап, если состояния нет или подошел срок по schedule.full_every
+def prepare_backup_plan(config, client_timestamp):
+    if not config.get('incremental', {}).get('enabled', False):
+        return None
+    state = None
+    path = manifest_path(config)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    full_every = config.get('schedule', {}).get('full_every', DEFAULT_FULL_EVERY)
+    if not state or not state.get('chain') or len(state['chain']) >= full_every:
+        logging.info("Будет выполнен полный бэкап")
+        return BackupPlan('full', {}, [], client_timestamp)
+    logging.info(f"Будет выполнен инкрементальный бэкап (в цепочке {len(state['chain'])} бэкапов)")
+    return BackupPlan('incremental', state['files'], state['chain'], client_timestamp)
+
+# Сохранение состояния после успешной загрузки бэкапа на сервер
+def commit_backup_plan(config, plan, backup_name):
+    chain = plan.chain + [backup_name] if plan.kind == 'incremental' else [backup_name]
+    path = manifest_path(config)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({"version": 1, "chain": chain, "files": plan.files}, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+    logging.info(
+        f"Состояние инкрементального бэкапа сохранено: изменено {len(plan.changed)}, "
+        f"удалено {len(plan.deleted())}, файлов всего {len(plan.files)}"
+    )
+
+# Контрольные суммы бэкапов, загруженных с этого клиента (имя на сервере -> SHA-256)
+def checksums_path(config):
+    return os.path.join(config['backup_dir'], DEFAULT_CHECKSUMS_FILE)
+
+def load_checksums(config):
+    path = checksums_path(config)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def record_checksum(config, backup_name, sha256):
+    checksums = load_checksums(config)
+    checksums[backup_name] = sha256
+    os.makedirs(config['backup_dir'], exist_ok=True)
+    temp_path = checksums_path(config) + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(checksums, f, indent=2)
+    os.replace(temp_path, checksums_path(config))
+
+# Аутентификация токеном: пароль отправляется серверу один раз (POST /token), дальше запросы идут
+# с токеном, который сервер проверяет по подписи, без дорогой проверки хеша пароля. Токен получается
+# заново незадолго до истечения или после отказа 401. Со старым сервером без /token — базовая аутентификация.
+class TokenAuth(AuthBase):
+    def __init__(self, session, server_url, username, password):
+        self.session = session
+        self.token_url = f"{server_url}/token"
+        self.basic = HTTPBasicAuth(username, password)
+        self.token = None
+        self.expires = 0
+        self.supported = True
+        self.lock = threading.Lock()
+
+    def _get_token(self):
+        with self.lock:
+            if self.supported and (self.token is None or time.monotonic() > self.expires - TOKEN_REFRESH_MARGIN):
+                self.token = None
+                try:
+                    response = self.session.post(self.token_url, auth=self.basic)
+                except requests.RequestException as e:
+                    logging.warning(f"Не удалось получить токен доступа: {e}")
+                    return None
+                if response.status_code in (404, 405):
+                    self.supported = False
+                elif response.status_code == 200:
+                    data = response.json()
+                    self.token = data['token']
+                    self.expires = time.monotonic() + data['expires_in']
+            return self.token
+
+    # Отказ 401 с токеном: токен отозван (сменился пароль или секрет сервера). Как в HTTPDigestAuth,
+    # запрос один раз повторяется с новым токеном (или с паролем, если токен получить не удалось).
+    # Запрос с телом-потоком (генератор, файл) повторить нельзя, он возвращается с 401.
+    def _on_response(self, response, **kwargs):
+        request = response.request
+        if response.status_code != 401 or getattr(request, 'token_retried', False):
+            return response
+        token = request.headers.get('Authorization', '')[len('Bearer '):]
+        if not token:
+            return response
+        with self.lock:
+            if token == self.token:
+                self.token = None
+        if not isinstance(request.body, (bytes, str, type(None))):
+            return response
+
+        response.content  # Дочитываем ответ, чтобы вернуть соединение в пул
+        response.close()
+        retry = request.copy()
+        retry.token_retried = True
+        token = self._get_token()
+        if token is None:
+            self.basic(retry)
+        else:
+            retry.headers['Authorization'] = f"Bearer {token}"
+        retry_response = response.connection.send(retry, **kwargs)
+        retry_response.history.append(response)
+        retry_response.request = retry
+        return retry_response
+
+    def __call__(self, request):
+        token = self._get_token()
+        if token is None:
+            return self.basic(request)
+        request.headers['Authorization'] = f"Bearer {token}"
+        request.register_hook('response', self._on_response)
+        return request
+
+# Сессия HTTP с пулом keep-alive соединений (одно соединение на поток загрузки)
+def create_http_session(server_url, username, password, pool_size=DEFAULT_UPLOAD_PARALLEL):
+    session = requests.Session()
+    session.auth = TokenAuth(session, server_url, username, password)
+    session.verify = False  # Отключение проверки SSL (для самоподписанных сертификатов)
+    mount_http_adapter(session, pool_size)
+    return session
+
+# Пул соединений сессии на pool_size соединений. Прежний пул закрывается: его свободные соединения
+# закрываются сразу, а занятые — когда запрос, который их использует, завершится.
+def mount_http_adapter(session, pool_size):
+    previous = session.adapters.get("https://")
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.pool_size = pool_size
+    if previous is not None:
+        previous.close()
+
+# Сессии, общие для всего запуска: список, загрузка, скачивание и проверка бэкапов идут через одни
+# и те же keep-alive соединения и один токен, а не открывают соединение (и TLS) на каждый запрос.
+# Если следующему вызову нужно больше параллельных соединений, пул сессии расширяется.
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def get_http_session(server_url, username, password, pool_size=DEFAULT_UPLOAD_PARALLEL):
+    key = (server_url, username, password)
+    with _http_sessions_lock:
+        session = _http_sessions.get(key)
+        if session is None:
+            session = _http_sessions[key] = create_http_session(server_url, username, password, pool_size)
+        elif session.pool_size < pool_size:
+            mount_http_adapter(session, pool_size)
+        return session
+
+@atexit.register
+def close_http_sessions():
+    with _http_sessions_lock:
+        for session in _http_sessions.values():
+            session.close()
+        _http_sessions.clear()
+
+# Задержка перед повтором: Retry-After из ответа сервера или экспоненциальная со случайным
+# разбросом, чтобы клиенты, получившие отказ одновременно, не вернулись тоже одновременно
+def retry_delay(response, attempt):
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), MAX_RETRY_DELAY)
+    return random.uniform(0, min(2 ** attempt, 60))
+
+# Запрос с повторами при сетевых ошибках, ответах 5xx и 429 (сервер ограничивает число загрузок).
+# on_throttle вызывается при каждом ответе 429.
+def request_with_retries(session, method, url, retries=DEFAULT_UPLOAD_RETRIES, on_throttle=None, **kwargs):
+    for attempt in range(retries + 1):
+        response = None
+        try:
+            response = session.request(method, url, **kwargs)
+            if response.status_code == 429 and on_throttle:
+                on_throttle()
+            if (response.status_code < 500 and response.status_code != 429) or attempt == retries:
+                return response
+            logging.warning(f"Сервер ответил {response.status_code} на {method} {url}, повтор")
+        except requests.ConnectionError as e:
+            if attempt == retries:
+                raise
+            logging.warning(f"Ошибка соединения при {method} {url}: {e}, повтор")
+        time.sleep(retry_delay(response, attempt))
+
+# Число одновременных загрузок частей. Сервер ограничивает загрузки одного пользователя
+# (upload_limits.max_per_user), поэтому после первого отказа 429 лимит снижается до числа
+# загрузок, которые сервер принял, и лишние части больше не ждут в его очереди.
+class PartUploadLimit:
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.active = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def throttle(self):
+        with self.condition:
+            limit = max(1, self.active - 1)  # Отклоненная загрузка тоже занимает место
+            if limit < self.limit:
+                self.limit = limit
+                logging.warning(f"Сервер ограничивает число загрузок, частей параллельно: {limit}")
+
+# Загрузка одной части файла с проверкой контрольной суммы на сервере
+def _upload_part(session, upload_url, file_path, number, part_size, retries, limit=None):
+    with limit.slot() if limit else nullcontext():
+        with open(file_path, 'rb') as f:
+            f.seek(number * part_size)
+            data = f.read(part_size)
+        response = request_with_retries(
+            session, "PUT", f"{upload_url}/parts/{number}", retries, limit.throttle if limit else None, data=data,
+            headers={"Content-Type": "application/octet-stream", "X-Part-SHA256": hashlib.sha256(data).hexdigest()}
+        )
+    response.raise_for_status()
+    return len(data)
+
+# Метаданные бэкапа для каталога на сервере: шифрование, сжатие, вид бэкапа и его родитель в цепочке
+def backup_metadata(config, encryption=None, plan=None):
+    settings = compression_settings(config.get('compression'))
+    metadata = {"compression": f"{settings['codec']}-{settings['level']}", "kind": plan.kind if plan else "full"}
+    if encryption:
+        metadata["encryption"] = encryption
+    if plan and plan.kind == 'incremental' and plan.chain:
+        metadata["parent"] = plan.chain[-1]
+    return metadata
+
+# Загрузка на собственный сервер по частям: части отправляются параллельно, каждая проверяется
+# сервером по SHA-256, а при завершении сервер сверяет SHA-256 всего файла.
+# Идентификатор сессии хранится рядом с файлом, поэтому прерванную загрузку можно продолжить
+# с последней подтвержденной части, а не с начала.
+def upload_to_server(file_path, server_url, username, password, client_timestamp=None, upload=None, metadata=None,
+                     sha256=None):
+    upload = upload or {}
+    part_size = upload.get('part_size', DEFAULT_UPLOAD_PART_SIZE)
+    parallel = upload.get('parallel', DEFAULT_UPLOAD_PARALLEL)
+    retries = upload.get('retries', DEFAULT_UPLOAD_RETRIES)
+    size = os.path.getsize(file_path)
+    sha256 = sha256 or file_sha256(file_path)
+    part_count = max(1, -(-size // part_size))
+    state_path = file_path + '.upload.json'
+    session = get_http_session(server_url, username, password, parallel)
+
+    try:
+        # Продолжение ранее начатой сессии, если она еще есть на сервере
+        done = set()
+        upload_id = None
+        if os.path.exists(state_path):
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+            if state.get('size') == size and state.get('part_size') == part_size:
+                response = request_with_retries(session, "GET", f"{server_url}/uploads/{state['upload_id']}", retries)
+                if response.status_code == 503:
+                    response.raise_for_status()  # Сервер еще завершает эту загрузку: новую не начинаем
+                if response.status_code == 200:
+                    upload_id = state['upload_id']
+                    if response.json().get('result'):
+                        # Загрузка уже завершена, но ответ на /complete не дошел: он вернет тот же бэкап
+                        done = set(range(part_count))
+                    for part in response.json()['parts']:
+                        expected = min(part_size, size - part['number'] * part_size)
+                        if part['size'] == expected:
+                            done.add(part['number'])
+                    logging.info(f"Продолжение загрузки {file_path}: на сервере уже {len(done)} из {part_count} частей")
+        if upload_id is None:
+            response = request_with_retries(
+                session, "POST", f"{server_url}/uploads", retries, json={"client_timestamp": client_timestamp, **(metadata or {})}
+            )
+            response.raise_for_status()
+            upload_id = response.json()['upload_id']
+            with open(state_path, 'w') as f:
+                json.dump({"upload_id": upload_id, "size": size, "part_size": part_size}, f)
+
+        upload_url = f"{server_url}/uploads/{upload_id}"
+        limit = PartUploadLimit(parallel)
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            futures = [
+                pool.submit(_upload_part, session, upload_url, file_path, number, part_size, retries, limit)
+                for number in range(part_count) if number not in done
+            ]
+            for future in futures:
+                future.result()
+
+        response = request_with_retries(
+            session, "POST", f"{upload_url}/complete", retries, json={"parts": part_count, "size": size, "sha256": sha256}
         )
+    except requests.RequestException as e:
+        logging.error(f"Ошибка при загрузке бэкапа {file_path}: {e}")
+        return None
+
     if response.status_code == 200:
+        os.remove(state_path)
         logging.info(f"Бэкап {file_path} загружен на сервер.")
+        return os.path.basename(response.json().get('path'))  # Имя бэкапа на сервере
     else:
         logging.error(f"Ошибка при загрузке бэкапа: {response.json().get('error')}")
+        return None
+
+# Ошибка отмены конвейера (одна из стадий упала или загрузка прервана)
+class PipelineCancelled(Exception):
+    pass
+
+# Конвейер бэкапа: стадии в отдельных потоках, связанные ограниченными очередями.
+# Заполненная очередь блокирует предыдущую стадию, поэтому память не растет.
+class BackupPipeline:
+    _END = object()  # Маркер конца потока в очереди
+
+    def __init__(self, queue_size=DEFAULT_PIPELINE_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.cancelled = threading.Event()
+        self.errors = []
+        self.threads = []
+
+    def queue(self):
+        return queue.Queue(maxsize=self.queue_size)
+
+    def put(self, q, item):
+        while not self.cancelled.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise PipelineCancelled()
+
+    def close_queue(self, q):
+        self.put(q, self._END)
+
+    def iter_queue(self, q):
+        while True:
+            if self.cancelled.is_set():
+                raise PipelineCancelled()
+            try:
+                item = q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is self._END:
+                return
+            yield item
+
+    def start(self, name, func, *args):
+        def run():
+            try:
+                func(*args)
+            except PipelineCancelled:
+                pass
+            except Exception as e:
+                logging.error(f"Ошибка на стадии конвейера '{name}': {e}")
+                self.errors.append(e)
+                self.cancelled.set()
+        thread = threading.Thread(target=run, name=f"pipeline-{name}", daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+# Файлоподобный объект, который режет записываемые данные на куски и кладет их в очередь конвейера
+class QueueWriter:
+    def __init__(self, pipeline, q, chunk_size=DEFAULT_PIPELINE_CHUNK_SIZE):
+        self.pipeline = pipeline
+        self.q = q
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self.pipeline.put(self.q, bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.pipeline.put(self.q, bytes(self.buffer))
+            self.buffer = bytearray()
+        self.pipeline.close_queue(self.q)
+
+# Стадия архивации: обход source_dir и сжатие в очередь
+def _archive_stage(pipeline, source_dir, out_queue, chunk_size, compression, plan, report):
+    writer = QueueWriter(pipeline, out_queue, chunk_size)
+    with report.stage('archive'):
+        write_archive(source_dir, writer, compression, plan, report)
+    writer.close()
+
+# Стадия шифрования: чтение сжатого потока из очереди и потоковое шифрование в следующую очередь
+def _encrypt_stage(pipeline, in_queue, out_queue, key, chunk_size, report):
+    writer = QueueWriter(pipeline, out_queue, chunk_size)
+    with EncryptingWriter(writer, key, chunk_size, report) as encryptor:
+        for chunk in pipeline.iter_queue(in_queue):
+            encryptor.write(chunk)
+    writer.close()
+
+# Одна попытка потоковой загрузки: архивация -> сжатие -> шифрование -> HTTP (chunked)
+def _stream_attempt(config, key, client_timestamp, plan, report):
+    pipeline_config = config.get('pipeline', {})
+    chunk_size = pipeline_config.get('chunk_size', DEFAULT_PIPELINE_CHUNK_SIZE)
+    pipeline = BackupPipeline(pipeline_config.get('queue_size', DEFAULT_PIPELINE_QUEUE_SIZE))
+
+    archive_queue = pipeline.queue()
+    pipeline.start(
+        "archive", _archive_stage, pipeline, config['source_dir'], archive_queue, chunk_size,
+        config.get('compression'), plan, report
+    )
+    upload_queue = archive_queue
+    if key:
+        upload_queue = pipeline.queue()
+        pipeline.start(
+            "encrypt", _encrypt_stage, pipeline, archive_queue, upload_queue, key,
+            config.get('encryption', {}).get('chunk_size', DEFAULT_STREAM_CHUNK_SIZE), report
+        )
+
+    # Тело запроса: данные из последней очереди с подсчетом отправленных байт и SHA-256
+    digest = hashlib.sha256()
+
+    def body():
+        for chunk in pipeline.iter_queue(upload_queue):
+            report.add('upload', bytes_out=len(chunk))
+            digest.update(chunk)
+            yield chunk
+
+    try:
+        with report.stage('upload'):
+            response = get_http_session(config['server_url'], config['username'], config['password']).post(
+                f"{config['server_url']}/upload-stream",
+                data=body(),  # Генератор -> Transfer-Encoding: chunked
+                params={
+                    "client_timestamp": client_timestamp,
+                    **backup_metadata(config, STREAM_ENCRYPTION if key else None, plan),
+                },
+                headers={"Content-Type": "application/octet-stream"},
+            )
+    except Exception:
+        pipeline.cancel()
+        pipeline.join()
+        raise
+    if response.status_code in BUSY_STATUSES:
+        pipeline.cancel()  # Сервер отказал до чтения тела, архивацию нужно будет начать заново
+    pipeline.join()
+    return response, digest.hexdigest()
+
+# Предварительный запрос допуска к потоковой загрузке: сервер держит его в своей очереди, пока не освободится
+# место, или отвечает 429/503 с Retry-After. Сервер без этого запроса отвечает 404 — тогда загрузка идет сразу.
+def _stream_admission(config):
+    return get_http_session(config['server_url'], config['username'], config['password']).get(
+        f"{config['server_url']}/upload-stream/admission"
+    )
+
+# Потоковая загрузка на сервер одним проходом. Конвейер запускается только после допуска: отказ сервера
+# до чтения тела клиент, еще отправляющий тело, видит не как 429/503, а как разрыв соединения.
+# Если сервер занят, попытка повторяется после Retry-After; если соединение разорвано, а сервер
+# отвечает, поток начинается заново сразу. Счетчики стадий неудачной попытки в отчет не попадают.
+def stream_backup(config, key, client_timestamp, plan=None, report=None):
+    report = report or RunReport()
+    retries = config.get('upload', {}).get('retries', DEFAULT_UPLOAD_RETRIES)
+    checkpoint = report.checkpoint()
+    sha256 = None
+    for attempt in range(retries + 1):
+        if attempt:
+            report.rollback(checkpoint)
+            if plan:
+                plan.reset()
+        response = _stream_admission(config)
+        if response.status_code not in BUSY_STATUSES:
+            try:
+                response, sha256 = _stream_attempt(config, key, client_timestamp, plan, report)
+            except requests.ConnectionError as e:
+                response = _stream_admission(config)  # Сервер недоступен — ошибка уходит выше
+                if attempt == retries:
+                    raise
+                if response.status_code not in BUSY_STATUSES:
+                    logging.warning(f"Потоковая загрузка прервана ({e}), загрузка начнется заново")
+                    continue
+        if response.status_code not in BUSY_STATUSES or attempt == retries:
+            break
+        delay = retry_delay(response, attempt)
+        logging.warning(f"Сервер занят, потоковая загрузка начнется через {delay:.0f} с")
+        time.sleep(delay)
+
+    if response.status_code == 200:
+        backup_name = os.path.basename(response.json().get('path'))
+        # Сумму при потоковой загрузке клиент узнает только в конце, поэтому сверяет ее с ответом сервера
+        server_sha256 = response.json().get('sha256')
+        if server_sha256 and server_sha256 != sha256:
+            logging.error(
+                f"Контрольная сумма бэкапа {backup_name} на сервере ({server_sha256}) "
+                f"не совпадает с отправленной ({sha256}), бэкап удален с сервера"
+            )
+            get_http_session(config['server_url'], config['username'], config['password']).delete(
+                f"{config['server_url']}/delete/{backup_name}"
+            )
+            return None
+        report.set(sha256=sha256)
+        logging.info(f"Бэкап загружен на сервер потоково: {response.json().get('path')}, sha256 {sha256}")
+        return backup_name
+    logging.error(f"Ошибка при потоковой загрузке бэкапа: {response.json().get('error')}")
+    return None
+
+# Разбиение потока на чанки по содержимому (content-defined chunking).
+# Граница ставится после первого якоря DEDUP_ANCHOR не ближе min_size от начала чанка,
+# поэтому вставка данных сдвигает границы лишь до ближайшего якоря.
+# Якорь ищется через bytes.find со скоростью C: побайтовый rolling hash на чистом Python
+# работает на порядки медленнее и стал бы узким местом конвейера.
+# В несжатых данных (codec store: текст, почти пустые страницы базы) якоря может не быть
+# на всем отрезке до max_size: тогда граница ставится по запасному образцу (см. _fallback_cut)
+# и тоже зависит только от соседних байт. Принудительно на max_size режутся только данные,
+# где нет и его, например длинные нулевые участки: их чанки одинаковы и так.
+def iter_content_chunks(pieces, min_size=DEFAULT_DEDUP_MIN_SIZE, max_size=DEFAULT_DEDUP_MAX_SIZE):
+    buffer = bytearray()
+    scanned = 0  # До этой позиции якоря в буфере уже искали
+
+    def cuts(final):
+        nonlocal scanned
+        while len(buffer) > min_size:
+            start = max(min_size, scanned - len(DEDUP_ANCHOR) + 1)
+            position = buffer.find(DEDUP_ANCHOR, start, min(len(buffer), max_size))
+            if position >= 0:
+                cut = position + len(DEDUP_ANCHOR)
+            elif len(buffer) >= max_size:
+                cut = _fallback_cut(buffer, min_size, max_size)
+            elif final:
+                break
+            else:
+                scanned = len(buffer)
+                return
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+            scanned = 0
+        if final and buffer:
+            yield bytes(buffer)
+
+    for piece in pieces:
+        buffer += piece
+        yield from cuts(final=False)
+    yield from cuts(final=True)
+
+# Запасная граница чанка без якоря: после первого DEDUP_FALLBACK_PATTERN в [min_size, max_size),
+# иначе на max_size. Байты блока считаются операциями над целыми блоками (translate, int.from_bytes,
+# XOR) со скоростью C; каждый зависит только от DEDUP_FALLBACK_WINDOW байт перед ним, поэтому после
+# вставки граница снова совпадает с прежней. Блок из одного повторенного байта (нулевые страницы)
+# дает одно и то же значение во всех позициях, и если оно не ноль, блок пропускается без подсчета.
+def _fallback_cut(buffer, min_size, max_size):
+    context = DEDUP_FALLBACK_WINDOW - 1
+    overlap = len(DEDUP_FALLBACK_PATTERN) - 1  # Образец на стыке блоков ищется в первом из них
+    for block_start in range(max(min_size, context), max_size, DEDUP_FALLBACK_BLOCK):
+        block = bytes(buffer[block_start - context:min(max_size, block_start + DEDUP_FALLBACK_BLOCK + overlap)])
+        size = len(block) - context
+        if block.count(block[:1]) == len(block) and _fallback_constant(block[0]):
+            continue
+        mixed = 0
+        for shift, table in enumerate(DEDUP_FALLBACK_TABLES):
+            mixed ^= int.from_bytes(block[context - shift:context - shift + size].translate(table), "big")
+        position = mixed.to_bytes(size, "big").find(DEDUP_FALLBACK_PATTERN)
+        if position >= 0:
+            return block_start + position + len(DEDUP_FALLBACK_PATTERN)
+    return max_size
+
+# Значение запасной суммы на участке из одного повторенного байта
+def _fallback_constant(value):
+    constant = 0
+    for table in DEDUP_FALLBACK_TABLES:
+        constant ^= table[value]
+    return constant
+
+# Отправка пачки чанков: сервер сообщает, каких у него нет, и загружаются только они
+def _upload_chunk_batch(session, server_url, batch, refs):
+    ids = list(dict.fromkeys(chunk_id for chunk_id, blob, plain_size in batch))
+    response = request_with_retries(session, "POST", f"{server_url}/chunks/missing", json={"chunks": ids})
+    response.raise_for_status()
+    missing = set(response.json()["missing"])
+    uploaded = 0
+    for chunk_id, blob, plain_size in batch:
+        if chunk_id in missing:
+            response = request_with_retries(
+                session, "PUT", f"{server_url}/chunks/{chunk_id}", data=blob,
+                headers={"Content-Type": "application/octet-stream"}
+            )
+            response.raise_for_status()
+            missing.discard(chunk_id)
+            uploaded += len(blob)
+        refs.append({"id": chunk_id, "size": len(blob), "plain_size": plain_size})
+    return uploaded
+
+# Бэкап с дедупликацией: поток архива режется на чанки по содержимому, на сервер уходят
+# только отсутствующие в его хранилище чанки, а сам бэкап записывается как список ссылок на них
+def dedup_backup(config, key, client_timestamp, plan=None, report=None):
+    report = report or RunReport()
+    dedup = config.get('dedup', {})
+    pipeline_config = config.get('pipeline', {})
+    chunk_size = pipeline_config.get('chunk_size', DEFAULT_PIPELINE_CHUNK_SIZE)
+    batch_size = dedup.get('batch_size', DEFAULT_DEDUP_BATCH_SIZE)
+    server_url = config['server_url']
+    session = get_http_session(server_url, config['username'], config['password'])
+
+    pipeline = BackupPipeline(pipeline_config.get('queue_size', DEFAULT_PIPELINE_QUEUE_SIZE))
+    archive_queue = pipeline.queue()
+    pipeline.start(
+        "archive", _archive_stage, pipeline, config['source_dir'], archive_queue, chunk_size,
+        config.get('compression'), plan, report
+    )
+    sealer = ChunkSealer(key) if key else None
+    refs = []
+    batch = []
+    total_bytes = uploaded_bytes = 0
+    digest = hashlib.sha256()  # SHA-256 всего бэкапа: чанки подряд, как их отдаст сервер при скачивании
+    try:
+        chunks = iter_content_chunks(
+            pipeline.iter_queue(archive_queue),
+            dedup.get('min_size', DEFAULT_DEDUP_MIN_SIZE), dedup.get('max_size', DEFAULT_DEDUP_MAX_SIZE)
+        )
+        for data in report.iterate('chunking', chunks):
+            if sealer:
+                blob = report.call('encrypt', sealer.seal, data)
+                report.add('encrypt', bytes_in=len(data), bytes_out=len(blob))
+            else:
+                blob = data
+            batch.append((hashlib.sha256(blob).hexdigest(), blob, len(data)))
+            digest.update(blob)
+            total_bytes += len(blob)
+            if len(batch) >= batch_size:
+                with report.stage('upload'):
+                    uploaded_bytes += _upload_chunk_batch(session, server_url, batch, refs)
+                batch = []
+        if batch:
+            with report.stage('upload'):
+                uploaded_bytes += _upload_chunk_batch(session, server_url, batch, refs)
+    except Exception:
+        pipeline.cancel()
+        pipeline.join()
+        raise
+    pipeline.join()
+
+    report.add('upload', bytes_out=uploaded_bytes)
+    report.add('chunking', chunks=len(refs), bytes_out=total_bytes)
+    response = session.post(
+        f"{server_url}/chunked-backups",
+        json={
+            "client_timestamp": client_timestamp,
+            "chunks": refs,
+            "sha256": digest.hexdigest(),
+            **backup_metadata(config, CHUNK_ENCRYPTION if key else None, plan),
+        }
+    )
+    if response.status_code == 200:
+        report.set(sha256=digest.hexdigest())
+        logging.info(
+            f"Бэкап записан на сервер из {len(refs)} чанков: {response.json().get('path')}. "
+            f"Передано {uploaded_bytes} из {total_bytes} байт"
+        )
+        return os.path.basename(response.json().get('path'))
+    logging.error(f"Ошибка при записи бэкапа из чанков: {response.json().get('error')}")
+    return None
+
+# Сохранение бэкапа в локальную очередь (spool), если сервер недоступен
+def spool_backup(config, key, client_timestamp, plan=None, report=None):
+    spool_dir = os.path.join(config['backup_dir'], SPOOL_DIR_NAME)
+    backup_file = create_backup(
+        config['source_dir'], spool_dir, key,
+        config.get('encryption', {}).get('chunk_size', DEFAULT_STREAM_CHUNK_SIZE),
+        timestamp=datetime.fromtimestamp(client_timestamp), compression=config.get('compression'), plan=plan,
+        report=report
+    )
+    logging.warning(f"Сервер недоступен, бэкап сохранен локально для последующей отправки: {backup_file}")
+    return backup_file
+
+# Отправка ранее сохраненных локально бэкапов
+def flush_spool(config):
+    spool_dir = os.path.join(config['backup_dir'], SPOOL_DIR_NAME)
+    if not os.path.isdir(spool_dir):
+        return
+    for name in sorted(os.listdir(spool_dir)):
+        if not name.startswith('backup_') or name.endswith('.upload.json'):
+            continue
+        file_path = os.path.join(spool_dir, name)
+        # Время создания бэкапа восстанавливаем из имени файла backup_YYYYmmddHHMMSS.zip[.enc]
+        client_timestamp = int(datetime.strptime(name[7:21], "%Y%m%d%H%M%S").timestamp())
+        # Вид бэкапа и родитель в цепочке для отложенных бэкапов неизвестны
+        metadata = {"encryption": STREAM_ENCRYPTION} if name.endswith('.enc') else {}
+        sha256 = file_sha256(file_path)
+        backup_name = upload_to_server(file_path, config['server_url'], config['username'], config['password'],
+                                       client_timestamp, config.get('upload'), metadata, sha256)
+        if not backup_name:
+            return
+        record_checksum(config, backup_name, sha256)
+        os.remove(file_path)
+        logging.info(f"Отложенный бэкап {file_path} отправлен и удален локально.")
 
 # Генерация SSL-сертификатов
 def generate_ssl_certificates(cert_file, key_file):
@@ -168,106 +1602,944 @@ def generate_ssl_certificates(cert_file, key_file):
 
     logging.info(f"Сертификат и ключ созданы: {cert_file}, {key_file}")
 
+# Клонирование файла (reflink): мгновенно, данные общие до первой записи в любую из копий.
+# Работает на Btrfs и XFS; на остальных файловых системах ioctl завершается OSError.
+def _reflink_file(src, dst):
+    if fcntl is None:
+        raise OSError("reflink не поддерживается на этой платформе")
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dst)
+
+# Снимок source_dir в staging_dir, пока сервис остановлен. Способы:
+# reflink — клон файла; copy — обычная копия (shutil.copy2 использует системное копирование);
+# hardlink — жесткая ссылка, годится, только если сервис не изменяет файлы на месте, а заменяет их;
+# auto — reflink, а если файловая система его не поддерживает, copy.
+def capture_snapshot(source_dir, staging_dir, method=DEFAULT_SNAPSHOT_METHOD, report=None):
+    report = report or RunReport()
+    if method not in ('auto', 'reflink', 'copy', 'hardlink'):
+        raise ValueError(f"Неизвестный способ снимка: {method}")
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)  # Остаток прерванного запуска
+    os.makedirs(staging_dir)
+    reflink_supported = method in ('auto', 'reflink')
+    for file_path, arcname in iter_source_files(source_dir):
+        target_path = os.path.join(staging_dir, arcname)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        if method == 'hardlink':
+            os.link(file_path, target_path)
+            used = 'hardlinked'
+        elif reflink_supported:
+            try:
+                _reflink_file(file_path, target_path)
+                used = 'reflinked'
+            except OSError as e:
+                if method == 'reflink':
+                    raise
+                logging.info(f"Reflink недоступен ({e}), файлы будут скопированы")
+                reflink_supported = False
+        if method == 'copy' or (method == 'auto' and not reflink_supported):
+            shutil.copy2(file_path, target_path)
+            used = 'copied'
+        report.add('capture', files=1, bytes_in=os.path.getsize(target_path), **{used: 1})
+    return staging_dir
+
 # Основная функция бэкапа
 def perform_backup(config):
     logging.info("Начало выполнения бэкапа")
+    report = RunReport()
+    snapshot = config.get('snapshot', {})
+    staging_dir = None
     try:
         # Выполнение пред-бэкап скрипта
-        if not run_script(config.get('pre_backup_script')):
+        downtime_started = time.perf_counter()
+        with report.stage('pre_script'):
+            pre_script_ok = run_script(config.get('pre_backup_script'))
+        if not pre_script_ok:
             logging.error("Пред-бэкап скрипт завершился с ошибкой. Бэкап отменен.")
+            report.finish('cancelled', "Пред-бэкап скрипт завершился с ошибкой")
             return  # Отменяем бэкап, если скрипт завершился с ошибкой
 
-        # Создание бэкапа
-        backup_file = create_backup(config['source_dir'], config['backup_dir'])
+        # Режим снимка: сервис остановлен только на время копирования source_dir в staging,
+        # пост-бэкап скрипт запускает его сразу, а сжатие и загрузка идут уже из снимка
+        post_script_ok = None
+        if snapshot.get('enabled', False):
+            staging_dir = snapshot.get('staging_dir') or os.path.join(config['backup_dir'], SNAPSHOT_DIR_NAME)
+            try:
+                with report.stage('capture'):
+                    capture_snapshot(
+                        config['source_dir'], staging_dir, snapshot.get('method', DEFAULT_SNAPSHOT_METHOD), report
+                    )
+            finally:
+                # Сервис запускаем, даже если снимок не удался
+                with report.stage('post_script'):
+                    post_script_ok = run_script(config.get('post_backup_script'))
+                report.set(downtime_seconds=round(time.perf_counter() - downtime_started, 3))
+            logging.info(f"Снимок {config['source_dir']} создан в {staging_dir}, сервис снова запущен")
+            config = dict(config, source_dir=staging_dir)
+        transfer_started = time.perf_counter()
 
-        # Шифрование бэкапа (если включено)
-        if config.get('encryption', {}).get('enabled', False):
-            key_file = config['encryption'].get('key_file', 'encryption_key.key')
+        # Ключ шифрования (если включено)
+        key = None
+        encryption = config.get('encryption', {})
+        if encryption.get('enabled', False):
+            key_file = encryption.get('key_file', 'encryption_key.key')
             generate_key(key_file)
             key = load_key(key_file)
-            backup_file = encrypt_file(backup_file, key)
 
-        # Загрузка на собственный сервер
-        if 'server_url' in config and 'username' in config and 'password' in config:
-            client_timestamp = int(time.time())  # Генерация Unix timestamp
-            upload_to_server(backup_file, config['server_url'], config['username'], config['password'], client_timestamp)
+        has_server = 'server_url' in config and 'username' in config and 'password' in config
+        pipeline_config = config.get('pipeline', {})
+        client_timestamp = int(time.time())  # Генерация Unix timestamp
+        plan = prepare_backup_plan(config, client_timestamp)
+        backup_name = None
+        spooled = False
+        report.set(
+            job=config.get('job_name'), client_timestamp=client_timestamp, kind=plan.kind if plan else "full",
+            encrypted=bool(key)
+        )
+
+        dedup_enabled = config.get('dedup', {}).get('enabled', False)
+        if has_server and (dedup_enabled or pipeline_config.get('enabled', False)):
+            # Однопроходный конвейер без промежуточных файлов
+            try:
+                # Сначала отправляем бэкапы, отложенные при прошлых запусках
+                flush_spool(config)
+                if dedup_enabled:
+                    report.set(mode="dedup")
+                    backup_name = dedup_backup(config, key, client_timestamp, plan, report)
+                else:
+                    report.set(mode="pipeline")
+                    backup_name = stream_backup(config, key, client_timestamp, plan, report)
+            except requests.ConnectionError as e:
+                if not pipeline_config.get('spool_on_failure', False):
+                    raise
+                logging.error(f"Сервер недоступен: {e}")
+                report = RunReport()  # Данные неудачной попытки не смешиваем с локальным бэкапом
+                report.set(mode="spool", client_timestamp=client_timestamp, kind=plan.kind if plan else "full")
+                if plan:
+                    plan.reset()  # Неудачная попытка уже успела пройти часть файлов
+                with report.stage('archive'):
+                    spool_backup(config, key, client_timestamp, plan, report)
+                spooled = True
+        else:
+            # Создание бэкапа (шифрование выполняется потоково при записи архива)
+            report.set(mode="file")
+            with report.stage('archive'):
+                backup_file = create_backup(
+                    config['source_dir'], config['backup_dir'], key,
+                    encryption.get('chunk_size', DEFAULT_STREAM_CHUNK_SIZE), compression=config.get('compression'),
+                    plan=plan, report=report
+                )
 
-        # Удаление локального архива после успешной загрузки
-        if os.path.exists(backup_file):
-            os.remove(backup_file)
-            logging.info(f"Локальный архив {backup_file} удален.")
+            # Загрузка на собственный сервер (сначала — бэкапы, отложенные при прошлых запусках)
+            if has_server:
+                flush_spool(config)
+                with report.stage('upload'):
+                    backup_name = upload_to_server(
+                        backup_file, config['server_url'], config['username'], config['password'], client_timestamp,
+                        config.get('upload'), backup_metadata(config, STREAM_ENCRYPTION if key else None, plan),
+                        report.fields.get('sha256')
+                    )
+                if backup_name:
+                    report.add('upload', bytes_out=os.path.getsize(backup_file))
 
-        # Выполнение пост-бэкап скрипта
-        if not run_script(config.get('post_backup_script')):
+            # Удаление локального архива после успешной загрузки. Если загрузка не удалась, архив вместе
+            # с состоянием загрузки уходит в spool: следующий запуск продолжит его с подтвержденных частей.
+            if backup_name:
+                os.remove(backup_file)
+                logging.info(f"Локальный архив {backup_file} удален.")
+            elif has_server:
+                spool_dir = os.path.join(config['backup_dir'], SPOOL_DIR_NAME)
+                os.makedirs(spool_dir, exist_ok=True)
+                spooled_file = os.path.join(spool_dir, os.path.basename(backup_file))
+                if os.path.exists(backup_file + '.upload.json'):
+                    os.replace(backup_file + '.upload.json', spooled_file + '.upload.json')
+                os.replace(backup_file, spooled_file)
+                spooled = True
+                logging.warning(f"Бэкап не загружен, сохранен локально для последующей отправки: {spooled_file}")
+
+        # Состояние для следующего инкрементального бэкапа сохраняем только после успешной загрузки
+        if plan and backup_name:
+            commit_backup_plan(config, plan, backup_name)
+        if backup_name and report.fields.get('sha256'):
+            record_checksum(config, backup_name, report.fields['sha256'])
+
+        report.set(backup_name=backup_name, transfer_seconds=round(time.perf_counter() - transfer_started, 3))
+
+        # Выполнение пост-бэкап скрипта (в режиме снимка он уже выполнен)
+        if post_script_ok is None:
+            with report.stage('post_script'):
+                post_script_ok = run_script(config.get('post_backup_script'))
+            report.set(downtime_seconds=round(time.perf_counter() - downtime_started, 3))
+        fields = report.as_dict()
+        logging.info(
+            f"Сервис был остановлен {fields['downtime_seconds']:.1f} с, "
+            f"сжатие и загрузка заняли {fields['transfer_seconds']:.1f} с"
+        )
+        if not post_script_ok:
             logging.error("Пост-бэкап скрипт завершился с ошибкой. Бэкап завершен с предупреждениями.")
+            report.finish('warning', "Пост-бэкап скрипт завершился с ошибкой")
             return  # Отменяем бэкап, если скрипт завершился с ошибкой
 
-        logging.info("Бэкап успешно завершен")
+        if backup_name or not has_server:
+            report.finish('ok')
+            logging.info("Бэкап успешно завершен")
+        elif spooled:
+            report.finish('spooled')
+            logging.warning("Бэкап не отправлен на сервер, он сохранен локально и будет отправлен при следующем запуске")
+        else:
+            report.finish('failed')
+            logging.error("Бэкап не выполнен: не удалось загрузить его на сервер")
     except Exception as e:
+        report.finish('failed', e)
         logging.error(f"Ошибка при выполнении бэкапа: {e}")
+    finally:
+        if staging_dir and os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        try:
+            report.write(config)
+        except OSError as e:
+            logging.error(f"Не удалось сохранить отчет о бэкапе: {e}")
+
+# Разбор поля cron: *, числа, списки, диапазоны и шаг (*/15, 1-5, 0,30, 5/10)
+def _parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        part, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(value) for value in part.split('-', 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"Недопустимое поле cron: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+# Расписание в формате cron (минута, час, день месяца, месяц, день недели) в местном времени.
+# Как в cron, если ограничены и день месяца, и день недели, подходит любой из них.
+class CronSchedule:
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"В выражении cron должно быть 5 полей: {expression}")
+        self.expression = expression
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = _parse_cron_field(fields[2], 1, 31)
+        self.months = _parse_cron_field(fields[3], 1, 12)
+        self.weekdays = {day % 7 for day in _parse_cron_field(fields[4], 0, 7)}  # 0 и 7 — воскресенье
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def _day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    # Ближайший момент запуска строго после moment
+    def next_after(self, moment):
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(moment):
+                moment = (moment + timedelta(days=1)).replace(hour=0, minute=0)
+            elif moment.hour not in self.hours:
+                moment = (moment + timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Расписание cron никогда не срабатывает: {self.expression}")
+
+    def __str__(self):
+        return f"cron {self.expression}"
+
+# Запуск через равные промежутки времени
+class IntervalSchedule:
+    def __init__(self, minutes):
+        self.interval = timedelta(minutes=minutes)
+
+    def next_after(self, moment):
+        return moment + self.interval
+
+    def __str__(self):
+        return f"каждые {self.interval}"
+
+# Расписание из секции "schedule": time (ежедневно ЧЧ:ММ), cron или interval_minutes.
+# Без расписания задание выполняется один раз при запуске.
+def parse_schedule(schedule_config):
+    if schedule_config.get('cron'):
+        return CronSchedule(schedule_config['cron'])
+    if schedule_config.get('time'):
+        hour, minute = schedule_config['time'].split(':')
+        return CronSchedule(f"{int(minute)} {int(hour)} * * *")
+    if schedule_config.get('interval_minutes'):
+        return IntervalSchedule(schedule_config['interval_minutes'])
+    return None
+
+# Задания из конфигурации: секция "jobs" (у каждого задания свои source_dir, backup_dir, schedule
+# и любые другие ключи поверх общих) или одно задание "default" из самой конфигурации.
+# Задания могут выполняться одновременно, поэтому общий snapshot.staging_dir делится на подкаталоги
+# по именам заданий, а совпадающие backup_dir и каталоги снимков считаются ошибкой конфигурации.
+def load_jobs(config):
+    base = {name: value for name, value in config.items() if name not in ('jobs', 'scheduler')}
+    jobs = {}
+    used_dirs = {}
+    for job in config.get('jobs') or [{"name": "default"}]:
+        name = job.get('name')
+        if not name or name in jobs:
+            raise ValueError(f"У каждого задания должно быть уникальное имя: {name}")
+        job_config = dict(base, **{key: value for key, value in job.items() if key != 'name'}, job_name=name)
+        snapshot = job_config.get('snapshot', {})
+        if config.get('jobs') and snapshot.get('staging_dir') and 'snapshot' not in job:
+            job_config['snapshot'] = dict(snapshot, staging_dir=os.path.join(snapshot['staging_dir'], name))
+        staging_dir = job_config.get('snapshot', {}).get('staging_dir') or os.path.join(
+            job_config['backup_dir'], SNAPSHOT_DIR_NAME
+        )
+        for path in (job_config['backup_dir'], staging_dir):
+            path = os.path.abspath(path)
+            if path in used_dirs:
+                raise ValueError(f"Задания {used_dirs[path]} и {name} используют один и тот же каталог {path}")
+            used_dirs[path] = name
+        jobs[name] = (job_config, parse_schedule(job_config.get('schedule', {})))
+    return jobs
+
+# Планировщик нескольких заданий: задания выполняются в пуле потоков не больше max_concurrent
+# одновременно, одно и то же задание не запускается повторно, пока не закончился прошлый запуск.
+# К моменту запуска добавляется случайная задержка до jitter секунд, чтобы клиенты филиалов
+# с одинаковым расписанием не обращались к серверу в одну секунду. Время последнего запуска
+# хранится в state_file: запуск, пропущенный из-за выключенного компьютера, выполняется
+# после старта (один раз, если пропущено несколько), если он не старше max_catch_up_age.
+class BackupScheduler:
+    def __init__(self, config):
+        scheduler_config = config.get('scheduler', {})
+        self.max_concurrent = scheduler_config.get('max_concurrent', 1)
+        self.jitter = scheduler_config.get('jitter', 0)
+        self.catch_up = scheduler_config.get('catch_up', True)
+        self.max_catch_up_age = scheduler_config.get('max_catch_up_age', 24 * 60 * 60)
+        self.state_file = scheduler_config.get('state_file', 'scheduler-state.json')
+        self.jobs = load_jobs(config)
+        self.lock = threading.Lock()
+        self.running = set()
+        self.state = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as f:
+                self.state = json.load(f)
+        self.pool = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="backup-job")
+        self.next_runs = {}  # Имя задания -> (момент по расписанию, фактический момент запуска с задержкой)
+
+    def _save_state(self):
+        with self.lock:
+            state = json.dumps(self.state, indent=2)
+        temp_path = self.state_file + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(state)
+        os.replace(temp_path, self.state_file)
+
+    def _delay(self):
+        return timedelta(seconds=random.uniform(0, self.jitter)) if self.jitter else timedelta(0)
+
+    # Первый запуск каждого задания с учетом пропущенного
+    def _plan_initial_runs(self, now):
+        for name, (job_config, job_schedule) in self.jobs.items():
+            if job_schedule is None:
+                self.next_runs[name] = (now, now)
+                continue
+            last = self.state.get(name, {}).get('last_scheduled')
+            if last is not None and self.catch_up:
+                missed = job_schedule.next_after(datetime.fromtimestamp(last))
+                if missed <= now and (now - missed).total_seconds() <= self.max_catch_up_age:
+                    run_at = now + self._delay()
+                    logging.warning(
+                        f"Задание {name}: пропущен запуск {missed:%Y-%m-%d %H:%M}, "
+                        f"он будет выполнен в {run_at:%H:%M:%S}"
+                    )
+                    self.next_runs[name] = (missed, run_at)
+                    continue
+            slot = job_schedule.next_after(now)
+            self.next_runs[name] = (slot, slot + self._delay())
+            logging.info(f"Задание {name} ({job_schedule}): следующий запуск в {slot:%Y-%m-%d %H:%M}")
+
+    def _run_job(self, name, job_config):
+        started = time.time()
+        logging.info(f"Задание {name}: запуск")
+        try:
+            perform_backup(job_config)
+        finally:
+            with self.lock:
+                self.running.discard(name)
+                self.state.setdefault(name, {}).update(last_started=started, last_finished=time.time())
+            self._save_state()
+            logging.info(f"Задание {name}: завершено за {time.time() - started:.1f} с")
+
+    def _dispatch(self, name, slot, now):
+        job_config, job_schedule = self.jobs[name]
+        with self.lock:
+            overlapping = name in self.running
+            if not overlapping:
+                self.running.add(name)
+            self.state.setdefault(name, {})['last_scheduled'] = slot.timestamp()
+        if overlapping:
+            logging.warning(f"Задание {name}: прошлый запуск еще не завершен, запуск {slot:%H:%M} пропущен")
+        else:
+            self.pool.submit(self._run_job, name, job_config)
+        self._save_state()
+        if job_schedule is None:
+            del self.next_runs[name]
+            return
+        # Если компьютер спал и прошло несколько моментов запуска, следующий берется после текущего времени
+        following = job_schedule.next_after(max(slot, now))
+        self.next_runs[name] = (following, following + self._delay())
+
+    def run(self):
+        self._plan_initial_runs(datetime.now())
+        while self.next_runs:
+            now = datetime.now()
+            for name, (slot, run_at) in sorted(self.next_runs.items(), key=lambda item: item[1][1]):
+                if run_at <= now:
+                    self._dispatch(name, slot, now)
+            if self.next_runs:
+                wait = min(run_at for slot, run_at in self.next_runs.values()) - datetime.now()
+                # Просыпаемся не реже раза в минуту, чтобы заметить перевод часов и выход из сна
+                time.sleep(min(max(wait.total_seconds(), 0.1), 60))
+        self.pool.shutdown(wait=True)
 
 # Планировщик задач
 def start_scheduler(config):
-    schedule_time = config.get('schedule', {}).get('time')
-    schedule_cron = config.get('schedule', {}).get('cron')
-
-    if schedule_time:
-        # Ежедневный запуск в указанное время
-        schedule.every().day.at(schedule_time).do(perform_backup, config)
-        logging.info(f"Бэкап запланирован на ежедневное выполнение в {schedule_time}")
-    elif schedule_cron:
-        # Использование cron-подобного синтаксиса
-        schedule.every().crontab(schedule_cron).do(perform_backup, config)
-        logging.info(f"Бэкап запланирован по cron-расписанию: {schedule_cron}")
-    else:
-        # Если расписание не указано, выполнить бэкап один раз
-        perform_backup(config)
-        return
-
-    # Бесконечный цикл для выполнения задач по расписанию
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    BackupScheduler(config).run()
 
 # Функция для получения списка бэкапов с сервера
-def list_backups(server_url, username, password):
+def list_backups(server_url, username, password, user=None, since=None, until=None, page_size=LIST_PAGE_SIZE):
+    params = {"limit": page_size, "offset": 0}
+    for name, value in (("user", user), ("since", since), ("until", until)):
+        if value is not None:
+            params[name] = value
+    backups = []
+    session = get_http_session(server_url, username, password)
     try:
-        response = requests.get(
-            f"{server_url}/list",
-            auth=HTTPBasicAuth(username, password),
-            verify=False  # Отключение проверки SSL (для самоподписанных сертификатов)
-        )
-        if response.status_code == 200:
-            return response.json().get("backups", [])
-        else:
-            logging.error(f"Ошибка при получении списка бэкапов: {response.json().get('error')}")
-            return []
+        # Сервер отдает список постранично; next_offset отсутствует на последней странице
+        while params["offset"] is not None:
+            response = session.get(f"{server_url}/list", params=params)
+            if response.status_code != 200:
+                logging.error(f"Ошибка при получении списка бэкапов: {response.json().get('error')}")
+                return backups
+            page = response.json()
+            backups.extend(page.get("backups", []))
+            params["offset"] = page.get("next_offset")
+        return backups
     except Exception as e:
         logging.error(f"Ошибка при подключении к серверу: {e}")
-        return []
+        return backups
+
+# Скачивание диапазона [start, end] в файл по тому же смещению. If-Range гарантирует,
+# что все диапазоны относятся к одной версии бэкапа: при изменении сервер ответит 200.
+def _download_range(session, url, etag, part_path, start, end, retries):
+    headers = {"Range": f"bytes={start}-{end}"}
+    if etag:
+        headers["If-Range"] = etag
+    for attempt in range(retries + 1):
+        try:
+            with session.get(url, headers=headers, stream=True) as response:
+                if response.status_code < 500:
+                    if response.status_code != 206:
+                        raise ValueError(f"Сервер ответил {response.status_code} на запрос диапазона, бэкап изменился")
+                    with open(part_path, 'r+b') as f:
+                        f.seek(start)
+                        for data in response.iter_content(DEFAULT_DOWNLOAD_BLOCK_SIZE):
+                            f.write(data)
+                        written = f.tell() - start
+                    if written == end - start + 1:
+                        return
+                    logging.warning(f"Получено {written} из {end - start + 1} байт диапазона {start}-{end}, повтор")
+                else:
+                    logging.warning(f"Сервер ответил {response.status_code} на GET {url}, повтор")
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == retries:
+                raise
+            logging.warning(f"Ошибка соединения при скачивании диапазона {start}-{end}: {e}, повтор")
+        time.sleep(min(2 ** attempt, 60))
+    raise ValueError(f"Не удалось скачать диапазон {start}-{end} бэкапа")
+
+# Функция для скачивания бэкапа с сервера: потоково, диапазонами (при download.parallel > 1 — параллельно),
+# с продолжением прерванного скачивания из .part-файла и проверкой контрольной суммы
+def download_backup(server_url, username, password, backup_name, download_dir="downloads", download=None):
+    download = download or {}
+    part_size = download.get('part_size', DEFAULT_DOWNLOAD_PART_SIZE)
+    parallel = download.get('parallel', DEFAULT_DOWNLOAD_PARALLEL)
+    retries = download.get('retries', DEFAULT_UPLOAD_RETRIES)
+    os.makedirs(download_dir, exist_ok=True)  # Создаем директорию для загрузок, если ее нет
+    file_path = os.path.join(download_dir, backup_name)
+    part_path = file_path + '.part'
+    state_path = file_path + '.part.json'
+    url = f"{server_url}/download/{backup_name}"
+    session = get_http_session(server_url, username, password, parallel)
 
-# Функция для скачивания бэкапа с сервера
-def download_backup(server_url, username, password, backup_name, download_dir="downloads"):
     try:
-        os.makedirs(download_dir, exist_ok=True)  # Создаем директорию для загрузок, если ее нет
-        response = requests.get(
-            f"{server_url}/download/{backup_name}",
-            auth=HTTPBasicAuth(username, password),
-            verify=False  # Отключение проверки SSL
-        )
-        if response.status_code == 200:
-            file_path = os.path.join(download_dir, backup_name)
-            with open(file_path, "wb") as f:
-                f.write(response.content)
-            logging.info(f"Бэкап {backup_name} успешно скачан в {file_path}")
-            return file_path
-        else:
-            logging.error(f"Ошибка при скачивании бэкапа: {response.json().get('error')}")
-            return None
-    except Exception as e:
+        # Первый запрос одного байта: размер, ETag и контрольная сумма бэкапа
+        response = request_with_retries(session, "GET", url, retries, headers={"Range": "bytes=0-0"}, stream=True)
+        with response:
+            if response.status_code not in (200, 206, 416):
+                logging.error(f"Ошибка при скачивании бэкапа: {response.json().get('error')}")
+                return None
+            etag = response.headers.get('ETag')
+            checksum = response.headers.get('X-Checksum-SHA256')
+            if response.status_code == 200:
+                # Сервер без поддержки Range: качаем целиком одним потоком
+                size = None
+                with open(part_path, 'wb') as f:
+                    for data in response.iter_content(DEFAULT_DOWNLOAD_BLOCK_SIZE):
+                        f.write(data)
+            else:
+                size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+
+        if size is not None:
+            state = None
+            if os.path.exists(state_path) and os.path.exists(part_path):
+                with open(state_path, 'r') as f:
+                    state = json.load(f)
+                if (state.get('etag'), state.get('size'), state.get('part_size')) != (etag, size, part_size):
+                    logging.info(f"Бэкап {backup_name} изменился на сервере, скачивание начнется заново")
+                    state = None
+            if state is None:
+                state = {"etag": etag, "size": size, "part_size": part_size, "done": []}
+                with open(part_path, 'wb') as f:
+                    f.truncate(size)
+            done = set(state['done'])
+            part_count = -(-size // part_size)
+            if done:
+                logging.info(f"Продолжение скачивания {backup_name}: готово {len(done)} из {part_count} частей")
+
+            lock = threading.Lock()
+
+            def fetch(number):
+                start = number * part_size
+                _download_range(session, url, etag, part_path, start, min(size, start + part_size) - 1, retries)
+                with lock:
+                    done.add(number)
+                    state['done'] = sorted(done)
+                    with open(state_path, 'w') as f:
+                        json.dump(state, f)
+
+            with ThreadPoolExecutor(max_workers=parallel) as pool:
+                futures = [pool.submit(fetch, number) for number in range(part_count) if number not in done]
+                for future in futures:
+                    future.result()
+    except (requests.RequestException, ValueError) as e:
         logging.error(f"Ошибка при скачивании бэкапа: {e}")
         return None
 
+    # Проверка контрольной суммы до переименования: битый файл не должен выглядеть скачанным
+    if checksum:
+        digest = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for data in iter(lambda: f.read(DEFAULT_DOWNLOAD_BLOCK_SIZE), b''):
+                digest.update(data)
+        if digest.hexdigest() != checksum:
+            logging.error(f"Контрольная сумма скачанного бэкапа {backup_name} не совпадает, файл удален")
+            os.remove(part_path)
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            return None
+    os.replace(part_path, file_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    logging.info(f"Бэкап {backup_name} успешно скачан в {file_path}")
+    return file_path
+
+# Чтение служебного манифеста из архива (None для обычных бэкапов)
+def read_archive_manifest(zipf):
+    try:
+        return json.loads(zipf.read(MANIFEST_ARCNAME).decode('utf-8'))
+    except KeyError:
+        return None
+
+# Сырые (сжатые) данные записи ZIP
+class _RawMemberReader:
+    def __init__(self, fp, info):
+        fp.seek(info.header_offset)
+        header = fp.read(30)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        fp.seek(info.header_offset + 30 + name_length + extra_length)
+        self.fp = fp
+        self.remaining = info.compress_size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+# Открытие записи архива на чтение. zipfile не умеет zstd, такие записи распаковываем сами.
+def open_archive_member(zipf, info):
+    if info.compress_type != ZIP_METHODS['zstd']:
+        return zipf.open(info)
+    if zstandard is None:
+        raise ValueError("Для распаковки записей zstd установите пакет zstandard")
+    return zstandard.ZstdDecompressor().stream_reader(_RawMemberReader(zipf.fp, info), read_across_frames=True)
+
+# Распаковка одной записи архива в target_dir с проверкой CRC
+def extract_archive_member(zipf, info, target_dir):
+    target_root = os.path.abspath(target_dir)
+    target_path = os.path.abspath(os.path.join(target_root, info.filename))
+    if os.path.commonpath([target_root, target_path]) != target_root:
+        raise ValueError(f"Недопустимый путь в архиве: {info.filename}")
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    crc = 0
+    with open_archive_member(zipf, info) as src, open(target_path, 'wb') as dst:
+        while True:
+            data = src.read(DEFAULT_STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            dst.write(data)
+    if crc != info.CRC:
+        raise ValueError(f"Неверная контрольная сумма файла {info.filename}")
+    return target_path
+
+# Файл только для чтения с произвольным доступом. Наследники реализуют _read_at(offset, size),
+# чего достаточно, чтобы zipfile читал центральный каталог и отдельные записи архива.
+class _SeekableReader(io.RawIOBase):
+    size = 0
+
+    def __init__(self):
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Отрицательное смещение")
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.size - self.position)
+        if size <= 0:
+            return 0
+        data = self._read_at(self.position, size)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def _read_at(self, offset, size):
+        raise NotImplementedError
+
+# Бэкап на сервере как файл: чтение диапазонами через Range. Последний прочитанный блок
+# кэшируется, поэтому мелкие чтения zipfile не превращаются в отдельные запросы.
+class RemoteBackupFile(_SeekableReader):
+    def __init__(self, session, server_url, backup_name, retries=DEFAULT_UPLOAD_RETRIES,
+                 read_size=DEFAULT_REMOTE_READ_SIZE):
+        super().__init__()
+        self.session = session
+        self.url = f"{server_url}/download/{backup_name}"
+        self.retries = retries
+        self.read_size = read_size
+        self.requests = 0
+        self.received = 0
+        self.cache_offset, self.cache = 0, b''
+        response = request_with_retries(session, "GET", self.url, retries, headers={"Range": "bytes=0-0"})
+        if response.status_code != 206:
+            raise ValueError(f"Сервер не поддерживает чтение бэкапа {backup_name} диапазонами ({response.status_code})")
+        self.etag = response.headers.get('ETag')
+        self.size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+
+    # Чтение диапазона [start, end] напрямую, без кэша
+    def read_range(self, start, end):
+        headers = {"Range": f"bytes={start}-{end}"}
+        if self.etag:
+            headers["If-Range"] = self.etag
+        response = request_with_retries(self.session, "GET", self.url, self.retries, headers=headers)
+        if response.status_code != 206:
+            raise ValueError(f"Сервер ответил {response.status_code} на запрос диапазона, бэкап изменился")
+        if len(response.content) != end - start + 1:
+            raise ValueError(f"Получено {len(response.content)} из {end - start + 1} байт диапазона {start}-{end}")
+        self.requests += 1
+        self.received += len(response.content)
+        return response.content
+
+    def _read_at(self, offset, size):
+        if not (self.cache_offset <= offset and offset + size <= self.cache_offset + len(self.cache)):
+            end = min(self.size, offset + max(size, self.read_size)) - 1
+            self.cache_offset, self.cache = offset, self.read_range(offset, end)
+        start = offset - self.cache_offset
+        return self.cache[start:start + size]
+
+# Открытый текст потоково зашифрованного бэкапа (формат MBKS) с произвольным доступом:
+# все чанки, кроме последнего, одного размера, поэтому смещение чанка вычисляется,
+# а расшифровывается только тот чанк, в который попало чтение
+class StreamDecryptingReader(_SeekableReader):
+    def __init__(self, remote, key):
+        super().__init__()
+        self.remote = remote
+        self.header = remote.read_range(0, STREAM_HEADER.size - 1)
+        magic, version, self.chunk_size, self.nonce_prefix = STREAM_HEADER.unpack(self.header)
+        if magic != STREAM_MAGIC or version != STREAM_VERSION:
+            raise ValueError("Поврежденный заголовок зашифрованного бэкапа")
+        self.aesgcm = AESGCM(derive_stream_key(key))
+        self.block_size = self.chunk_size + STREAM_TAG_SIZE
+        encrypted_size = remote.size - STREAM_HEADER.size
+        self.chunk_count = max(1, -(-encrypted_size // self.block_size))
+        self.size = encrypted_size - self.chunk_count * STREAM_TAG_SIZE
+        self.cache_index, self.cache = None, b''
+
+    def _chunk(self, index):
+        if index != self.cache_index:
+            start = STREAM_HEADER.size + index * self.block_size
+            end = min(self.remote.size, start + self.block_size) - 1
+            nonce = _stream_nonce(self.nonce_prefix, index, index == self.chunk_count - 1)
+            self.cache_index, self.cache = index, self.aesgcm.decrypt(nonce, self.remote.read_range(start, end), self.header)
+        return self.cache
+
+    def _read_at(self, offset, size):
+        result = bytearray()
+        while len(result) < size:
+            index, start = divmod(offset + len(result), self.chunk_size)
+            data = self._chunk(index)[start:start + size - len(result)]
+            if not data:
+                break
+            result += data
+        return bytes(result)
+
+# Открытый текст бэкапа из чанков дедупликации (формат MBKC): смещения чанков берутся
+# из списка чанков на сервере (размер на сервере и размер открытого текста каждого чанка)
+class ChunkDecryptingReader(_SeekableReader):
+    def __init__(self, remote, key, chunks):
+        super().__init__()
+        self.remote = remote
+        self.aesgcm = AESGCM(derive_key(key, b"mini-backup chunk v1"))
+        self.chunks = []
+        self.plain_offsets = []
+        stored_offset = plain_offset = 0
+        for ref in chunks:
+            self.chunks.append((stored_offset, ref['size']))
+            self.plain_offsets.append(plain_offset)
+            stored_offset += ref['size']
+            plain_offset += ref['plain_size']
+        self.size = plain_offset
+        self.cache_index, self.cache = None, b''
+
+    def _chunk(self, index):
+        if index != self.cache_index:
+            stored_offset, stored_size = self.chunks[index]
+            blob = self.remote.read_range(stored_offset, stored_offset + stored_size - 1)
+            magic, version, nonce, length = CHUNK_HEADER.unpack(blob[:CHUNK_HEADER.size])
+            if magic != CHUNK_MAGIC or version != CHUNK_VERSION or length != len(blob) - CHUNK_HEADER.size:
+                raise ValueError("Поврежденный заголовок чанка")
+            self.cache_index, self.cache = index, self.aesgcm.decrypt(nonce, blob[CHUNK_HEADER.size:], CHUNK_MAGIC)
+        return self.cache
+
+    def _read_at(self, offset, size):
+        result = bytearray()
+        index = max(0, bisect.bisect_right(self.plain_offsets, offset) - 1)
+        while len(result) < size and index < len(self.chunks):
+            start = offset + len(result) - self.plain_offsets[index]
+            data = self._chunk(index)[start:start + size - len(result)]
+            result += data
+            index += 1
+        return bytes(result)
+
+# Открытие бэкапа на сервере для чтения без скачивания: возвращает файлоподобный объект
+# с открытым текстом ZIP или None, если формат не допускает произвольного доступа (Fernet)
+def open_remote_backup(session, server_url, backup_name, key, retries=DEFAULT_UPLOAD_RETRIES):
+    remote = RemoteBackupFile(session, server_url, backup_name, retries)
+    head = remote.read_range(0, min(remote.size, len(STREAM_MAGIC)) - 1)
+    if head == STREAM_MAGIC or head == CHUNK_MAGIC:
+        if not key:
+            raise ValueError(f"Бэкап {backup_name} зашифрован, но шифрование не настроено в конфигурации")
+        if head == STREAM_MAGIC:
+            return StreamDecryptingReader(remote, key)
+        response = request_with_retries(session, "GET", f"{server_url}/chunked-backups/{backup_name}", retries)
+        response.raise_for_status()
+        return ChunkDecryptingReader(remote, key, response.json()['chunks'])
+    if head.startswith(b'gAAAA'):
+        return None
+    return remote
+
+# Проверка, подходит ли путь в архиве под один из запрошенных (точное имя, каталог или шаблон)
+def match_archive_path(arcname, patterns):
+    for pattern in patterns:
+        pattern = pattern.replace('\\', '/').strip('/')
+        if arcname == pattern or arcname.startswith(pattern + '/') or fnmatch.fnmatchcase(arcname, pattern):
+            return True
+    return False
+
+# Быстрое восстановление отдельных файлов: с сервера читаются только центральный каталог ZIP
+# и данные нужных записей (для зашифрованных бэкапов — только содержащие их чанки).
+# В инкрементальной цепочке каждый файл берется из самого нового бэкапа, где он есть.
+def restore_files(config, backup_name, patterns, target_dir):
+    key = None
+    encryption = config.get('encryption', {})
+    key_file = encryption.get('key_file', 'encryption_key.key')
+    if encryption.get('enabled', False) or os.path.exists(key_file):
+        key = load_key(key_file)
+    retries = config.get('download', {}).get('retries', DEFAULT_UPLOAD_RETRIES)
+    session = get_http_session(config['server_url'], config['username'], config['password'])
+    temp_files = []
+
+    # Открытие одного бэкапа цепочки как ZipFile
+    def open_archive(name):
+        fileobj = open_remote_backup(session, config['server_url'], name, key, retries)
+        if fileobj is None:
+            logging.warning(f"Бэкап {name} в старом формате шифрования, он будет скачан целиком")
+            path, files = fetch_backup_archive(config, name, key, "downloads")
+            temp_files.extend(files)
+            return zipfile.ZipFile(path)
+        return zipfile.ZipFile(fileobj)
+
+    try:
+        with open_archive(backup_name) as zipf:
+            manifest = read_archive_manifest(zipf)
+            names = list(manifest['files']) if manifest else [
+                info.filename for info in zipf.infolist() if not info.is_dir()
+            ]
+        pending = {name for name in names if name != MANIFEST_ARCNAME and match_archive_path(name, patterns)}
+        if not pending:
+            raise ValueError(f"В бэкапе {backup_name} нет файлов, подходящих под {', '.join(patterns)}")
+        logging.info(f"Будет восстановлено файлов: {len(pending)}")
+
+        chain = manifest['chain'] if manifest else []
+        restored_bytes = 0
+        for name in reversed(chain + [backup_name]):
+            with open_archive(name) as zipf:
+                for info in zipf.infolist():
+                    if info.filename in pending:
+                        extract_archive_member(zipf, info, target_dir)
+                        pending.discard(info.filename)
+                        restored_bytes += info.file_size
+                remote = getattr(zipf.fp, 'remote', zipf.fp)
+                if isinstance(remote, RemoteBackupFile):
+                    logging.info(
+                        f"Из бэкапа {name} прочитано {remote.received} из {remote.size} байт за {remote.requests} запросов"
+                    )
+            if not pending:
+                break
+        if pending:
+            raise ValueError(f"Файлы не найдены в цепочке бэкапов: {', '.join(sorted(pending))}")
+    finally:
+        for temp_file in temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    logging.info(f"Восстановлено {restored_bytes} байт из бэкапа {backup_name} в {target_dir}")
+
+# Скачивание бэкапа и расшифровка (если нужно). Возвращает путь к ZIP и список временных файлов.
+def fetch_backup_archive(config, backup_name, key, download_dir):
+    file_path = download_backup(
+        config['server_url'], config['username'], config['password'], backup_name, download_dir, config.get('download')
+    )
+    if not file_path:
+        raise ValueError(f"Не удалось скачать бэкап {backup_name}")
+    if not is_encrypted_backup(file_path):
+        return file_path, [file_path]
+    if not key:
+        raise ValueError(f"Бэкап {backup_name} зашифрован, но шифрование не настроено в конфигурации")
+    plain_path = decrypt_file(file_path, key, file_path + '.plain.zip')
+    return plain_path, [file_path, plain_path]
+
+# Восстановление бэкапа на момент времени: полный бэкап цепочки, затем инкрементальные по порядку.
+# Файлы, удаленные к моменту выбранного бэкапа, удаляются из target_dir.
+def restore_backup(config, backup_name, target_dir, download_dir="downloads"):
+    key = None
+    encryption = config.get('encryption', {})
+    key_file = encryption.get('key_file', 'encryption_key.key')
+    if encryption.get('enabled', False) or os.path.exists(key_file):
+        key = load_key(key_file)
+
+    archive_path, temp_files = fetch_backup_archive(config, backup_name, key, download_dir)
+    try:
+        with zipfile.ZipFile(archive_path) as zipf:
+            manifest = read_archive_manifest(zipf)
+        chain = manifest['chain'] if manifest else []
+        restored = set()
+        for name in chain + [backup_name]:
+            if name == backup_name:
+                path = archive_path
+            else:
+                path, chain_temp_files = fetch_backup_archive(config, name, key, download_dir)
+                temp_files.extend(chain_temp_files)
+            with zipfile.ZipFile(path) as zipf:
+                for info in zipf.infolist():
+                    if info.filename == MANIFEST_ARCNAME or info.is_dir():
+                        continue
+                    extract_archive_member(zipf, info, target_dir)
+                    restored.add(info.filename)
+            logging.info(f"Применен бэкап {name}")
+            if name != backup_name:
+                for temp_file in chain_temp_files:
+                    os.remove(temp_file)
+                    temp_files.remove(temp_file)
+
+        if manifest:
+            for stale in restored - set(manifest['files']):
+                os.remove(os.path.join(target_dir, stale))
+                logging.info(f"Удален файл, отсутствующий на момент бэкапа: {stale}")
+    finally:
+        for temp_file in temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    logging.info(f"Бэкап {backup_name} восстановлен в {target_dir}")
+
+# Проверка бэкапа без скачивания: сервер перечитывает свою копию и считает SHA-256,
+# результат сверяется с суммой, записанной этим клиентом при загрузке (если бэкап загружал он)
+def verify_backup(config, backup_name):
+    session = get_http_session(config['server_url'], config['username'], config['password'], 1)
+    response = request_with_retries(session, "POST", f"{config['server_url']}/verify/{backup_name}")
+    if response.status_code != 200:
+        logging.error(f"Не удалось проверить бэкап {backup_name}: сервер ответил {response.status_code}")
+        return False
+    result = response.json()
+    expected = load_checksums(config).get(backup_name)
+    if result['integrity'] != 'ok':
+        logging.error(f"Бэкап {backup_name} на сервере поврежден ({result['integrity']})")
+        return False
+    if expected and expected != result['actual_sha256']:
+        logging.error(
+            f"Бэкап {backup_name} на сервере не совпадает с загруженным: "
+            f"sha256 {result['actual_sha256']}, ожидался {expected}"
+        )
+        return False
+    source = "совпадает с записанной при загрузке" if expected else "совпадает с суммой на сервере"
+    logging.info(f"Бэкап {backup_name} цел: sha256 {result['actual_sha256']} {source}")
+    return True
+
+# Выбор бэкапа из списка на сервере (None, если выбор не сделан)
+def choose_server_backup(config, prompt):
+    backups = list_backups(config['server_url'], config['username'], config['password'])
+    if not backups:
+        print("На сервере нет доступных бэкапов.")
+        return None
+    print("\nДоступные бэкапы на сервере:")
+    for i, backup in enumerate(backups, 1):
+        print(f"{i}. {backup}")
+    backup_choice = input(prompt)
+    try:
+        backup_choice = int(backup_choice) - 1
+        if 0 <= backup_choice < len(backups):
+            return backups[backup_choice]
+        print("Неверный выбор.")
+    except ValueError:
+        print("Введите корректный номер.")
+    return None
+
 # Минимальный shell-интерфейс
 def shell_interface(config):
     while True:
@@ -275,9 +2547,13 @@ def shell_interface(config):
         print("2. Расшифровать бэкап")
         print("3. Сгенерировать SSL-сертификаты")
         print("4. Скачать бэкап с сервера")
-        print("5. Выйти")
+        print("5. Восстановить бэкап с сервера")
+        print("6. Восстановить отдельные файлы из бэкапа на сервере")
+        print("7. Проверить целостность бэкапа на сервере")
+        print("8. Выйти")
         choice = input("Выберите действие: ")
 
+        has_server = 'server_url' in config and 'username' in config and 'password' in config
         if choice == "1":
             perform_backup(config)
         elif choice == "2":
@@ -291,28 +2567,47 @@ def shell_interface(config):
             generate_ssl_certificates(cert_file, key_file)
             print(f"Сертификат и ключ созданы: {cert_file}, {key_file}")
         elif choice == "4":
-            if 'server_url' in config and 'username' in config and 'password' in config:
+            if has_server:
                 # Получаем список бэкапов с сервера
-                backups = list_backups(config['server_url'], config['username'], config['password'])
-                if backups:
-                    print("\nДоступные бэкапы на сервере:")
-                    for i, backup in enumerate(backups, 1):
-                        print(f"{i}. {backup}")
-                    backup_choice = input("Введите номер бэкапа для скачивания: ")
-                    try:
-                        backup_choice = int(backup_choice) - 1
-                        if 0 <= backup_choice < len(backups):
-                            backup_name = backups[backup_choice]
-                            download_backup(config['server_url'], config['username'], config['password'], backup_name)
-                        else:
-                            print("Неверный выбор.")
-                    except ValueError:
-                        print("Введите корректный номер.")
-                else:
-                    print("На сервере нет доступных бэкапов.")
+                backup_name = choose_server_backup(config, "Введите номер бэкапа для скачивания: ")
+                if backup_name:
+                    download_backup(
+                        config['server_url'], config['username'], config['password'], backup_name,
+                        download=config.get('download')
+                    )
             else:
                 print("Не указаны данные для подключения к серверу в конфигурации.")
         elif choice == "5":
+            if has_server:
+                backup_name = choose_server_backup(config, "Введите номер бэкапа для восстановления: ")
+                if backup_name:
+                    target_dir = input("Введите каталог для восстановления: ")
+                    try:
+                        restore_backup(config, backup_name, target_dir)
+                    except Exception as e:
+                        logging.error(f"Ошибка при восстановлении бэкапа: {e}")
+            else:
+                print("Не указаны данные для подключения к серверу в конфигурации.")
+        elif choice == "6":
+            if has_server:
+                backup_name = choose_server_backup(config, "Введите номер бэкапа для восстановления: ")
+                if backup_name:
+                    patterns = input("Введите пути файлов или шаблоны через запятую: ").split(',')
+                    target_dir = input("Введите каталог для восстановления: ")
+                    try:
+                        restore_files(config, backup_name, [p.strip() for p in patterns if p.strip()], target_dir)
+                    except Exception as e:
+                        logging.error(f"Ошибка при восстановлении файлов: {e}")
+            else:
+                print("Не указаны данные для подключения к серверу в конфигурации.")
+        elif choice == "7":
+            if has_server:
+                backup_name = choose_server_backup(config, "Введите номер бэкапа для проверки: ")
+                if backup_name:
+                    verify_backup(config, backup_name)
+            else:
+                print("Не указаны данные для подключения к серверу в конфигурации.")
+        elif choice == "8":
             break
         else:
             print("Неверный выбор. Попробуйте снова.")
@@ -322,16 +2617,28 @@ def main():
     setup_logging()
     parser = argparse.ArgumentParser(description="Утилита для бэкапов.")
     parser.add_argument('--gui', action='store_true', help="Запустить в режиме shell-интерфейса.")
+    parser.add_argument('--restore', metavar='BACKUP_NAME', help="Восстановить бэкап с сервера.")
+    parser.add_argument('--path', action='append',
+                        help="Восстановить только этот файл, каталог или шаблон (можно указать несколько).")
+    parser.add_argument('--target', default='restored', help="Каталог для восстановления.")
+    parser.add_argument('--verify', metavar='BACKUP_NAME', help="Проверить целостность бэкапа на сервере без скачивания.")
     parser.add_argument('config_file', help="Путь к конфигурационному файлу.")
     args = parser.parse_args()
 
     config = load_config(args.config_file)
 
-    if args.gui:
+    if args.verify:
+        sys.exit(0 if verify_backup(config, args.verify) else 1)
+    elif args.restore:
+        if args.path:
+            restore_files(config, args.restore, args.path, args.target)
+        else:
+            restore_backup(config, args.restore, args.target)
+    elif args.gui:
         shell_interface(config)
     else:
-        if 'schedule' in config:
-            start_scheduler(config)  # Исправлено
+        if 'schedule' in config or 'jobs' in config:
+            start_scheduler(config)
         else:
             perform_backup(config)
 
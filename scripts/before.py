@@ -3,47 +3,78 @@ import os
 import time
 import argparse
 
+def _name_matches(proc_name, executable_name):
+    """
+    Сравнивает имя процесса с именем исполняемого файла.
+    В Linux имя процесса обрезается до 15 символов, поэтому допускается совпадение по префиксу.
+    """
+    proc_name = os.path.normcase(proc_name)
+    if proc_name == executable_name:
+        return True
+    return len(proc_name) == 15 and executable_name.startswith(proc_name)
+
 def find_process_by_executable_path(executable_path):
     """
     Находит все процессы, запущенные из указанного исполняемого файла.
+    Сначала процессы отбираются по имени (дешево), и только для подходящих
+    запрашивается полный путь к исполняемому файлу.
     """
+    executable_path = os.path.normcase(os.path.abspath(executable_path))
+    executable_name = os.path.basename(executable_path)
     matching_processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'exe']):
+    for proc in psutil.process_iter(['name']):
         try:
-            # Получаем путь к исполняемому файлу
-            proc_exe = proc.info['exe']
-            # Проверяем, что путь не None и совпадает с искомым
-            if proc_exe and os.path.normcase(proc_exe) == os.path.normcase(executable_path):
+            proc_name = proc.info['name']
+            if not proc_name or not _name_matches(proc_name, executable_name):
+                continue
+            # Получаем путь к исполняемому файлу только для процессов с подходящим именем
+            proc_exe = proc.exe()
+            if proc_exe and os.path.normcase(proc_exe) == executable_path:
                 matching_processes.append(proc)
         except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
             continue
     return matching_processes
 
-def soft_kill_process(pid):
+def terminate_processes(processes, timeout, kill_timeout, allow_kill=True):
     """
-    Мягко завершает процесс по PID.
-    Возвращает 0, если процесс завершился успешно, и 1, если не удалось завершить.
+    Мягко завершает все процессы одновременно и ждет их не дольше timeout секунд.
+    Процессы, не завершившиеся за это время, принудительно завершаются (если allow_kill).
+    Возвращает 0, если завершились все процессы, и 1, если нет.
     """
-    try:
-        process = psutil.Process(pid)
-        process.terminate()  # Мягкое завершение
-        print(f"Процесс с PID {pid} отправлен на завершение.")
-        time.sleep(2)  # Даем процессу время на завершение
+    for proc in processes:
+        try:
+            proc.terminate()  # Мягкое завершение
+            print(f"Процесс с PID {proc.pid} отправлен на завершение.")
+        except psutil.NoSuchProcess:
+            print(f"Процесс с PID {proc.pid} уже завершен.")
+        except psutil.AccessDenied:
+            print(f"Нет прав для завершения процесса с PID {proc.pid}.")
+
+    started = time.monotonic()
+    gone, alive = psutil.wait_procs(processes, timeout=timeout)
+    print(f"Ожидание мягкого завершения: {time.monotonic() - started:.2f} с, "
+          f"завершено {len(gone)} из {len(processes)}.")
+
+    if alive and allow_kill:
+        for proc in alive:
+            try:
+                proc.kill()  # Принудительное завершение
+                print(f"Процесс с PID {proc.pid} не завершился за {timeout} с, завершаем принудительно.")
+            except psutil.NoSuchProcess:
+                pass
+            except psutil.AccessDenied:
+                print(f"Нет прав для принудительного завершения процесса с PID {proc.pid}.")
+        killed_started = time.monotonic()
+        gone_after_kill, alive = psutil.wait_procs(alive, timeout=kill_timeout)
+        print(f"Ожидание принудительного завершения: {time.monotonic() - killed_started:.2f} с, "
+              f"завершено {len(gone_after_kill)}.")
 
-        if process.is_running():
-            print(f"Процесс с PID {pid} не завершился.")
-            return 1  # Код ошибки, если процесс не завершился
-        else:
-            print(f"Процесс с PID {pid} успешно завершен.")
-            return 0  # Успешное завершение
-    except psutil.NoSuchProcess:
-        print(f"Процесс с PID {pid} уже завершен.")
-        return 0  # Успешное завершение (процесс уже завершен)
-    except psutil.AccessDenied:
-        print(f"Нет прав для завершения процесса с PID {pid}.")
-        return 1  # Код ошибки, если нет прав
+    for proc in alive:
+        print(f"Процесс с PID {proc.pid} не завершился.")
+    print(f"Всего ожидание завершения: {time.monotonic() - started:.2f} с.")
+    return 1 if alive else 0
 
-def main(executable_path):
+def main(executable_path, timeout, kill_timeout, allow_kill):
     """
     Основная функция скрипта.
     """
@@ -53,16 +84,11 @@ def main(executable_path):
         print(f"Процессы, запущенные из '{executable_path}', не найдены.")
         return 1  # Код ошибки, если процессы не найдены
 
-    # Мягкое завершение всех найденных процессов
-    overall_result = 0
     for proc in processes:
-        pid = proc.info['pid']
-        print(f"Найден процесс с PID {pid}, запущенный из '{executable_path}'")
-        result = soft_kill_process(pid)
-        if result != 0:
-            overall_result = 1  # Если хотя бы один процесс не завершился, возвращаем ошибку
+        print(f"Найден процесс с PID {proc.pid}, запущенный из '{executable_path}'")
 
-    return overall_result
+    # Завершение всех найденных процессов одновременно
+    return terminate_processes(processes, timeout, kill_timeout, allow_kill)
 
 if __name__ == "__main__":
     # Настройка парсера аргументов
@@ -72,7 +98,24 @@ if __name__ == "__main__":
         type=str,
         help="Полный путь к исполняемому файлу, процессы которого нужно завершить."
     )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30,
+        help="Сколько секунд ждать мягкого завершения (ожидание заканчивается, как только завершатся все процессы)."
+    )
+    parser.add_argument(
+        "--kill-timeout",
+        type=float,
+        default=5,
+        help="Сколько секунд ждать после принудительного завершения."
+    )
+    parser.add_argument(
+        "--no-kill",
+        action="store_true",
+        help="Не завершать процессы принудительно, если они не завершились за --timeout."
+    )
     args = parser.parse_args()
 
-    # Запуск основной функции с переданным путём
-    exit(main(args.executable_path))
\ No newline at end of file
+    # Запуск основной функции с переданными параметрами
+    exit(main(args.executable_path, args.timeout, args.kill_timeout, not args.no_kill))
@@ -1,13 +1,37 @@
+from collections import defaultdict
+from contextlib import asynccontextmanager, closing, contextmanager
 from datetime import datetime
+from urllib.parse import quote
+import asyncio
 import os
 import shutil
 import logging
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, status, Form
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBasic, HTTPBasicCredentials, HTTPBearer
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+import hashlib
+import re
 import secrets
 import json
-from typing import Optional
+import random
+import sqlite3
+import struct
+import threading
+import time
+from typing import List, Optional
+from credentials import TokenSigner, VerificationCache, is_hashed
+from storage import FileWriter, open_storage
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+try:
+    import fcntl  # Межпроцессные блокировки (flock), только Unix
+except ImportError:
+    fcntl = None
 
 # Настройка логирования
 logging.basicConfig(
@@ -19,7 +43,37 @@ logging.basicConfig(
     ]
 )
 
-app = FastAPI()
+# Подготовка при запуске сервера: бэкапы в старой раскладке переносятся в хранилище, каталог
+# сверяется с хранилищем, запускаются фоновые задачи (очистка по политикам хранения и проверка целостности).
+# Воркеры uvicorn запускаются одновременно, поэтому подготовка идет под блокировкой, по очереди.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(prepare_storage)
+    tasks = [asyncio.create_task(metrics_flush_loop())]
+    loops = []
+    if RETENTION.get("enabled"):
+        loops.append(retention_loop)
+    if SCRUB.get("enabled"):
+        loops.append(scrub_loop)
+    if loops:
+        tasks.append(asyncio.create_task(run_background_tasks(loops)))
+    yield
+    for task in tasks:
+        task.cancel()
+    await run_in_threadpool(remove_metrics_snapshot)
+
+app = FastAPI(lifespan=lifespan)
+
+# Учет каждого запроса в метриках: количество и время до отправки заголовков ответа
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.monotonic()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    labels = {"route": route.path if route else "unmatched", "method": request.method}
+    metrics.observe("mini_backup_http_request_duration_seconds", time.monotonic() - started, **labels)
+    metrics.inc("mini_backup_http_requests_total", status=str(response.status_code), **labels)
+    return response
 
 # Загрузка конфигурации из файла
 def load_config(config_file: str) -> dict:
@@ -39,27 +93,472 @@ CONFIG = load_config("server-config.json")
 SERVER_BACKUP_DIR = CONFIG.get("server_backup_dir", "server_backups")
 os.makedirs(SERVER_BACKUP_DIR, exist_ok=True)
 
-# База данных пользователей
+# Хранилище данных бэкапов и чанков (storage.py): локальные диски или S3-совместимое хранилище.
+# Метаданные (каталог, манифесты, контрольные суммы, сессии загрузки) остаются в SERVER_BACKUP_DIR.
+STORAGE = open_storage(CONFIG.get("storage", {}), SERVER_BACKUP_DIR)
+LEGACY_CHUNK_STORE_DIR = os.path.join(SERVER_BACKUP_DIR, ".chunks")  # Раскладка до появления хранилищ
+
+# Манифесты бэкапов, собранных из чанков. Скрытые каталоги внутри SERVER_BACKUP_DIR не попадают в /list.
+MANIFEST_DIR = os.path.join(SERVER_BACKUP_DIR, ".manifests")
+os.makedirs(MANIFEST_DIR, exist_ok=True)
+
+# Чанк без ссылок удаляется сборщиком мусора не раньше, чем через это время после последнего
+# обращения: клиент мог только что узнать, что чанк есть, и еще не записал манифест
+CHUNK_GC_GRACE = CONFIG.get("chunk_gc_grace", 24 * 60 * 60)
+MAX_CHUNK_SIZE = CONFIG.get("max_chunk_size", 16 * 1024 * 1024)
+CHUNK_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# Сессии загрузки по частям: части хранятся во временном каталоге сессии до завершения,
+# затем склеиваются и записываются в хранилище одним объектом
+UPLOAD_SESSIONS_DIR = os.path.join(SERVER_BACKUP_DIR, ".uploads")
+os.makedirs(UPLOAD_SESSIONS_DIR, exist_ok=True)
+UPLOAD_SESSION_TTL = CONFIG.get("upload_session_ttl", 7 * 24 * 60 * 60)  # Незавершенные сессии старше удаляются
+MAX_PART_SIZE = CONFIG.get("max_part_size", 64 * 1024 * 1024)
+MAX_PARTS = 100000
+UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# Ограничение приема загрузок: одновременные загрузки (всего и на пользователя), очередь ожидания
+# и необязательное ограничение скорости записи (байт/с, 0 — без ограничения). Ограничения общие
+# для всех воркеров: места и запас скорости хранятся в файлах в LOCK_DIR.
+UPLOAD_LIMITS = CONFIG.get("upload_limits", {})
+
+# Политики хранения (дед-отец-сын): сколько последних, дневных, недельных и месячных бэкапов
+# оставлять и сколько места они могут занимать. "default" — для всех, "users" — для отдельных пользователей.
+# "admins" — кто через API может смотреть и запускать очистку для всех пользователей, а не только для себя.
+RETENTION = CONFIG.get("retention", {})
+RETENTION_INTERVAL = RETENTION.get("interval", 60 * 60)
+RETENTION_BATCH_SIZE = RETENTION.get("batch_size", 100)
+RETENTION_PERIODS = ("daily", "weekly", "monthly")
+
+# Контрольные суммы SHA-256 бэкапов хранятся рядом с ними в файлах формата sha256sum,
+# чтобы пережить потерю каталога. Фоновая проверка (scrub) перечитывает каждый бэкап раз
+# в interval секунд со скоростью не больше rate байт/с, чтобы не мешать загрузкам.
+CHECKSUM_DIR = os.path.join(SERVER_BACKUP_DIR, ".checksums")
+os.makedirs(CHECKSUM_DIR, exist_ok=True)
+SCRUB = CONFIG.get("scrub", {})
+SCRUB_INTERVAL = SCRUB.get("interval", 7 * 24 * 60 * 60)
+SCRUB_RATE = SCRUB.get("rate", 32 * 1024 * 1024)
+SCRUB_IDLE = SCRUB.get("idle", 10 * 60)  # Пауза, когда проверять нечего
+
+# Каталог бэкапов (SQLite); при повреждении или удалении восстанавливается с диска при запуске
+CATALOG_DB = CONFIG.get("catalog_db", os.path.join(SERVER_BACKUP_DIR, ".catalog.sqlite3"))
+LIST_DEFAULT_LIMIT = 100
+LIST_MAX_LIMIT = 1000
+
+# Несколько воркеров (uvicorn --workers, WEB_CONCURRENCY) делят каталог, сессии загрузки и хранилище.
+# Блокировки между ними — flock на файлах в LOCK_DIR. Каждый воркер сбрасывает свои метрики в METRICS_DIR,
+# а /metrics их складывает.
+LOCK_DIR = os.path.join(SERVER_BACKUP_DIR, ".locks")
+os.makedirs(LOCK_DIR, exist_ok=True)
+METRICS_DIR = os.path.join(SERVER_BACKUP_DIR, ".metrics")
+os.makedirs(METRICS_DIR, exist_ok=True)
+METRICS_FLUSH_INTERVAL = 5
+ADMISSION_POLL_INTERVAL = 0.2  # Как часто ожидающая загрузка проверяет, не освободилось ли место
+BACKGROUND_RETRY_INTERVAL = 30  # Как часто воркер без фоновых задач проверяет, жив ли тот, кто их выполняет
+
+# Отдача файлов бэкапов через nginx (X-Accel-Redirect): FastAPI проверяет права и отдает только заголовки,
+# а файл с диска отправляет nginx (sendfile). root — каталог, который nginx отдает из внутренней location
+# (alias). Бэкапы вне root, бэкапы из чанков и бэкапы в S3 по-прежнему отдает FastAPI.
+ACCEL_REDIRECT = CONFIG.get("accel_redirect", {})
+
+# Без fcntl (Windows) блокировки действуют только внутри процесса — запускайте один воркер
+_process_locks = defaultdict(threading.Lock)
+
+# Блокировка, общая для всех воркеров (ожидает, пока ее отпустят)
+@contextmanager
+def file_lock(name: str):
+    if fcntl is None:
+        with _process_locks[name]:
+            yield
+        return
+    with open(os.path.join(LOCK_DIR, f"{name}.lock"), "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+# Блокировка процесса без fcntl, отпускается закрытием, как файл с flock
+class _ProcessLockHandle:
+    def __init__(self, lock: threading.Lock):
+        self.lock = lock
+
+    def close(self):
+        if self.lock is not None:
+            self.lock.release()
+            self.lock = None
+
+# Попытка взять блокировку без ожидания: открытый файл (блокировка держится, пока он открыт) или None
+def try_file_lock(name: str):
+    if fcntl is None:
+        lock = _process_locks[name]
+        return _ProcessLockHandle(lock) if lock.acquire(blocking=False) else None
+    f = open(os.path.join(LOCK_DIR, f"{name}.lock"), "a")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+# Одно из count мест, общих для всех воркеров (блокировки <name>-0 ... <name>-<count-1>), или None.
+# Место держится, пока открыт возвращенный файл, и освобождается само при падении воркера.
+def try_shared_slot(name: str, count: int):
+    for number in range(count):
+        handle = try_file_lock(f"{name}-{number}")
+        if handle is not None:
+            return handle
+    return None
+
+# Метрики в текстовом формате Prometheus (без внешних зависимостей). Значения хранятся
+# в памяти процесса и сбрасываются при перезапуске, как у обычных счетчиков Prometheus.
+# При нескольких воркерах значения складываются из снимков всех воркеров (snapshot),
+# кроме метрик с aggregate=False: они считаются из каталога или хранилища и одинаковы у всех.
+class Metrics:
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    throughput_buckets = tuple(2 ** power * 1024 * 1024 for power in range(0, 11))  # 1 МиБ/с .. 1 ГиБ/с
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.definitions = {}
+        self.values = {}
+        self.not_aggregated = set()
+
+    def register(self, name: str, kind: str, help_text: str, buckets: Optional[tuple] = None, aggregate: bool = True):
+        self.definitions[name] = (kind, help_text, buckets)
+        self.values[name] = {}
+        if not aggregate:
+            self.not_aggregated.add(name)
+
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    # Увеличение счетчика или изменение gauge на value
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._labels(labels)
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.values[name][self._labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self.definitions[name][2]
+        key = self._labels(labels)
+        with self.lock:
+            histogram = self.values[name].setdefault(key, [0] * len(buckets) + [0, 0])
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @staticmethod
+    def _format(name: str, labels: tuple, value, extra: tuple = ()) -> str:
+        pairs = []
+        for key, label in labels + extra:
+            label = str(label).replace("\\", "\\\\").replace('"', '\\"')
+            pairs.append(f'{key}="{label}"')
+        return f"{name}{{{','.join(pairs)}}} {value}" if pairs else f"{name} {value}"
+
+    # Значения в виде, пригодном для JSON
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {name: [[list(labels), value] for labels, value in values.items()] for name, values in self.values.items()}
+
+    # Сумма собственных значений и снимков других воркеров
+    def _merged(self, snapshots: list) -> dict:
+        with self.lock:
+            merged = {name: {labels: list(value) if isinstance(value, list) else value for labels, value in values.items()}
+                      for name, values in self.values.items()}
+        for snapshot in snapshots:
+            for name, items in snapshot.items():
+                if name not in merged or name in self.not_aggregated:
+                    continue
+                for labels, value in items:
+                    key = tuple(tuple(pair) for pair in labels)
+                    current = merged[name].get(key)
+                    if isinstance(value, list):
+                        merged[name][key] = [a + b for a, b in zip(current, value)] if current else value
+                    else:
+                        merged[name][key] = (current or 0) + value
+        return merged
+
+    def render(self, snapshots: tuple = ()) -> str:
+        lines = []
+        values = self._merged(snapshots)
+        for name, (kind, help_text, buckets) in self.definitions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(values[name].items()):
+                if kind != "histogram":
+                    lines.append(self._format(name, labels, value))
+                    continue
+                for bound, count in zip(buckets, value):
+                    lines.append(self._format(f"{name}_bucket", labels, count, (("le", bound),)))
+                lines.append(self._format(f"{name}_bucket", labels, value[-1], (("le", "+Inf"),)))
+                lines.append(self._format(f"{name}_sum", labels, value[-2]))
+                lines.append(self._format(f"{name}_count", labels, value[-1]))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.register("mini_backup_http_requests_total", "counter", "HTTP requests by route, method and status.")
+metrics.register(
+    "mini_backup_http_request_duration_seconds", "histogram",
+    "Time until response headers are sent, by route and method.", Metrics.latency_buckets
+)
+metrics.register("mini_backup_received_bytes_total", "counter", "Bytes of uploaded data written to storage.")
+metrics.register("mini_backup_sent_bytes_total", "counter", "Bytes of backup data sent to clients.")
+metrics.register("mini_backup_active_transfers", "gauge", "Uploads and downloads in progress.")
+metrics.register(
+    "mini_backup_transfer_throughput_bytes_per_second", "histogram",
+    "Throughput of finished transfers of at least 1 MiB.", Metrics.throughput_buckets
+)
+metrics.register("mini_backup_backups", "gauge", "Backups in the catalog by layout.", aggregate=False)
+metrics.register("mini_backup_backup_bytes", "gauge", "Size of backups in the catalog by layout.", aggregate=False)
+metrics.register("mini_backup_chunk_store_bytes", "gauge", "Bytes used by the deduplicated chunk store.", aggregate=False)
+metrics.register("mini_backup_chunk_store_chunks", "gauge", "Chunks in the deduplicated chunk store.", aggregate=False)
+metrics.register("mini_backup_disk_free_bytes", "gauge", "Free space on the backup volume.", aggregate=False)
+metrics.register("mini_backup_upload_slots_in_use", "gauge", "Uploads currently admitted.")
+metrics.register("mini_backup_upload_queue_length", "gauge", "Uploads waiting for a free slot.")
+metrics.register("mini_backup_upload_rejected_total", "counter", "Uploads rejected by admission control, by reason.")
+metrics.register("mini_backup_scrub_bytes_total", "counter", "Bytes of stored backups re-read for verification.")
+metrics.register("mini_backup_corrupt_backups", "gauge", "Backups whose last verification failed, by state.", aggregate=False)
+metrics.register("mini_backup_retention_deleted_total", "counter", "Backups deleted by the retention policy.")
+metrics.register("mini_backup_retention_freed_bytes_total", "counter", "Bytes of backups deleted by the retention policy.")
+metrics.register("mini_backup_offloaded_downloads_total", "counter", "Downloads handed to nginx via X-Accel-Redirect.")
+
+# Учет одной передачи (загрузки или скачивания) в метриках
+class TransferMeter:
+    def __init__(self, direction: str):
+        self.direction = direction
+        self.started = time.monotonic()
+        self.size = 0
+        self.finished = False
+        metrics.inc("mini_backup_active_transfers", 1, direction=direction)
+
+    def add(self, size: int):
+        self.size += size
+        counter = "mini_backup_received_bytes_total" if self.direction == "upload" else "mini_backup_sent_bytes_total"
+        metrics.inc(counter, size)
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        metrics.inc("mini_backup_active_transfers", -1, direction=self.direction)
+        elapsed = time.monotonic() - self.started
+        if self.size >= 1024 * 1024 and elapsed > 0:
+            metrics.observe("mini_backup_transfer_throughput_bytes_per_second", self.size / elapsed,
+                            direction=self.direction)
+
+# Ограничение скорости по алгоритму token bucket, общее для всех воркеров: запас и время его обновления
+# хранятся в файле <name>.bucket в LOCK_DIR и меняются под блокировкой. Порция больше запаса
+# не отклоняется, а уводит запас в минус: вызов ждет, пока долг не восстановится со скоростью rate.
+# Блокировка и файловый ввод-вывод выполняются в пуле потоков, чтобы не останавливать цикл событий.
+class TokenBucket:
+    STATE = struct.Struct("<dd")  # запас, время обновления (time.time)
+
+    def __init__(self, name: str, rate: float, burst: Optional[float] = None):
+        self.name = name
+        self.rate = rate
+        self.capacity = burst or rate
+        self.path = os.path.join(LOCK_DIR, f"{name}.bucket")
+
+    # Списание порции; возвращает, сколько секунд ждать до погашения долга
+    def _take(self, amount: int) -> float:
+        with file_lock(self.name):
+            now = time.time()
+            try:
+                with open(self.path, "rb") as f:
+                    tokens, updated = self.STATE.unpack(f.read())
+            except (FileNotFoundError, struct.error):
+                tokens, updated = self.capacity, now
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate) - amount
+            with open(self.path, "wb") as f:
+                f.write(self.STATE.pack(tokens, now))
+        return -tokens / self.rate if tokens < 0 else 0
+
+    async def consume(self, amount: int):
+        delay = await run_in_threadpool(self._take, amount)
+        if delay:
+            await asyncio.sleep(delay)
+
+# Допуск загрузок, общий для всех воркеров. Место загрузки — одна из max_concurrent блокировок
+# upload-slot, место пользователя — одна из max_per_user блокировок upload-user-<хеш имени>,
+# место в очереди — одна из max_queue блокировок upload-queue (см. try_shared_slot). Когда мест нет,
+# запрос занимает место в очереди и проверяет освободившиеся места каждые ADMISSION_POLL_INTERVAL
+# секунд, но не дольше queue_timeout; если очередь переполнена или время вышло, клиент получает
+# 503 (сервер занят) или 429 (занято место пользователя) с Retry-After. Retry-After случайно
+# растягивается до двух раз, чтобы отклоненные клиенты не вернулись одновременно. Пока тело запроса
+# не читается, клиент стоит на TCP-окне и не расходует диск, поэтому общая скорость записи
+# остается на уровне диска.
+class UploadAdmission:
+    def __init__(self, limits: dict):
+        self.max_concurrent = limits.get("max_concurrent", 0)  # 0 — без ограничения
+        self.max_per_user = limits.get("max_per_user", 0)
+        self.max_queue = limits.get("max_queue", 64)
+        self.queue_timeout = limits.get("queue_timeout", 30)
+        self.retry_after = limits.get("retry_after", 30)
+        self.user_bandwidth = limits.get("user_bandwidth", 0)
+        self.burst = limits.get("burst")
+        self.bandwidth = TokenBucket("bandwidth", limits["bandwidth"], self.burst) if limits.get("bandwidth") else None
+        self.user_buckets = {}
+        self.active = 0  # Загрузки этого воркера (для метрик, складываются по воркерам)
+        self.waiting = 0
+
+    @staticmethod
+    def _user_id(username: str) -> str:
+        return hashlib.sha256(username.encode()).hexdigest()[:16]
+
+    # Попытка занять место загрузки и место пользователя: (открытые блокировки, None) или (None, причина отказа)
+    def _try_acquire(self, username: str):
+        held = []
+        for name, count, reason in (
+            ("upload-slot", self.max_concurrent, "server_busy"),
+            (f"upload-user-{self._user_id(username)}", self.max_per_user, "user_busy"),
+        ):
+            if not count:
+                continue
+            handle = try_shared_slot(name, count)
+            if handle is None:
+                for acquired in held:
+                    acquired.close()
+                return None, reason
+            held.append(handle)
+        return held, None
+
+    def _reject(self, reason: str, status_code: int):
+        metrics.inc("mini_backup_upload_rejected_total", reason=reason)
+        retry_after = int(self.retry_after * random.uniform(1, 2))
+        logging.warning(f"Загрузка отклонена ({reason}), повтор через {retry_after} с")
+        raise HTTPException(
+            status_code=status_code,
+            detail="Too many concurrent uploads, retry later",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    def _buckets(self, username: str) -> list:
+        buckets = [self.bandwidth] if self.bandwidth else []
+        if self.user_bandwidth:
+            if username not in self.user_buckets:
+                self.user_buckets[username] = TokenBucket(
+                    f"bandwidth-user-{self._user_id(username)}", self.user_bandwidth, self.burst
+                )
+            buckets.append(self.user_buckets[username])
+        return buckets
+
+    # Место для одной загрузки; внутри блока доступны ограничители скорости для AsyncFileSink
+    @asynccontextmanager
+    async def slot(self, username: str):
+        held, reason = self._try_acquire(username)
+        if held is None:
+            ticket = try_shared_slot("upload-queue", self.max_queue)
+            if ticket is None:
+                self._reject("queue_full", status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.waiting += 1
+            metrics.set("mini_backup_upload_queue_length", self.waiting)
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                while held is None and time.monotonic() < deadline:
+                    await asyncio.sleep(min(ADMISSION_POLL_INTERVAL, max(0.0, deadline - time.monotonic())))
+                    held, reason = self._try_acquire(username)
+            finally:
+                ticket.close()
+                self.waiting -= 1
+                metrics.set("mini_backup_upload_queue_length", self.waiting)
+            if held is None:
+                if reason == "server_busy":
+                    self._reject(reason, status.HTTP_503_SERVICE_UNAVAILABLE)
+                self._reject(reason, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.active += 1
+        metrics.set("mini_backup_upload_slots_in_use", self.active)
+        try:
+            yield self._buckets(username)
+        finally:
+            for handle in held:
+                handle.close()
+            self.active -= 1
+            metrics.set("mini_backup_upload_slots_in_use", self.active)
+
+upload_admission = UploadAdmission(UPLOAD_LIMITS)
+
+# Интервал пересчета объема хранилища чанков (обход каталога дорогой, его не делаем на каждый запрос)
+STORAGE_METRICS_TTL = 60
+storage_metrics_cache = {"updated": 0, "bytes": 0, "chunks": 0}
+
+# База данных пользователей: имя -> хеш пароля (python credentials.py) или пароль в открытом виде
 USERS = CONFIG.get("users", {"admin": "admin_password"})
+for _user, _stored in USERS.items():
+    if not is_hashed(_stored):
+        logging.warning(f"Пароль пользователя {_user} хранится в конфигурации в открытом виде, замените его хешем")
+
+# Аутентификация: проверка хеша пароля дорогая, поэтому успешные проверки кэшируются на cache_ttl секунд
+# (не больше cache_size записей), а клиент в начале запуска получает токен (POST /token) на token_ttl секунд
+# и дальше отправляет его вместо пароля. Секрет подписи токенов общий для всех воркеров: token_secret
+# из конфигурации или случайный, сохраняемый в SERVER_BACKUP_DIR при первом запуске.
+AUTH = CONFIG.get("auth", {})
+TOKEN_SECRET_PATH = os.path.join(SERVER_BACKUP_DIR, ".token_secret")
+
+# Секрет подписи токенов: из конфигурации или из файла (создается первым запущенным воркером)
+def load_token_secret() -> bytes:
+    if AUTH.get("token_secret"):
+        return AUTH["token_secret"].encode()
+    with file_lock("token_secret"):
+        if not os.path.exists(TOKEN_SECRET_PATH):
+            temp_path = f"{TOKEN_SECRET_PATH}.{os.getpid()}.tmp"
+            with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                f.write(secrets.token_hex(32))
+            os.replace(temp_path, TOKEN_SECRET_PATH)
+        with open(TOKEN_SECRET_PATH, "r") as f:
+            return f.read().strip().encode()
+
+password_cache = VerificationCache(AUTH.get("cache_ttl", 300), AUTH.get("cache_size", 1024))
+token_signer = TokenSigner(load_token_secret(), AUTH.get("token_ttl", 3600))
 
 # Шаблон имени файла
 BACKUP_NAME_FORMAT = CONFIG.get("backup_name_format", "backup_{timestamp}_{username}.zip")
 
-# Базовая аутентификация
-security = HTTPBasic()
+# Базовая аутентификация или токен (Authorization: Bearer)
+basic_security = HTTPBasic(auto_error=False)
+bearer_security = HTTPBearer(auto_error=False)
 
-# Проверка аутентификации
-def authenticate(credentials: HTTPBasicCredentials = Depends(security)):
-    username = credentials.username
-    password = credentials.password
-    if username in USERS and secrets.compare_digest(password, USERS[username]):
-        return username
-    raise HTTPException(
+def _unauthorized() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Incorrect username or password",
         headers={"WWW-Authenticate": "Basic"},
     )
 
+# Проверка пароля (только Basic)
+def authenticate_password(basic: Optional[HTTPBasicCredentials] = Depends(basic_security)):
+    if basic is not None:
+        stored = USERS.get(basic.username)
+        if stored is not None and password_cache.verify(basic.username, basic.password, stored):
+            return basic.username
+    raise _unauthorized()
+
+# Проверка аутентификации: токен или пароль
+def authenticate(
+    basic: Optional[HTTPBasicCredentials] = Depends(basic_security),
+    bearer: Optional[HTTPAuthorizationCredentials] = Depends(bearer_security),
+):
+    if bearer is None:
+        return authenticate_password(basic)
+    username = token_signer.verify(bearer.credentials, USERS)
+    if username is None:
+        raise _unauthorized()
+    return username
+
+# Выдача токена на время запуска клиента: дальше запросы проверяются по подписи, без хеша пароля.
+# Токен выдается только по паролю, иначе его можно было бы продлевать бесконечно.
+@app.post("/token")
+def issue_token(username: str = Depends(authenticate_password)):
+    return {
+        "token": token_signer.issue(username, USERS[username]),
+        "token_type": "bearer",
+        "expires_in": token_signer.ttl,
+    }
+
 # Формирование имени файла с разделителями
 def generate_backup_name(username: str, client_timestamp: Optional[int] = None) -> str:
     # Если клиент передал timestamp, используем его. Иначе — текущее время сервера.
@@ -77,40 +576,1334 @@ def generate_backup_name(username: str, client_timestamp: Optional[int] = None)
         )
     return BACKUP_NAME_FORMAT.format(timestamp=timestamp, username=username)
 
-# Загрузка бэкапа на сервер
+# Разбор имени бэкапа по BACKUP_NAME_FORMAT: (пользователь, Unix timestamp) или (None, None)
+BACKUP_NAME_RE = re.compile(
+    "^" + re.escape(BACKUP_NAME_FORMAT)
+    .replace(re.escape("{timestamp}"), r"(?P<timestamp>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})")
+    .replace(re.escape("{username}"), r"(?P<username>.+?)") + "$"
+)
+
+def parse_backup_name(name: str):
+    match = BACKUP_NAME_RE.match(name)
+    if not match:
+        return None, None
+    groups = match.groupdict()
+    timestamp = groups.get("timestamp")
+    if timestamp:
+        timestamp = int(datetime.strptime(timestamp, "%Y-%m-%d_%H-%M-%S").timestamp())
+    return groups.get("username"), timestamp
+
+# Метаданные бэкапа, которые сообщает клиент
+BACKUP_METADATA_FIELDS = ("encryption", "compression", "kind", "parent")
+
+def backup_metadata(values) -> dict:
+    return {field: str(values[field]) for field in BACKUP_METADATA_FIELDS if values.get(field)}
+
+# Каталог бэкапов в SQLite: один ряд на бэкап, счетчик версий для ETag в /list
+class BackupCatalog:
+    columns = (
+        "name", "username", "timestamp", "client_timestamp", "created", "size", "sha256",
+        "layout", "encryption", "compression", "kind", "parent", "verified", "integrity",
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        with self.transaction() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS backups (
+                    name TEXT PRIMARY KEY,
+                    username TEXT,
+                    timestamp INTEGER,
+                    client_timestamp INTEGER,
+                    created INTEGER,
+                    size INTEGER,
+                    sha256 TEXT,
+                    layout TEXT,
+                    encryption TEXT,
+                    compression TEXT,
+                    kind TEXT,
+                    parent TEXT,
+                    verified INTEGER,
+                    integrity TEXT
+                );
+                CREATE INDEX IF NOT EXISTS backups_user_time ON backups (username, timestamp);
+                CREATE INDEX IF NOT EXISTS backups_time ON backups (timestamp);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+                INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+            """)
+            # Каталоги, созданные до появления проверки целостности
+            existing = {row["name"] for row in db.execute("PRAGMA table_info(backups)")}
+            for column, kind in (("verified", "INTEGER"), ("integrity", "TEXT")):
+                if column not in existing:
+                    db.execute(f"ALTER TABLE backups ADD COLUMN {column} {kind}")
+
+    # Отдельное соединение на каждую операцию: эндпоинты вызывают каталог из разных потоков
+    @contextmanager
+    def transaction(self):
+        with closing(sqlite3.connect(self.path, timeout=30)) as db:
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            with db:
+                yield db
+
+    @staticmethod
+    def _bump_version(db):
+        db.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+    def add(self, record: dict):
+        record = {column: record.get(column) for column in self.columns}
+        with self.transaction() as db:
+            db.execute(
+                f"INSERT OR REPLACE INTO backups ({', '.join(self.columns)}) "
+                f"VALUES ({', '.join('?' for _ in self.columns)})",
+                [record[column] for column in self.columns],
+            )
+            self._bump_version(db)
+
+    def remove(self, name: str):
+        with self.transaction() as db:
+            db.execute("DELETE FROM backups WHERE name = ?", (name,))
+            self._bump_version(db)
+
+    # Удаление нескольких записей одной транзакцией
+    def remove_many(self, names: List[str]):
+        with self.transaction() as db:
+            db.executemany("DELETE FROM backups WHERE name = ?", [(name,) for name in names])
+            self._bump_version(db)
+
+    def get(self, name: str) -> Optional[dict]:
+        with self.transaction() as db:
+            row = db.execute("SELECT * FROM backups WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row else None
+
+    # Количество и объем бэкапов по способу хранения (файл или чанки)
+    def stats(self) -> dict:
+        with self.transaction() as db:
+            rows = db.execute("SELECT layout, COUNT(*), COALESCE(SUM(size), 0) FROM backups GROUP BY layout").fetchall()
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def users(self) -> List[str]:
+        with self.transaction() as db:
+            rows = db.execute("SELECT DISTINCT username FROM backups WHERE username IS NOT NULL").fetchall()
+        return [row[0] for row in rows]
+
+    # Все бэкапы пользователя (новые первыми) — без постраничного вывода, для политик хранения
+    def user_backups(self, username: str) -> List[dict]:
+        with self.transaction() as db:
+            rows = db.execute(
+                "SELECT name, timestamp, size, layout, kind, parent FROM backups "
+                "WHERE username = ? ORDER BY timestamp DESC, name DESC",
+                (username,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    # Результат проверки целостности; sha256 записывается, только если его еще не было
+    def mark_verified(self, name: str, integrity: str, sha256: Optional[str] = None):
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE backups SET verified = ?, integrity = ?, sha256 = COALESCE(sha256, ?) WHERE name = ?",
+                (int(time.time()), integrity, sha256, name),
+            )
+            self._bump_version(db)
+
+    # Следующий бэкап для фоновой проверки: сначала никогда не проверенные, потом проверенные раньше before
+    def next_to_scrub(self, before: int) -> Optional[str]:
+        with self.transaction() as db:
+            row = db.execute(
+                "SELECT name FROM backups WHERE verified IS NULL OR verified < ? "
+                "ORDER BY verified IS NOT NULL, verified, timestamp LIMIT 1",
+                (before,),
+            ).fetchone()
+        return row[0] if row else None
+
+    # Количество бэкапов с неудачной последней проверкой по состоянию (corrupt, missing)
+    def integrity_stats(self) -> dict:
+        with self.transaction() as db:
+            rows = db.execute(
+                "SELECT integrity, COUNT(*) FROM backups WHERE integrity IS NOT NULL AND integrity != 'ok' "
+                "GROUP BY integrity"
+            ).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def version(self) -> int:
+        with self.transaction() as db:
+            return db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    # Страница бэкапов (новые первыми) с фильтрами и общим количеством
+    def list(self, username=None, since=None, until=None, limit=LIST_DEFAULT_LIMIT, offset=0):
+        conditions, params = [], []
+        if username:
+            conditions.append("username = ?")
+            params.append(username)
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("timestamp <= ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.transaction() as db:
+            version = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            total = db.execute(f"SELECT COUNT(*) FROM backups {where}", params).fetchone()[0]
+            rows = db.execute(
+                f"SELECT * FROM backups {where} ORDER BY timestamp DESC, name DESC LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return [dict(row) for row in rows], total, version
+
+    # Сверка с диском: добавление недостающих записей и удаление записей об отсутствующих файлах
+    def sync(self, on_disk: dict):
+        with self.transaction() as db:
+            known = {row["name"] for row in db.execute("SELECT name FROM backups")}
+            for name in known - set(on_disk):
+                db.execute("DELETE FROM backups WHERE name = ?", (name,))
+            for name in set(on_disk) - known:
+                record = on_disk[name]
+                db.execute(
+                    f"INSERT INTO backups ({', '.join(self.columns)}) VALUES ({', '.join('?' for _ in self.columns)})",
+                    [record.get(column) for column in self.columns],
+                )
+            changed = len(known - set(on_disk)) + len(set(on_disk) - known)
+            if changed:
+                self._bump_version(db)
+        return changed
+
+with file_lock("catalog"):  # Создание таблиц и миграция — один воркер за раз
+    catalog = BackupCatalog(CATALOG_DB)
+
+# Запись о бэкапе для каталога
+def catalog_record(name: str, username: str, client_timestamp: Optional[int], size: int, layout: str,
+                   sha256: Optional[str] = None, metadata: Optional[dict] = None, created: Optional[int] = None) -> dict:
+    created = created or int(time.time())
+    record = {
+        "name": name,
+        "username": username,
+        "timestamp": client_timestamp or created,
+        "client_timestamp": client_timestamp,
+        "created": created,
+        "size": size,
+        "sha256": sha256,
+        "layout": layout,
+    }
+    record.update(metadata or {})
+    return record
+
+# Файл с контрольной суммой бэкапа
+def checksum_path(backup_name: str) -> str:
+    return os.path.join(CHECKSUM_DIR, f"{backup_name}.sha256")
+
+def write_checksum(backup_name: str, sha256: str):
+    temp_path = f"{checksum_path(backup_name)}.{secrets.token_hex(4)}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(f"{sha256}  {backup_name}\n")
+    os.replace(temp_path, checksum_path(backup_name))
+
+def read_checksum(backup_name: str) -> Optional[str]:
+    try:
+        with open(checksum_path(backup_name), "r") as f:
+            return f.read().split()[0]
+    except (FileNotFoundError, IndexError):
+        return None
+
+# Запись о новом бэкапе: контрольная сумма рядом с бэкапом и строка в каталоге
+def record_backup(record: dict):
+    if record.get("sha256"):
+        write_checksum(record["name"], record["sha256"])
+    catalog.add(record)
+
+# Контрольная сумма, переданная клиентом (поле или параметр sha256, заголовок X-Content-SHA256),
+# должна совпасть с посчитанной сервером при приеме данных
+def check_client_sha256(expected: Optional[str], actual: str):
+    if expected and expected.lower() != actual:
+        raise HTTPException(status_code=400, detail="Checksum mismatch")
+
+# Ключи объектов в хранилище
+def backup_key(backup_name: str) -> str:
+    return f"backups/{backup_name}"
+
+def chunk_key(chunk_id: str) -> str:
+    return f"chunks/{chunk_id}"
+
+# Перенос бэкапов и чанков, лежащих в SERVER_BACKUP_DIR в старой раскладке (файлы в корне и .chunks),
+# в хранилище. На том же диске это переименование, иначе — копирование.
+def migrate_legacy_layout():
+    moved = 0
+    for name in os.listdir(SERVER_BACKUP_DIR):
+        path = os.path.join(SERVER_BACKUP_DIR, name)
+        if name.startswith("backup_") and os.path.isfile(path):
+            STORAGE.put_file(backup_key(name), path)
+            moved += 1
+    if os.path.isdir(LEGACY_CHUNK_STORE_DIR):
+        for root, dirs, files in os.walk(LEGACY_CHUNK_STORE_DIR, topdown=False):
+            for name in files:
+                if CHUNK_ID_RE.match(name):
+                    STORAGE.put_file(chunk_key(name), os.path.join(root, name))
+                    moved += 1
+            try:
+                os.rmdir(root)  # Опустевшие каталоги старой раскладки
+            except OSError:
+                pass
+    if moved:
+        logging.info(f"Перенесено в хранилище из старой раскладки каталога: {moved} файлов")
+
+# Подготовка хранилища и каталога при запуске воркера
+def prepare_storage():
+    with file_lock("startup"):
+        migrate_legacy_layout()
+        rebuild_catalog()
+
+# Фоновые задачи выполняет один воркер — тот, кто держит блокировку "background". Остальные
+# периодически пытаются ее взять, чтобы подхватить задачи, если этот воркер завершится.
+async def run_background_tasks(loops: list):
+    lock = None
+    while lock is None:
+        lock = await run_in_threadpool(try_file_lock, "background")
+        if lock is None:
+            await asyncio.sleep(BACKGROUND_RETRY_INTERVAL)
+    logging.info(f"Фоновые задачи выполняет воркер {os.getpid()}")
+    try:
+        await asyncio.gather(*(loop() for loop in loops))
+    finally:
+        lock.close()
+
+# Восстановление каталога по содержимому хранилища и манифестам
+def rebuild_catalog():
+    on_disk = {}
+    for item in STORAGE.list("backups/backup_"):
+        name = item.key[len("backups/"):]
+        username, timestamp = parse_backup_name(name)
+        on_disk[name] = catalog_record(
+            name, username, timestamp, item.size, "file", read_checksum(name), created=int(item.mtime)
+        )
+    for file_name in os.listdir(MANIFEST_DIR):
+        if file_name.startswith("backup_") and file_name.endswith(".json"):
+            manifest = load_manifest(file_name[:-len(".json")])
+            on_disk[manifest["name"]] = catalog_record(
+                manifest["name"], manifest["username"], manifest["client_timestamp"], manifest["size"],
+                "chunked", read_checksum(manifest["name"]), manifest.get("metadata"), manifest["created"]
+            )
+    changed = catalog.sync(on_disk)
+    logging.info(f"Каталог бэкапов сверен с хранилищем: {len(on_disk)} бэкапов, исправлено записей: {changed}")
+
+# Запись тела запроса без блокировки цикла событий: данные копятся в буфере и порциями уходят
+# в пул потоков, где пишутся в объект хранилища (или временный файл) и сразу хэшируются (SHA-256).
+# open_writer открывает запись (объект с методами write, commit и abort); записанное становится
+# видно только после commit.
+class AsyncFileSink:
+    flush_size = 1024 * 1024
+
+    def __init__(self, open_writer, max_size: Optional[int] = None, buckets: tuple = ()):
+        self.open_writer = open_writer
+        self.max_size = max_size
+        self.buckets = buckets  # Ограничители скорости записи (TokenBucket)
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.buffer = bytearray()
+        self.writer = None
+        self.meter = None
+
+    async def open(self):
+        self.writer = await run_in_threadpool(self.open_writer)
+        self.meter = TransferMeter("upload")
+
+    def _write(self, data: bytes):
+        self.digest.update(data)
+        self.writer.write(data)
+        self.meter.add(len(data))
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise HTTPException(status_code=413, detail="Request body too large")
+        self.buffer += data
+        if len(self.buffer) >= self.flush_size:
+            await self.flush()
+
+    async def flush(self):
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            for bucket in self.buckets:
+                await bucket.consume(len(data))
+            await run_in_threadpool(self._write, data)
+
+    async def close(self):
+        await self.flush()
+        self.meter.finish()
+
+    async def commit(self):
+        await run_in_threadpool(self.writer.commit)
+
+    async def abort(self):
+        if self.meter is not None:
+            self.meter.finish()
+        if self.writer is not None:
+            await run_in_threadpool(self.writer.abort)
+
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
+
+# Прием тела запроса. При обрыве соединения или ошибке запись отменяется; после успешного
+# приема вызывающий проверяет данные и фиксирует их (commit) или отменяет (abort).
+async def receive_body(request: Request, open_writer, max_size: Optional[int] = None, buckets: tuple = ()) -> AsyncFileSink:
+    sink = AsyncFileSink(open_writer, max_size, buckets)
+    try:
+        await sink.open()
+        async for chunk in request.stream():
+            await sink.write(chunk)
+        await sink.close()
+    except BaseException:
+        await sink.abort()
+        raise
+    return sink
+
+# Потоковый разбор multipart/form-data: данные поля file сразу уходят в AsyncFileSink,
+# остальные (небольшие) поля собираются в словарь. В памяти — не больше одного куска тела.
+class MultipartFileReceiver:
+    max_field_size = 1024
+
+    def __init__(self, boundary: bytes, sink: AsyncFileSink):
+        self.sink = sink
+        self.fields = {}
+        self.file_received = False
+        self._pending = []
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._field_name = None
+        self._is_file = False
+        self._data = bytearray()
+        self.parser = MultipartParser(boundary, callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+
+    def _on_part_begin(self):
+        self._disposition = b""
+        self._field_name = None
+        self._is_file = False
+        self._data = bytearray()
+
+    def _on_header_field(self, data, start, end):
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        disposition, options = parse_options_header(self._disposition)
+        self._field_name = options.get(b"name", b"").decode("utf-8", "replace")
+        self._is_file = self._field_name == "file"
+        if self._is_file:
+            if self.file_received:
+                raise HTTPException(status_code=400, detail="Only one file may be uploaded")
+            self.file_received = True
+
+    def _on_part_data(self, data, start, end):
+        if self._is_file:
+            self._pending.append(data[start:end])
+        else:
+            self._data += data[start:end]
+            if len(self._data) > self.max_field_size:
+                raise HTTPException(status_code=400, detail="Form field too large")
+
+    def _on_part_end(self):
+        if not self._is_file and self._field_name:
+            self.fields[self._field_name] = self._data.decode("utf-8", "replace")
+
+    async def feed(self, chunk: bytes):
+        self.parser.write(chunk)
+        for data in self._pending:
+            await self.sink.write(data)
+        self._pending.clear()
+
+    def finalize(self):
+        self.parser.finalize()
+
+# Загрузка бэкапа на сервер (multipart/form-data с полями file и client_timestamp).
+# Тело разбирается по мере поступления, без промежуточного UploadFile. Имя бэкапа зависит от полей
+# формы, которые могут прийти после файла, поэтому файл сначала принимается во временный файл
+# в SERVER_BACKUP_DIR и уже потом переносится в хранилище.
 @app.post("/upload")
-async def upload_backup(
-    file: UploadFile = File(...),
+async def upload_backup(request: Request, username: str = Depends(authenticate)):
+    content_type, options = parse_options_header(request.headers.get("Content-Type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data")
+    temp_path = os.path.join(SERVER_BACKUP_DIR, f".upload-{secrets.token_hex(8)}")  # Не попадает в /list
+    async with upload_admission.slot(username) as buckets:
+        sink = AsyncFileSink(lambda: FileWriter(temp_path), buckets=buckets)
+        try:
+            await sink.open()
+            receiver = MultipartFileReceiver(options[b"boundary"], sink)
+            async for chunk in request.stream():
+                await receiver.feed(chunk)
+            receiver.finalize()
+            await sink.close()
+            if not receiver.file_received:
+                raise HTTPException(status_code=400, detail="Field 'file' is required")
+            try:
+                client_timestamp = int(receiver.fields["client_timestamp"]) if receiver.fields.get("client_timestamp") else None
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid client_timestamp")
+            check_client_sha256(receiver.fields.get("sha256") or request.headers.get("X-Content-SHA256"), sink.hexdigest())
+            backup_name = generate_backup_name(username, client_timestamp)  # Генерация имени файла
+            backup_path = backup_key(backup_name)
+            await sink.commit()
+        except BaseException:
+            await sink.abort()
+            raise
+        try:
+            await run_in_threadpool(STORAGE.put_file, backup_path, temp_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    await run_in_threadpool(record_backup, catalog_record(
+        backup_name, username, client_timestamp, sink.size, "file", sink.hexdigest(), backup_metadata(receiver.fields)
+    ))
+    logging.info(f"Бэкап загружен на сервер как {backup_path} ({sink.size} байт, sha256 {sink.hexdigest()})")
+    return JSONResponse(content={"message": "Backup uploaded successfully", "path": backup_path, "sha256": sink.hexdigest()})
+
+# Допуск к потоковой загрузке без тела запроса: ждет места в очереди, как сама загрузка, и сразу его
+# освобождает. Клиент запускает архивацию только после ответа 200: отказ посреди отправки тела
+# клиент увидел бы как разрыв соединения, а не как 429/503 с Retry-After.
+@app.get("/upload-stream/admission")
+async def upload_stream_admission(username: str = Depends(authenticate)):
+    async with upload_admission.slot(username):
+        pass
+    return JSONResponse(content={"admitted": True})
+
+# Потоковая загрузка бэкапа (тело запроса — сам архив, обычно Transfer-Encoding: chunked).
+# Данные сразу пишутся в хранилище, но объект становится виден только после получения всего тела.
+@app.post("/upload-stream")
+async def upload_backup_stream(
+    request: Request,
     username: str = Depends(authenticate),
-    client_timestamp: Optional[int] = Form(default=None),  # Передаем Unix timestamp из формы
+    client_timestamp: Optional[int] = None,
+    encryption: Optional[str] = None,
+    compression: Optional[str] = None,
+    kind: Optional[str] = None,
+    parent: Optional[str] = None,
+    sha256: Optional[str] = None,
 ):
-    backup_name = generate_backup_name(username, client_timestamp)  # Генерация имени файла
-    backup_path = os.path.join(SERVER_BACKUP_DIR, backup_name)
-    with open(backup_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
-    logging.info(f"Бэкап {file.filename} загружен на сервер как {backup_path}")
-    return JSONResponse(content={"message": "Backup uploaded successfully", "path": backup_path})
-
-# Скачивание бэкапа с сервера
+    backup_name = generate_backup_name(username, client_timestamp)
+    backup_path = backup_key(backup_name)
+    try:
+        async with upload_admission.slot(username) as buckets:
+            sink = await receive_body(request, lambda: STORAGE.open_write(backup_path), buckets=buckets)
+    except HTTPException:
+        raise
+    except BaseException:
+        logging.error(f"Потоковая загрузка бэкапа {backup_name} прервана")
+        raise
+    try:
+        check_client_sha256(sha256 or request.headers.get("X-Content-SHA256"), sink.hexdigest())
+        await sink.commit()
+    except BaseException:
+        await sink.abort()
+        raise
+    await run_in_threadpool(record_backup, catalog_record(
+        backup_name, username, client_timestamp, sink.size, "file", sink.hexdigest(),
+        backup_metadata({"encryption": encryption, "compression": compression, "kind": kind, "parent": parent})
+    ))
+    logging.info(f"Бэкап загружен на сервер потоково как {backup_path} ({sink.size} байт, sha256 {sink.hexdigest()})")
+    return JSONResponse(content={"message": "Backup uploaded successfully", "path": backup_path, "sha256": sink.hexdigest()})
+
+# Путь к манифесту бэкапа, собранного из чанков
+def manifest_path(backup_name: str) -> str:
+    return os.path.join(MANIFEST_DIR, f"{backup_name}.json")
+
+def load_manifest(backup_name: str) -> dict:
+    with open(manifest_path(backup_name), "r") as f:
+        return json.load(f)
+
+class ChunkIds(BaseModel):
+    chunks: List[str]
+
+class ChunkRef(BaseModel):
+    id: str
+    size: int
+    plain_size: Optional[int] = None
+
+# Метаданные бэкапа от клиента (шифрование, сжатие, вид бэкапа и предыдущий бэкап цепочки)
+class BackupMetadata(BaseModel):
+    encryption: Optional[str] = None
+    compression: Optional[str] = None
+    kind: Optional[str] = None
+    parent: Optional[str] = None
+
+class ChunkedBackup(BackupMetadata):
+    sha256: Optional[str] = None  # SHA-256 всего бэкапа (чанков подряд), проверяется фоновой проверкой
+    client_timestamp: Optional[int] = None
+    chunks: List[ChunkRef]
+
+# Какие из перечисленных чанков отсутствуют в хранилище.
+# Имеющиеся чанки "касаются", чтобы сборщик мусора не удалил их до записи манифеста.
+@app.post("/chunks/missing")
+def missing_chunks(payload: ChunkIds, username: str = Depends(authenticate)):
+    missing = []
+    for chunk_id in payload.chunks:
+        if not CHUNK_ID_RE.match(chunk_id):
+            raise HTTPException(status_code=400, detail=f"Invalid chunk id: {chunk_id}")
+        if not STORAGE.touch(chunk_key(chunk_id)):
+            missing.append(chunk_id)
+    return JSONResponse(content={"missing": missing})
+
+# Загрузка одного чанка. Идентификатор чанка — SHA-256 его содержимого, сервер его проверяет.
+@app.put("/chunks/{chunk_id}")
+async def upload_chunk(chunk_id: str, request: Request, username: str = Depends(authenticate)):
+    if not CHUNK_ID_RE.match(chunk_id):
+        raise HTTPException(status_code=400, detail="Invalid chunk id")
+    async with upload_admission.slot(username) as buckets:
+        sink = await receive_body(request, lambda: STORAGE.open_write(chunk_key(chunk_id)), MAX_CHUNK_SIZE, buckets)
+    if sink.hexdigest() != chunk_id:
+        await sink.abort()
+        raise HTTPException(status_code=400, detail="Chunk checksum mismatch")
+    await sink.commit()
+    return JSONResponse(content={"message": "Chunk uploaded successfully"})
+
+# Запись бэкапа как списка ссылок на чанки (все чанки должны уже быть в хранилище). Чанки не
+# перечитываются: SHA-256 от клиента сохраняется в манифесте как непроверенная, а эталонную сумму
+# задает первый проход фоновой проверки (см. verify_stored_backup).
+@app.post("/chunked-backups")
+def create_chunked_backup(payload: ChunkedBackup, username: str = Depends(authenticate)):
+    backup_name = generate_backup_name(username, payload.client_timestamp)
+    client_sha256 = payload.sha256.lower() if payload.sha256 else None
+    if client_sha256 and not CHUNK_ID_RE.match(client_sha256):
+        raise HTTPException(status_code=400, detail="Invalid sha256")
+    with file_lock("chunks"):
+        missing = []
+        for ref in payload.chunks:
+            if not CHUNK_ID_RE.match(ref.id):
+                raise HTTPException(status_code=400, detail=f"Invalid chunk id: {ref.id}")
+            info = STORAGE.stat(chunk_key(ref.id))
+            if info is None:
+                missing.append(ref.id)
+            elif info.size != ref.size:
+                raise HTTPException(status_code=400, detail=f"Chunk size mismatch: {ref.id}")
+        if missing:
+            raise HTTPException(status_code=409, detail={"error": "Missing chunks", "missing": missing})
+        manifest = {
+            "name": backup_name,
+            "username": username,
+            "client_timestamp": payload.client_timestamp,
+            "created": int(time.time()),
+            "size": sum(ref.size for ref in payload.chunks),
+            "metadata": backup_metadata(payload.model_dump()),
+            "client_sha256": client_sha256,
+            "chunks": [ref.model_dump() for ref in payload.chunks],
+        }
+        temp_path = manifest_path(backup_name) + ".part"
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, manifest_path(backup_name))
+        record_backup(catalog_record(
+            backup_name, username, payload.client_timestamp, manifest["size"], "chunked", None,
+            manifest["metadata"], manifest["created"]
+        ))
+    backup_path = backup_key(backup_name)
+    logging.info(f"Бэкап {backup_name} записан из {len(payload.chunks)} чанков")
+    return JSONResponse(content={"message": "Backup uploaded successfully", "path": backup_path, "sha256": client_sha256})
+
+# Список чанков бэкапа: по смещениям и размерам чанков клиент читает нужные части бэкапа
+# через Range и расшифровывает их по отдельности
+@app.get("/chunked-backups/{filename}")
+def get_chunked_backup(filename: str, username: str = Depends(authenticate)):
+    if not os.path.exists(manifest_path(filename)):
+        raise HTTPException(status_code=404, detail="Chunked backup not found")
+    manifest = load_manifest(filename)
+    return JSONResponse(content={"name": manifest["name"], "size": manifest["size"], "chunks": manifest["chunks"]})
+
+# Сборка мусора: удаление чанков, на которые не ссылается ни один манифест
+def collect_garbage_chunks() -> int:
+    with file_lock("chunks"):
+        referenced = set()
+        for name in os.listdir(MANIFEST_DIR):
+            if name.endswith(".json"):
+                with open(os.path.join(MANIFEST_DIR, name), "r") as f:
+                    referenced.update(ref["id"] for ref in json.load(f)["chunks"])
+        removed = 0
+        expired = time.time() - CHUNK_GC_GRACE
+        for item in list(STORAGE.list("chunks/")):
+            if item.key[len("chunks/"):] not in referenced and item.mtime < expired:
+                STORAGE.delete(item.key)
+                removed += 1
+    if removed:
+        logging.info(f"Сборщик мусора удалил {removed} чанков без ссылок")
+    return removed
+
+class UploadSessionRequest(BackupMetadata):
+    client_timestamp: Optional[int] = None
+
+class UploadSessionComplete(BaseModel):
+    parts: int
+    size: Optional[int] = None
+    sha256: Optional[str] = None
+
+def upload_session_dir(upload_id: str) -> str:
+    return os.path.join(UPLOAD_SESSIONS_DIR, upload_id)
+
+def part_path(upload_id: str, number: int) -> str:
+    return os.path.join(upload_session_dir(upload_id), f"part-{number:06d}")
+
+# Загрузка сессии с проверкой владельца. Пока части склеиваются (каталог переименован
+# в .completing), запрос получает 503 с Retry-After и повторяется клиентом.
+def load_upload_session(upload_id: str, username: str) -> dict:
+    if not UPLOAD_ID_RE.match(upload_id):
+        raise HTTPException(status_code=400, detail="Invalid upload id")
+    completing = False
+    try:
+        with open(os.path.join(upload_session_dir(upload_id), "session.json"), "r") as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        try:
+            with open(os.path.join(upload_session_dir(upload_id) + ".completing", "session.json"), "r") as f:
+                session = json.load(f)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        completing = True
+    if session["username"] != username:
+        raise HTTPException(status_code=403, detail="Upload session belongs to another user")
+    if completing:
+        raise HTTPException(
+            status_code=503, detail="Upload session is being completed", headers={"Retry-After": "10"}
+        )
+    return session
+
+# Принятые части сессии: номер, размер и контрольная сумма
+def list_uploaded_parts(upload_id: str) -> List[dict]:
+    parts = []
+    for name in sorted(os.listdir(upload_session_dir(upload_id))):
+        if name.startswith("part-") and name.endswith(".json"):
+            with open(os.path.join(upload_session_dir(upload_id), name), "r") as f:
+                parts.append(json.load(f))
+    return parts
+
+# Удаление брошенных сессий загрузки
+def cleanup_upload_sessions():
+    expired = time.time() - UPLOAD_SESSION_TTL
+    for upload_id in os.listdir(UPLOAD_SESSIONS_DIR):
+        session_dir = upload_session_dir(upload_id)
+        try:
+            if os.path.getmtime(session_dir) >= expired:
+                continue
+        except FileNotFoundError:  # Сессию только что завершили или удалили в другом воркере
+            continue
+        shutil.rmtree(session_dir, ignore_errors=True)
+        logging.info(f"Удалена брошенная сессия загрузки {upload_id}")
+
+# Начало загрузки по частям
+@app.post("/uploads")
+def create_upload_session(payload: UploadSessionRequest, username: str = Depends(authenticate)):
+    cleanup_upload_sessions()
+    upload_id = secrets.token_hex(16)
+    os.makedirs(upload_session_dir(upload_id))
+    with open(os.path.join(upload_session_dir(upload_id), "session.json"), "w") as f:
+        json.dump({
+            "username": username,
+            "client_timestamp": payload.client_timestamp,
+            "created": int(time.time()),
+            "metadata": backup_metadata(payload.model_dump()),
+        }, f)
+    logging.info(f"Начата загрузка по частям {upload_id} пользователем {username}")
+    return JSONResponse(content={"upload_id": upload_id})
+
+# Состояние сессии: какие части уже приняты (для продолжения прерванной загрузки)
+@app.get("/uploads/{upload_id}")
+def get_upload_session(upload_id: str, username: str = Depends(authenticate)):
+    session = load_upload_session(upload_id, username)
+    if session.get("result"):  # Сессия уже завершена: клиент не получил ответ на /complete
+        return JSONResponse(content={"upload_id": upload_id, "parts": [], "offset": 0, "result": session["result"]})
+    parts = list_uploaded_parts(upload_id)
+    # Непрерывно подтвержденный префикс: с этого смещения можно продолжать последовательную загрузку
+    offset = 0
+    for expected, part in enumerate(parts):
+        if part["number"] != expected:
+            break
+        offset += part["size"]
+    return JSONResponse(content={"upload_id": upload_id, "parts": parts, "offset": offset})
+
+# Загрузка части. Клиент передает SHA-256 части в заголовке X-Part-SHA256, сервер его проверяет.
+@app.put("/uploads/{upload_id}/parts/{number}")
+async def upload_part(upload_id: str, number: int, request: Request, username: str = Depends(authenticate)):
+    if load_upload_session(upload_id, username).get("result"):
+        raise HTTPException(status_code=409, detail="Upload session is already completed")
+    if not 0 <= number < MAX_PARTS:
+        raise HTTPException(status_code=400, detail="Invalid part number")
+    expected_sha256 = request.headers.get("X-Part-SHA256", "").lower()
+    path = part_path(upload_id, number)
+    async with upload_admission.slot(username) as buckets:
+        sink = await receive_body(request, lambda: FileWriter(path), MAX_PART_SIZE, buckets)
+    if expected_sha256 and sink.hexdigest() != expected_sha256:
+        await sink.abort()
+        raise HTTPException(status_code=400, detail="Part checksum mismatch")
+    await sink.commit()
+    part = {"number": number, "size": sink.size, "sha256": sink.hexdigest()}
+    await run_in_threadpool(save_part, path, part)
+    return JSONResponse(content=part)
+
+# Описание принятой части с контрольной суммой (пишется после самих данных части)
+def save_part(path: str, part: dict):
+    with open(f"{path}.json", "w") as f:
+        json.dump(part, f)
+
+# Ответ на завершение загрузки; сохраняется в сессии, чтобы повторное завершение вернуло тот же бэкап
+def upload_result(backup_path: str, size: int, sha256: str) -> dict:
+    return {"message": "Backup uploaded successfully", "path": backup_path, "size": size, "sha256": sha256}
+
+# Запись описания сессии в ее каталог (через временный файл, чтобы не оставить его недописанным)
+def save_upload_session(session_dir: str, session: dict):
+    temp_path = os.path.join(session_dir, "session.json.part")
+    with open(temp_path, "w") as f:
+        json.dump(session, f)
+    os.replace(temp_path, os.path.join(session_dir, "session.json"))
+
+# Завершение загрузки: части склеиваются в объект хранилища, который становится виден
+# только после записи всех частей — наполовину записанный бэкап никогда не виден в /list.
+# Завершение идемпотентно: результат сохраняется в сессии (части удаляются), и повтор после
+# обрыва соединения или таймаута прокси возвращает тот же бэкап, а не загружает его заново.
+# Пока другой запрос еще склеивает части, повтор получает 503 с Retry-After.
+@app.post("/uploads/{upload_id}/complete")
+def complete_upload_session(upload_id: str, payload: UploadSessionComplete, username: str = Depends(authenticate)):
+    session = load_upload_session(upload_id, username)
+    if session.get("result"):
+        check_client_sha256(payload.sha256, session["result"]["sha256"])
+        return JSONResponse(content=session["result"])
+    parts = list_uploaded_parts(upload_id)
+    if [part["number"] for part in parts] != list(range(payload.parts)):
+        raise HTTPException(status_code=409, detail="Not all parts have been uploaded")
+    size = sum(part["size"] for part in parts)
+    if payload.size is not None and payload.size != size:
+        raise HTTPException(status_code=409, detail="Uploaded size does not match")
+
+    # Переименование каталога сессии защищает от повторного одновременного завершения
+    completing_dir = upload_session_dir(upload_id) + ".completing"
+    try:
+        os.rename(upload_session_dir(upload_id), completing_dir)
+    except OSError:
+        raise HTTPException(status_code=503, detail="Upload session is being completed", headers={"Retry-After": "10"})
+    os.utime(completing_dir)  # Чтобы очистка брошенных сессий не удалила каталог во время склейки
+
+    backup_name = generate_backup_name(username, session["client_timestamp"])
+    backup_path = backup_key(backup_name)
+    digest = hashlib.sha256()
+    writer = None
+    try:
+        writer = STORAGE.open_write(backup_path)
+        for part in parts:
+            with open(os.path.join(completing_dir, f"part-{part['number']:06d}"), "rb") as src:
+                while True:
+                    data = src.read(1024 * 1024)
+                    if not data:
+                        break
+                    digest.update(data)
+                    writer.write(data)
+        check_client_sha256(payload.sha256, digest.hexdigest())
+        writer.commit()
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        os.rename(completing_dir, upload_session_dir(upload_id))
+        raise
+    record_backup(catalog_record(
+        backup_name, username, session["client_timestamp"], size, "file", digest.hexdigest(), session.get("metadata")
+    ))
+    session["result"] = upload_result(backup_path, size, digest.hexdigest())
+    save_upload_session(completing_dir, session)
+    for name in os.listdir(completing_dir):
+        if name.startswith("part-"):
+            os.remove(os.path.join(completing_dir, name))
+    os.rename(completing_dir, upload_session_dir(upload_id))
+    logging.info(f"Бэкап загружен по частям ({len(parts)} частей) как {backup_path}")
+    return JSONResponse(content=session["result"])
+
+# Отмена загрузки по частям
+@app.delete("/uploads/{upload_id}")
+def abort_upload_session(upload_id: str, username: str = Depends(authenticate)):
+    load_upload_session(upload_id, username)
+    shutil.rmtree(upload_session_dir(upload_id), ignore_errors=True)
+    return JSONResponse(content={"message": "Upload session aborted"})
+
+# Чтение диапазона [start, end] бэкапа из чанков: по смещениям чанков находим первый нужный
+# и читаем только пересекающиеся с диапазоном чанки
+def iter_chunked_range(manifest: dict, start: int, end: int):
+    offset = 0
+    for ref in manifest["chunks"]:
+        chunk_start, chunk_end = offset, offset + ref["size"] - 1
+        offset += ref["size"]
+        if chunk_end < start:
+            continue
+        if chunk_start > end:
+            break
+        yield from STORAGE.read(
+            chunk_key(ref["id"]), max(start, chunk_start) - chunk_start, min(end, chunk_end) - chunk_start
+        )
+
+# Отдача данных клиенту с учетом в метриках скачивания
+def metered(blocks):
+    meter = TransferMeter("download")
+    try:
+        for data in blocks:
+            meter.add(len(data))
+            yield data
+    finally:
+        meter.finish()
+
+# Разбор заголовка Range. Поддерживается один диапазон байт; несколько диапазонов
+# и некорректный синтаксис игнорируются (отдается весь файл), как допускает RFC 9110.
+def parse_range_header(value: Optional[str], size: int):
+    if not value or not value.startswith("bytes=") or "," in value:
+        return None
+    first, _, last = value[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        elif last:
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+    if start > end and last:
+        return None
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+# Внутренний URI nginx для объекта хранилища или None, если файл нельзя отдать через nginx
+def accel_redirect_uri(key: str) -> Optional[str]:
+    path = STORAGE.local_path(key)
+    if path is None:
+        return None
+    relative = os.path.relpath(path, os.path.abspath(ACCEL_REDIRECT.get("root", SERVER_BACKUP_DIR)))
+    if relative.startswith(os.pardir):
+        return None
+    return ACCEL_REDIRECT.get("location", "/internal-storage/") + quote(relative.replace(os.sep, "/"))
+
+# Скачивание бэкапа с сервера. Поддерживаются Range и If-Range, что позволяет клиенту
+# продолжать прерванное скачивание и качать части параллельно. ETag и X-Checksum-SHA256
+# берутся из каталога (контрольная сумма известна для бэкапов, загруженных файлом).
+# Если включен accel_redirect, файл с локального диска отдает nginx: Range, If-Range и ETag
+# (по времени изменения и размеру файла) обрабатывает он сам.
 @app.get("/download/{filename}")
-async def download_backup(filename: str, username: str = Depends(authenticate)):
-    backup_path = os.path.join(SERVER_BACKUP_DIR, filename)
-    if not os.path.exists(backup_path):
-        raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(backup_path, filename=filename)
+async def download_backup(filename: str, request: Request, username: str = Depends(authenticate)):
+    record = await run_in_threadpool(catalog.get, filename)
+    sha256 = record["sha256"] if record else None
+    if os.path.exists(manifest_path(filename)):
+        manifest = await run_in_threadpool(load_manifest, filename)
+        size = manifest["size"]
+        etag = '"' + hashlib.sha256("".join(ref["id"] for ref in manifest["chunks"]).encode()).hexdigest()[:32] + '"'
+        reader = lambda start, end: iter_chunked_range(manifest, start, end)
+    else:
+        info = await run_in_threadpool(STORAGE.stat, backup_key(filename))
+        if info is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        uri = await run_in_threadpool(accel_redirect_uri, info.key) if ACCEL_REDIRECT.get("enabled") else None
+        if uri:
+            headers = {"X-Accel-Redirect": uri, "Content-Disposition": f'attachment; filename="{filename}"'}
+            if sha256:
+                headers["X-Checksum-SHA256"] = sha256
+            metrics.inc("mini_backup_offloaded_downloads_total")
+            return Response(media_type="application/octet-stream", headers=headers)
+        size = info.size
+        etag = f'"{sha256[:32]}"' if sha256 else f'"{info.size:x}-{int(info.mtime * 1e9):x}"'
+        reader = lambda start, end: STORAGE.read(info.key, start, end)
 
-# Получение списка бэкапов
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    }
+    if sha256:
+        headers["X-Checksum-SHA256"] = sha256
+    byte_range = None
+    if_range = request.headers.get("If-Range")
+    if if_range is None or if_range == etag:
+        byte_range = parse_range_header(request.headers.get("Range"), size)
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(metered(reader(0, size - 1)), media_type="application/octet-stream", headers=headers)
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(
+        metered(reader(start, end)), status_code=206, media_type="application/octet-stream", headers=headers
+    )
+
+# Разбор границы периода для /list: Unix timestamp или дата/время в ISO 8601
+def parse_time_filter(value: Optional[str]) -> Optional[int]:
+    if value is None:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid date: {value}")
+
+# Получение списка бэкапов из каталога: постранично, с фильтром по пользователю и периоду.
+# Ответ помечается ETag; если каталог не менялся, на If-None-Match отдается 304.
 @app.get("/list")
-async def list_backups(username: str = Depends(authenticate)):
-    backups = [f for f in os.listdir(SERVER_BACKUP_DIR) if f.startswith('backup_')]
-    return JSONResponse(content={"backups": backups})
+async def list_backups(
+    request: Request,
+    username: str = Depends(authenticate),
+    user: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    limit: int = LIST_DEFAULT_LIMIT,
+    offset: int = 0,
+):
+    limit = max(1, min(limit, LIST_MAX_LIMIT))
+    offset = max(0, offset)
+    items, total, version = await run_in_threadpool(
+        catalog.list, user, parse_time_filter(since), parse_time_filter(until), limit, offset
+    )
+    query = f"{user}|{since}|{until}|{limit}|{offset}"
+    etag = f'W/"{version}-{hashlib.sha256(query.encode()).hexdigest()[:16]}"'
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    next_offset = offset + len(items) if offset + len(items) < total else None
+    return JSONResponse(
+        content={
+            "backups": [item["name"] for item in items],
+            "items": items,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "next_offset": next_offset,
+        },
+        headers={"ETag": etag},
+    )
+
+# Пересчет метрик хранилища: каталог бэкапов, хранилище чанков (не чаще STORAGE_METRICS_TTL) и свободное место
+def update_storage_metrics():
+    for layout, (count, size) in catalog.stats().items():
+        metrics.set("mini_backup_backups", count, layout=layout)
+        metrics.set("mini_backup_backup_bytes", size, layout=layout)
+    if time.monotonic() - storage_metrics_cache["updated"] > STORAGE_METRICS_TTL:
+        total = chunks = 0
+        for item in STORAGE.list("chunks/"):
+            total += item.size
+            chunks += 1
+        storage_metrics_cache.update(updated=time.monotonic(), bytes=total, chunks=chunks)
+    metrics.set("mini_backup_chunk_store_bytes", storage_metrics_cache["bytes"])
+    metrics.set("mini_backup_chunk_store_chunks", storage_metrics_cache["chunks"])
+    free = STORAGE.free_space()  # Объектное хранилище свободное место не сообщает
+    metrics.set("mini_backup_disk_free_bytes", free if free is not None else shutil.disk_usage(SERVER_BACKUP_DIR).free)
+    integrity = catalog.integrity_stats()
+    for state in ("corrupt", "missing", "client_mismatch"):
+        metrics.set("mini_backup_corrupt_backups", integrity.get(state, 0), state=state)
+
+# Снимок метрик воркера в METRICS_DIR, чтобы их видел воркер, отвечающий на /metrics
+def metrics_snapshot_path() -> str:
+    return os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+
+def write_metrics_snapshot():
+    temp_path = metrics_snapshot_path() + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(metrics.snapshot(), f)
+    os.replace(temp_path, metrics_snapshot_path())
+
+def remove_metrics_snapshot():
+    try:
+        os.remove(metrics_snapshot_path())
+    except FileNotFoundError:
+        pass
+
+# Снимки других воркеров. Давно не обновлявшиеся снимки остались от завершившихся воркеров и
+# не учитываются: их счетчики пропадают из суммы, что Prometheus воспринимает как сброс счетчика.
+def read_metrics_snapshots() -> list:
+    snapshots = []
+    expired = time.time() - 3 * METRICS_FLUSH_INTERVAL
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith(".json") or name == os.path.basename(metrics_snapshot_path()):
+            continue
+        try:
+            if os.path.getmtime(os.path.join(METRICS_DIR, name)) < expired:
+                continue
+            with open(os.path.join(METRICS_DIR, name), "r") as f:
+                snapshots.append(json.load(f))
+        except (FileNotFoundError, ValueError):
+            continue
+    return snapshots
+
+async def metrics_flush_loop():
+    while True:
+        try:
+            await run_in_threadpool(write_metrics_snapshot)
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении метрик воркера: {e}")
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+
+# Метрики сервера для Prometheus (сумма по всем воркерам)
+@app.get("/metrics")
+async def get_metrics(username: str = Depends(authenticate)):
+    await run_in_threadpool(update_storage_metrics)
+    snapshots = await run_in_threadpool(read_metrics_snapshots)
+    return Response(content=metrics.render(snapshots), media_type="text/plain; version=0.0.4; charset=utf-8")
 
-# Удаление бэкапа
+# Удаление бэкапа из хранилища. Возвращает способ хранения удаленного бэкапа или None, если его нет.
+# Чанки бэкапа из чанков удаляет сборщик мусора, когда на них не остается ссылок.
+def remove_backup_files(filename: str) -> Optional[str]:
+    if os.path.exists(checksum_path(filename)):
+        os.remove(checksum_path(filename))
+    if os.path.exists(manifest_path(filename)):
+        os.remove(manifest_path(filename))
+        return "chunked"
+    if STORAGE.delete(backup_key(filename)):
+        return "file"
+    return None
+
+# Удаление бэкапа (для бэкапа из чанков — манифест и чанки, на которые больше никто не ссылается)
 @app.delete("/delete/{filename}")
 async def delete_backup(filename: str, username: str = Depends(authenticate)):
-    backup_path = os.path.join(SERVER_BACKUP_DIR, filename)
-    if not os.path.exists(backup_path):
+    layout = await run_in_threadpool(remove_backup_files, filename)
+    if layout is None:
         raise HTTPException(status_code=404, detail="File not found")
-    os.remove(backup_path)
+    if layout == "chunked":
+        await run_in_threadpool(collect_garbage_chunks)
+    await run_in_threadpool(catalog.remove, filename)
     logging.info(f"Бэкап {filename} удален с сервера")
-    return JSONResponse(content={"message": "Backup deleted successfully"})
\ No newline at end of file
+    return JSONResponse(content={"message": "Backup deleted successfully"})
+
+# Политика хранения пользователя: общая ("default"), дополненная личной ("users"). None — хранить все.
+def retention_policy(username: str) -> Optional[dict]:
+    policy = dict(RETENTION.get("default", {}))
+    policy.update(RETENTION.get("users", {}).get(username, {}))
+    return policy if any(policy.get(key) for key in ("last", "max_bytes") + RETENTION_PERIODS) else None
+
+# Ключ периода для отбора "один бэкап на период" (местное время, как в имени бэкапа)
+def retention_period(period: str, timestamp: int):
+    moment = datetime.fromtimestamp(timestamp)
+    if period == "daily":
+        return moment.date()
+    if period == "weekly":
+        return moment.isocalendar()[:2]
+    return moment.year, moment.month
+
+# Бэкапы, которые нужно оставить, вместе с цепочками, от которых зависят инкрементальные бэкапы
+def retention_closure(selected: dict, by_name: dict) -> dict:
+    keep = {name: list(reasons) for name, reasons in selected.items()}
+    for name in selected:
+        parent = by_name[name].get("parent")
+        while parent in by_name and "chain" not in keep.setdefault(parent, []):
+            keep[parent].append("chain")
+            parent = by_name[parent].get("parent")
+    return keep
+
+# Разбор бэкапов одного пользователя (новые первыми) по политике: последний бэкап остается всегда,
+# из каждого дня/недели/месяца — самый новый бэкап, пока не набрано нужное число периодов.
+# Если оставленные бэкапы превышают max_bytes, отбрасываются самые старые из отобранных.
+def plan_retention(backups: List[dict], policy: dict) -> dict:
+    by_name = {backup["name"]: backup for backup in backups}
+    selected = {}
+    for backup in backups[:max(1, policy.get("last", 0))]:
+        selected[backup["name"]] = ["last"]
+    for period in RETENTION_PERIODS:
+        count = policy.get(period, 0)
+        seen = set()
+        for backup in backups:
+            if len(seen) >= count:
+                break
+            key = retention_period(period, backup["timestamp"])
+            if key not in seen:
+                seen.add(key)
+                selected.setdefault(backup["name"], []).append(period)
+    keep = retention_closure(selected, by_name)
+
+    max_bytes = policy.get("max_bytes", 0)
+    over_quota = set()
+    roots = sorted(selected, key=lambda name: by_name[name]["timestamp"])
+    while max_bytes and len(roots) > 1 and sum(by_name[name]["size"] or 0 for name in keep) > max_bytes:
+        dropped = roots.pop(0)
+        over_quota.add(dropped)
+        keep = retention_closure({name: selected[name] for name in roots}, by_name)
+
+    delete = [
+        {"name": backup["name"], "size": backup["size"] or 0, "reason": "quota" if backup["name"] in over_quota else "policy"}
+        for backup in backups if backup["name"] not in keep
+    ]
+    return {
+        "keep": [{"name": backup["name"], "reasons": keep[backup["name"]]} for backup in backups if backup["name"] in keep],
+        "delete": delete,
+        "freed_bytes": sum(item["size"] for item in delete),
+    }
+
+# Удаление пачки бэкапов: файлы с диска, записи из каталога одной транзакцией
+def prune_batch(names: List[str]) -> bool:
+    removed, chunked = [], False
+    for name in names:
+        try:
+            layout = remove_backup_files(name)
+        except OSError as e:
+            logging.error(f"Не удалось удалить бэкап {name}: {e}")
+            continue
+        removed.append(name)
+        chunked = chunked or layout == "chunked"
+    catalog.remove_many(removed)
+    return chunked
+
+# Применение политик хранения ко всем пользователям. В режиме dry_run ничего не удаляется,
+# возвращается только отчет: что осталось бы (и почему) и что было бы удалено.
+def apply_retention(dry_run: bool = False, users: Optional[List[str]] = None) -> dict:
+    report = {"dry_run": dry_run, "users": {}, "deleted": 0, "freed_bytes": 0}
+    to_delete = []
+    for username in users or catalog.users():
+        policy = retention_policy(username)
+        if policy is None:
+            continue
+        plan = plan_retention(catalog.user_backups(username), policy)
+        report["users"][username] = plan
+        report["deleted"] += len(plan["delete"])
+        report["freed_bytes"] += plan["freed_bytes"]
+        to_delete.extend(plan["delete"])
+    if dry_run or not to_delete:
+        return report
+
+    chunked = False
+    for start in range(0, len(to_delete), RETENTION_BATCH_SIZE):
+        batch = to_delete[start:start + RETENTION_BATCH_SIZE]
+        chunked = prune_batch([item["name"] for item in batch]) or chunked
+        metrics.inc("mini_backup_retention_deleted_total", len(batch))
+        metrics.inc("mini_backup_retention_freed_bytes_total", sum(item["size"] for item in batch))
+    if chunked:
+        collect_garbage_chunks()
+    logging.info(
+        f"Политика хранения: удалено {report['deleted']} бэкапов, освобождено {report['freed_bytes']} байт"
+    )
+    return report
+
+# Периодическая очистка по политикам хранения (фоновая задача сервера)
+async def retention_loop():
+    dry_run = RETENTION.get("dry_run", False)
+    while True:
+        try:
+            report = await run_in_threadpool(apply_retention, dry_run)
+            if dry_run and report["deleted"]:
+                logging.info(
+                    f"Политика хранения (пробный запуск): к удалению {report['deleted']} бэкапов, "
+                    f"{report['freed_bytes']} байт"
+                )
+        except Exception as e:
+            logging.error(f"Ошибка при очистке по политике хранения: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+# Пользователи, для которых вызывающий может смотреть и применять политику хранения: администраторы
+# (retention.admins) — для всех или для указанного user, остальные — только для себя
+def retention_scope(username: str, user: Optional[str]) -> Optional[List[str]]:
+    if username in RETENTION.get("admins", []):
+        return [user] if user else None
+    if user and user != username:
+        raise HTTPException(status_code=403, detail="Retention of other users' backups requires an admin")
+    return [username]
+
+# Отчет о политике хранения без удаления: что будет оставлено и удалено при следующем запуске
+@app.get("/retention")
+async def retention_report(user: Optional[str] = None, username: str = Depends(authenticate)):
+    report = await run_in_threadpool(apply_retention, True, retention_scope(username, user))
+    return JSONResponse(content=report)
+
+# Немедленный запуск очистки по политике хранения. По умолчанию dry_run берется из конфигурации
+# (только отчет, если там не сказано иное); удалять можно, только если политика включена (retention.enabled).
+@app.post("/retention/run")
+async def run_retention(
+    dry_run: Optional[bool] = None, user: Optional[str] = None, username: str = Depends(authenticate)
+):
+    if dry_run is None:
+        dry_run = RETENTION.get("dry_run", True)
+    if not dry_run and not RETENTION.get("enabled"):
+        raise HTTPException(status_code=409, detail="Retention is disabled on the server")
+    report = await run_in_threadpool(apply_retention, dry_run, retention_scope(username, user))
+    return JSONResponse(content=report)
+
+# Чтение бэкапа с сервера целиком с подсчетом SHA-256. rate — ограничение скорости чтения
+# в байт/с (0 — без ограничения). Для бэкапа из чанков хэшируются чанки подряд, как при скачивании.
+def hash_backup(filename: str, rate: float = 0) -> str:
+    if os.path.exists(manifest_path(filename)):
+        manifest = load_manifest(filename)
+        blocks = iter_chunked_range(manifest, 0, manifest["size"] - 1)
+    else:
+        info = STORAGE.stat(backup_key(filename))
+        if info is None:
+            raise FileNotFoundError(filename)
+        blocks = STORAGE.read(info.key, 0, info.size - 1)
+    digest = hashlib.sha256()
+    started = time.monotonic()
+    total = 0
+    for block in blocks:
+        digest.update(block)
+        total += len(block)
+        metrics.inc("mini_backup_scrub_bytes_total", len(block))
+        if rate:
+            ahead = total / rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    return digest.hexdigest()
+
+# SHA-256, которую клиент сообщил при записи бэкапа из чанков (еще не проверенная сервером)
+def pending_sha256(filename: str) -> Optional[str]:
+    try:
+        return load_manifest(filename).get("client_sha256")
+    except FileNotFoundError:
+        return None
+
+# Проверка целостности одного бэкапа: сохраненные данные перечитываются и сравниваются с контрольной
+# суммой из каталога или файла рядом с бэкапом. У бэкапов без суммы (старых и записанных из чанков)
+# первая проверка задает эталон; если она расходится с суммой, которую сообщил клиент, бэкап помечается
+# client_mismatch, но эталоном все равно становятся данные сервера — чанки проверены по их id.
+def verify_stored_backup(filename: str, rate: float = 0) -> Optional[dict]:
+    record = catalog.get(filename)
+    if record is None:
+        return None
+    expected = record["sha256"] or read_checksum(filename)
+    pending = pending_sha256(filename) if expected is None and record["layout"] == "chunked" else None
+    try:
+        actual = hash_backup(filename, rate)
+    except FileNotFoundError:
+        actual, integrity = None, "missing"
+    else:
+        integrity = "ok" if expected in (None, actual) else "corrupt"
+        if integrity == "ok" and read_checksum(filename) is None:
+            write_checksum(filename, actual)
+        if pending not in (None, actual):
+            integrity = "client_mismatch"
+    catalog.mark_verified(filename, integrity, actual if expected is None else None)
+    if integrity == "ok":
+        logging.info(f"Бэкап {filename} проверен: sha256 {actual}")
+    else:
+        logging.error(
+            f"Бэкап {filename} поврежден ({integrity}): ожидался sha256 {expected or pending}, получен {actual}"
+        )
+    return {"name": filename, "sha256": expected or actual, "actual_sha256": actual, "integrity": integrity}
+
+# Фоновая проверка целостности: по одному бэкапу, давно не проверенные первыми
+async def scrub_loop():
+    while True:
+        try:
+            name = await run_in_threadpool(catalog.next_to_scrub, int(time.time()) - SCRUB_INTERVAL)
+            if name:
+                await run_in_threadpool(verify_stored_backup, name, SCRUB_RATE)
+                continue
+        except Exception as e:
+            logging.error(f"Ошибка при проверке целостности бэкапов: {e}")
+        await asyncio.sleep(SCRUB_IDLE)
+
+# Проверка целостности бэкапа по запросу клиента: сервер перечитывает данные сам, скачивать ничего не нужно
+@app.post("/verify/{filename}")
+async def verify_backup(filename: str, username: str = Depends(authenticate)):
+    result = await run_in_threadpool(verify_stored_backup, filename, SCRUB.get("verify_rate", 0))
+    if result is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return JSONResponse(content=result)
@@ -0,0 +1,366 @@
+from abc import ABC, abstractmethod
+from collections import namedtuple
+import errno
+import hashlib
+import os
+import secrets
+import shutil
+from typing import Iterator, List, Optional
+
+try:
+    import boto3  # Необязательная зависимость для хранилища S3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+# Хранилища данных бэкапов для сервера. Объекты адресуются ключами вида "<пространство>/<имя>"
+# ("backups/backup_..._user.zip", "chunks/<sha256>"). Метаданные (каталог, манифесты, контрольные
+# суммы, сессии загрузки) хранилище не касаются и остаются в server_backup_dir.
+
+ObjectInfo = namedtuple("ObjectInfo", "key size mtime")
+
+READ_BLOCK_SIZE = 1024 * 1024
+S3_MIN_PART_SIZE = 5 * 1024 * 1024  # Минимальный размер части multipart-загрузки S3 (кроме последней)
+
+# Запись файла через временный файл рядом с итоговым: под своим именем файл появляется
+# только после commit, при abort временный файл удаляется
+class FileWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.temp_path = f"{path}.{secrets.token_hex(4)}.part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(self.temp_path, "wb")
+
+    def write(self, data: bytes):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+# Чтение диапазона [start, end] файла блоками
+def iter_file_range(path: str, start: int, end: int, block_size: int = READ_BLOCK_SIZE):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(block_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+# Общий интерфейс хранилища. open_write возвращает объект с методами write, commit и abort:
+# записываемый объект не виден под своим ключом до commit.
+class StorageBackend(ABC):
+    @abstractmethod
+    def open_write(self, key: str):
+        pass
+
+    # Чтение диапазона [start, end] объекта блоками; FileNotFoundError, если объекта нет
+    @abstractmethod
+    def read(self, key: str, start: int, end: int) -> Iterator[bytes]:
+        pass
+
+    @abstractmethod
+    def stat(self, key: str) -> Optional[ObjectInfo]:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def list(self, prefix: str) -> Iterator[ObjectInfo]:
+        pass
+
+    # Обновление времени изменения объекта (защита от сборщика мусора); False, если объекта нет
+    @abstractmethod
+    def touch(self, key: str) -> bool:
+        pass
+
+    # Перенос готового локального файла в хранилище (файл после этого удаляется)
+    def put_file(self, key: str, path: str):
+        writer = self.open_write(key)
+        try:
+            with open(path, "rb") as f:
+                while True:
+                    data = f.read(READ_BLOCK_SIZE)
+                    if not data:
+                        break
+                    writer.write(data)
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        os.remove(path)
+
+    # Свободное место в байтах или None, если хранилище его не сообщает
+    def free_space(self) -> Optional[int]:
+        return None
+
+    # Путь к объекту в локальной файловой системе или None (объекта нет или хранилище не локальное)
+    def local_path(self, key: str) -> Optional[str]:
+        return None
+
+# Локальное хранилище на одном или нескольких дисках (точках монтирования). Диск для объекта выбирается
+# по хэшу ключа (rendezvous hashing): добавление диска переносит на него только часть новых объектов,
+# а уже записанные находятся перебором дисков в том же порядке. Диски, на которых осталось меньше
+# min_free байт, пропускаются при записи. Внутри диска объекты раскладываются по подкаталогам
+# из первых символов SHA-256 имени (shard_depth уровней), чтобы в одном каталоге не было миллионов файлов.
+class LocalStorage(StorageBackend):
+    def __init__(self, paths: List[str], shard_depth: int = 2, min_free: int = 0):
+        if not paths:
+            raise ValueError("Для локального хранилища нужен хотя бы один каталог")
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.shard_depth = shard_depth
+        self.min_free = min_free
+        for path in self.paths:
+            os.makedirs(path, exist_ok=True)
+
+    def _relative(self, key: str) -> str:
+        namespace, _, name = key.partition("/")
+        digest = hashlib.sha256(name.encode()).hexdigest()
+        shards = [digest[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+        return os.path.join(namespace, *shards, name)
+
+    # Диски в порядке предпочтения для ключа
+    def _order(self, key: str) -> List[str]:
+        return sorted(self.paths, key=lambda path: hashlib.sha256(f"{path}\0{key}".encode()).digest(), reverse=True)
+
+    def _find(self, key: str) -> Optional[str]:
+        relative = self._relative(key)
+        for root in self._order(key):
+            path = os.path.join(root, relative)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    # Куда писать объект: туда, где он уже есть, иначе на первый по порядку диск с достаточным местом,
+    # а если места мало везде — на диск с наибольшим свободным местом
+    def _target(self, key: str) -> str:
+        existing = self._find(key)
+        if existing:
+            return existing
+        order = self._order(key)
+        root = order[0]
+        if self.min_free and len(order) > 1:
+            free = {path: shutil.disk_usage(path).free for path in order}
+            root = next((path for path in order if free[path] >= self.min_free), max(order, key=free.get))
+        return os.path.join(root, self._relative(key))
+
+    def open_write(self, key: str) -> FileWriter:
+        return FileWriter(self._target(key))
+
+    def read(self, key: str, start: int, end: int) -> Iterator[bytes]:
+        path = self._find(key)
+        if path is None:
+            raise FileNotFoundError(key)
+        return iter_file_range(path, start, end)
+
+    def stat(self, key: str) -> Optional[ObjectInfo]:
+        path = self._find(key)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return ObjectInfo(key, stat.st_size, stat.st_mtime)
+
+    def delete(self, key: str) -> bool:
+        relative = self._relative(key)
+        removed = False
+        for root in self.paths:
+            try:
+                os.remove(os.path.join(root, relative))
+                removed = True
+            except FileNotFoundError:
+                continue
+        return removed
+
+    def list(self, prefix: str) -> Iterator[ObjectInfo]:
+        namespace, _, name_prefix = prefix.partition("/")
+        seen = set()
+        for root in self.paths:
+            for directory, dirs, files in os.walk(os.path.join(root, namespace)):
+                for name in files:
+                    if name.endswith(".part") or not name.startswith(name_prefix) or name in seen:
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        continue
+                    seen.add(name)
+                    yield ObjectInfo(f"{namespace}/{name}", stat.st_size, stat.st_mtime)
+
+    def touch(self, key: str) -> bool:
+        path = self._find(key)
+        if path is None:
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    # В пределах одной файловой системы файл просто переименовывается
+    def put_file(self, key: str, path: str):
+        target = self._target(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            super().put_file(key, path)
+
+    # Сумма свободного места по дискам (каталоги на одном устройстве учитываются один раз)
+    def free_space(self) -> Optional[int]:
+        devices = {}
+        for path in self.paths:
+            devices.setdefault(os.stat(path).st_dev, shutil.disk_usage(path).free)
+        return sum(devices.values())
+
+    def local_path(self, key: str) -> Optional[str]:
+        return self._find(key)
+
+# Запись объекта в S3: данные копятся до part_size и уходят частями multipart-загрузки.
+# Объект меньше одной части записывается одним PutObject. До commit объект в бакете не виден.
+class S3Writer:
+    def __init__(self, client, bucket: str, key: str, part_size: int):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    def _upload_part(self, data: bytes):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+        number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data
+        )
+        self.parts.append({"PartNumber": number, "ETag": response["ETag"]})
+
+    def write(self, data: bytes):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def commit(self):
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            return
+        if self.buffer:
+            self._upload_part(bytes(self.buffer))
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": self.parts}
+        )
+
+    def abort(self):
+        self.buffer.clear()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+def _is_not_found(error) -> bool:
+    return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+# Хранилище в S3-совместимом объектном хранилище (AWS S3, MinIO, Ceph RGW). Ключи объектов
+# получают общий префикс prefix, так что в одном бакете могут жить несколько серверов.
+class S3Storage(StorageBackend):
+    def __init__(self, bucket: str, prefix: str = "", part_size: int = 8 * 1024 * 1024, client=None, **client_options):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, S3_MIN_PART_SIZE)
+        self.client = client or boto3.client("s3", **client_options)
+
+    def open_write(self, key: str) -> S3Writer:
+        return S3Writer(self.client, self.bucket, self.prefix + key, self.part_size)
+
+    # Запрос к S3 выполняется при первом обращении к итератору, а не при вызове read
+    def read(self, key: str, start: int, end: int) -> Iterator[bytes]:
+        if end < start:  # Пустой объект или пустой диапазон: S3 не принимает такой Range
+            if self.stat(key) is None:
+                raise FileNotFoundError(key)
+            return
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key, Range=f"bytes={start}-{end}")
+        except ClientError as e:
+            if _is_not_found(e):
+                raise FileNotFoundError(key)
+            raise
+        body = response["Body"]
+        try:
+            yield from body.iter_chunks(READ_BLOCK_SIZE)
+        finally:
+            body.close()
+
+    def stat(self, key: str) -> Optional[ObjectInfo]:
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if _is_not_found(e):
+                return None
+            raise
+        return ObjectInfo(key, response["ContentLength"], response["LastModified"].timestamp())
+
+    def delete(self, key: str) -> bool:
+        if self.stat(key) is None:
+            return False
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+        return True
+
+    def list(self, prefix: str) -> Iterator[ObjectInfo]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for item in page.get("Contents", []):
+                yield ObjectInfo(item["Key"][len(self.prefix):], item["Size"], item["LastModified"].timestamp())
+
+    # В S3 время изменения обновляется копированием объекта в самого себя с заменой метаданных
+    def touch(self, key: str) -> bool:
+        try:
+            self.client.copy_object(
+                Bucket=self.bucket, Key=self.prefix + key, MetadataDirective="REPLACE",
+                CopySource={"Bucket": self.bucket, "Key": self.prefix + key},
+            )
+        except ClientError as e:
+            if _is_not_found(e):
+                return False
+            raise
+        return True
+
+# Создание хранилища по секции "storage" конфигурации сервера. Без настроек — локальное хранилище
+# в default_dir. Для S3: {"type": "s3", "bucket", "prefix", "endpoint_url" (для MinIO и других
+# совместимых хранилищ), "region", "access_key", "secret_key", "part_size"}; ключи доступа можно
+# не указывать — тогда boto3 берет их из окружения.
+def open_storage(config: dict, default_dir: str) -> StorageBackend:
+    kind = config.get("type", "local")
+    if kind == "local":
+        return LocalStorage(config.get("paths") or [default_dir], config.get("shard_depth", 2), config.get("min_free", 0))
+    if kind == "s3":
+        if boto3 is None:
+            raise ValueError("Для хранилища S3 установите пакет boto3")
+        client_options = {
+            "endpoint_url": config.get("endpoint_url"),
+            "region_name": config.get("region"),
+            "aws_access_key_id": config.get("access_key"),
+            "aws_secret_access_key": config.get("secret_key"),
+        }
+        return S3Storage(
+            config["bucket"], config.get("prefix", ""), config.get("part_size", 8 * 1024 * 1024),
+            **{name: value for name, value in client_options.items() if value is not None}
+        )
+    raise ValueError(f"Неизвестный тип хранилища: {kind}")
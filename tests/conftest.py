@@ -0,0 +1,50 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+
+# Модули проекта лежат в корне репозитория (main.py, server.py, storage.py)
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+TEST_USER, TEST_PASSWORD = "tester", "tester_password"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Сервер (uvicorn server:app) в отдельном процессе со своим каталогом бэкапов: (адрес, имя, пароль)
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    pytest.importorskip("uvicorn")
+    server_dir = tmp_path_factory.mktemp("server")
+    with open(server_dir / "server-config.json", "w") as f:
+        json.dump({"server_backup_dir": "backups", "users": {TEST_USER: TEST_PASSWORD}}, f)
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--app-dir", REPO_DIR, "--port", str(port),
+         "--log-level", "warning"],
+        cwd=server_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"{url}/list", auth=(TEST_USER, TEST_PASSWORD), timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            pytest.fail("Тестовый сервер не запустился")
+        yield url, TEST_USER, TEST_PASSWORD
+    finally:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,91 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+import main
+
+BLOCK_SIZE = 64 * 1024
+
+
+def make_source(root):
+    files = {
+        "text/readme.txt": b"mini-backup " * 20000,  # Сжимаемый, несколько блоков
+        "text/empty.txt": b"",
+        "bin/random.bin": os.urandom(3 * BLOCK_SIZE + 123),  # Несжимаемый
+        "photo.jpg": os.urandom(5000),  # Несжимаемый по расширению
+        "nested/deep/dir/small.cfg": b"key=value\n",
+    }
+    for name, data in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    return files
+
+
+def make_sparse(path, size, data_at):
+    with open(path, "wb") as f:
+        f.truncate(size)
+        for offset, data in data_at.items():
+            f.seek(offset)
+            f.write(data)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def archive(source, compression):
+    out = io.BytesIO()
+    report = main.RunReport()
+    main.write_archive(str(source), out, dict(compression, block_size=BLOCK_SIZE, workers=4), report=report)
+    out.seek(0)
+    return zipfile.ZipFile(out), report
+
+
+@pytest.mark.parametrize("compression", [
+    {"codec": "deflate"},
+    {"codec": "deflate", "level": 1, "adaptive": False},
+    {"codec": "store"},
+])
+def test_archive_readable_by_zipfile(tmp_path, compression):
+    files = make_source(tmp_path / "src")
+    zipf, _ = archive(tmp_path / "src", compression)
+    assert zipf.testzip() is None
+    assert sorted(zipf.namelist()) == sorted(files)
+    for name, data in files.items():
+        assert zipf.read(name) == data
+
+
+def test_adaptive_compression_stores_incompressible_files(tmp_path):
+    make_source(tmp_path / "src")
+    zipf, report = archive(tmp_path / "src", {"codec": "deflate"})
+    assert zipf.getinfo("photo.jpg").compress_type == zipfile.ZIP_STORED
+    assert zipf.getinfo("text/readme.txt").compress_type == zipfile.ZIP_DEFLATED
+    assert report.stages["compress"]["stored_files"] >= 1
+    info = zipf.getinfo("bin/random.bin")  # Несжимаемые данные не раздуваются
+    assert info.compress_size <= info.file_size * 1.01
+
+
+def test_sparse_file_round_trip(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    size = 16 * BLOCK_SIZE + 100
+    data = make_sparse(source / "disk.img", size, {0: b"head" * 100, 9 * BLOCK_SIZE + 7: b"middle", size - 4: b"tail"})
+    if os.stat(source / "disk.img").st_blocks * 512 >= size:
+        pytest.skip("Файловая система не поддерживает разреженные файлы")
+    for compression in ({"codec": "deflate"}, {"codec": "store"}):
+        zipf, report = archive(source, compression)
+        assert zipf.read("disk.img") == data
+        assert report.stages["read"].get("sparse_bytes", 0) >= 10 * BLOCK_SIZE
+
+
+def test_create_backup_encrypted_round_trip(tmp_path):
+    files = make_source(tmp_path / "src")
+    key = main.Fernet.generate_key()
+    report = main.RunReport()
+    backup = main.create_backup(str(tmp_path / "src"), str(tmp_path / "out"), key, 4096, report=report)
+    assert report.fields["sha256"] == main.file_sha256(backup)
+    decrypted = main.decrypt_file(backup, key)
+    with zipfile.ZipFile(decrypted) as zipf:
+        for name, data in files.items():
+            assert zipf.read(name) == data
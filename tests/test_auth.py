@@ -0,0 +1,19 @@
+import main
+
+
+def test_revoked_token_is_replaced_and_request_resent(server):
+    url, username, password = server
+    session = main.create_http_session(url, username, password)
+    assert session.get(f"{url}/list").status_code == 200
+    auth = session.auth
+    valid = auth.token
+    assert valid
+
+    # Токен, который сервер больше не принимает (например, после смены секрета)
+    revoked = auth.token = valid[:-4] + ("AAAA" if not valid.endswith("AAAA") else "BBBB")
+    response = session.put(f"{url}/uploads/{'0' * 32}/parts/0", data=b"part")
+    assert response.status_code == 404  # Повтор с новым токеном дошел до проверки сессии
+    assert [r.status_code for r in response.history] == [401]
+    assert auth.token and auth.token != revoked
+    session.close()
+
@@ -0,0 +1,87 @@
+import io
+import random
+
+import pytest
+import requests
+from cryptography.exceptions import InvalidTag
+
+import main
+
+
+@pytest.fixture
+def key():
+    return main.Fernet.generate_key()
+
+
+def test_chunk_sealing_round_trip_and_tamper(key):
+    sealer = main.ChunkSealer(key)
+    sealed = [sealer.seal(b"first chunk"), sealer.seal(b"second chunk")]
+    assert sealer.seal(b"first chunk") == sealed[0]  # Детерминированно, для дедупликации
+    out = io.BytesIO()
+    main.decrypt_chunk_stream(io.BytesIO(b"".join(sealed)), out, key)
+    assert out.getvalue() == b"first chunksecond chunk"
+
+    tampered = bytearray(sealed[0])
+    tampered[-1] ^= 1
+    with pytest.raises(InvalidTag):
+        main.decrypt_chunk_stream(io.BytesIO(bytes(tampered)), io.BytesIO(), key)
+    with pytest.raises(ValueError):
+        main.decrypt_chunk_stream(io.BytesIO(sealed[0][:-3]), io.BytesIO(), key)
+
+
+def test_chunked_backup_checksum_is_set_by_first_verification(tmp_path, server):
+    url, username, password = server
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "data.txt").write_bytes(b"dedup " * 50000)
+    config = {"source_dir": str(source), "server_url": url, "username": username, "password": password}
+    report = main.RunReport()
+    name = main.dedup_backup(config, None, 946684802, report=report)
+    assert name
+
+    result = requests.post(f"{url}/verify/{name}", auth=(username, password)).json()
+    assert result["integrity"] == "ok" and result["sha256"] == report.fields["sha256"]
+
+    # Неверная сумма от клиента не отклоняет запись, но первая проверка ее обнаруживает
+    chunks = requests.get(f"{url}/chunked-backups/{name}", auth=(username, password)).json()["chunks"]
+    response = requests.post(
+        f"{url}/chunked-backups", auth=(username, password),
+        json={"client_timestamp": 946684803, "chunks": chunks, "sha256": "0" * 64},
+    )
+    assert response.status_code == 200
+    other = response.json()["path"].rsplit("/", 1)[-1]
+    result = requests.post(f"{url}/verify/{other}", auth=(username, password)).json()
+    assert result["integrity"] == "client_mismatch" and result["actual_sha256"] == report.fields["sha256"]
+    result = requests.post(f"{url}/verify/{other}", auth=(username, password)).json()
+    assert result["integrity"] == "ok"
+
+
+def split_chunks(data, min_size, max_size):
+    return list(main.iter_content_chunks((data[i:i + 100000] for i in range(0, len(data), 100000)), min_size, max_size))
+
+
+def low_entropy_data(size, seed=1):
+    # Текстовые записи и нулевые страницы, как в несжатой базе: в таких данных нет якоря DEDUP_ANCHOR
+    rng = random.Random(seed)
+    out = bytearray()
+    while len(out) < size:
+        for _ in range(100):
+            out += b"id=%d;user=user%d;ts=%d;action=%s\n" % (
+                rng.randrange(10 ** 6), rng.randrange(500), 1700000000 + rng.randrange(10 ** 6),
+                rng.choice((b"allow", b"deny", b"login")),
+            )
+        out += bytes(rng.choice((0, 4096, 8192)))
+    return bytes(out[:size])
+
+
+def test_boundaries_resync_after_insert_into_low_entropy_data():
+    min_size, max_size = 16 * 1024, 128 * 1024
+    data = low_entropy_data(4 * 1024 * 1024)
+    assert main.DEDUP_ANCHOR not in data
+    original = split_chunks(data, min_size, max_size)
+    assert b"".join(original) == data
+    assert all(min_size <= len(chunk) <= max_size for chunk in original[:-1])
+
+    changed = split_chunks(data[:1000] + b"inserted bytes" + data[1000:], min_size, max_size)
+    shared = set(original) & set(changed)
+    assert len(shared) >= len(original) - 3  # Изменились только чанки около вставки
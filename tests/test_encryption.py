@@ -0,0 +1,86 @@
+import io
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+import main
+from main import STREAM_HEADER, STREAM_TAG_SIZE
+
+CHUNK_SIZE = 1024
+
+
+@pytest.fixture
+def key():
+    return main.Fernet.generate_key()
+
+
+def encrypt(data, key, chunk_size=CHUNK_SIZE):
+    out = io.BytesIO()
+    with main.EncryptingWriter(out, key, chunk_size) as writer:
+        for start in range(0, len(data), 300):  # Запись порциями, не совпадающими с чанками
+            writer.write(data[start:start + 300])
+    return out.getvalue()
+
+
+def decrypt(blob, key):
+    out = io.BytesIO()
+    main.decrypt_stream(io.BytesIO(blob), out, key)
+    return out.getvalue()
+
+
+def split_chunks(blob):
+    body = blob[STREAM_HEADER.size:]
+    size = CHUNK_SIZE + STREAM_TAG_SIZE
+    return blob[:STREAM_HEADER.size], [body[i:i + size] for i in range(0, len(body), size)]
+
+
+@pytest.mark.parametrize("length", [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 5 * CHUNK_SIZE + 17])
+def test_stream_round_trip(key, length):
+    data = bytes(range(256)) * (length // 256) + bytes(length % 256)
+    assert decrypt(encrypt(data, key), key) == data
+
+
+def test_file_round_trip(tmp_path, key):
+    path = tmp_path / "backup.zip"
+    data = b"backup data" * 10000
+    path.write_bytes(data)
+    encrypted = main.encrypt_file(str(path), key, CHUNK_SIZE)
+    assert main.is_stream_encrypted(encrypted)
+    decrypted = main.decrypt_file(encrypted, key, str(tmp_path / "restored.zip"))
+    with open(decrypted, "rb") as f:
+        assert f.read() == data
+
+
+def test_wrong_key_is_rejected(key):
+    blob = encrypt(b"secret" * 1000, key)
+    with pytest.raises(InvalidTag):
+        decrypt(blob, main.Fernet.generate_key())
+
+
+def test_truncation_at_chunk_boundary_is_detected(key):
+    header, chunks = split_chunks(encrypt(b"x" * (4 * CHUNK_SIZE + 10), key))
+    with pytest.raises(InvalidTag):  # Последний оставшийся чанк не помечен как последний
+        decrypt(header + b"".join(chunks[:2]), key)
+
+
+def test_truncation_inside_chunk_is_detected(key):
+    blob = encrypt(b"x" * (4 * CHUNK_SIZE + 10), key)
+    with pytest.raises((InvalidTag, ValueError)):
+        decrypt(blob[:-5], key)
+    with pytest.raises(ValueError):
+        decrypt(blob[:STREAM_HEADER.size - 1], key)
+
+
+def test_reordered_chunks_are_detected(key):
+    header, chunks = split_chunks(encrypt(bytes(range(256)) * 20, key))
+    chunks[0], chunks[1] = chunks[1], chunks[0]
+    with pytest.raises(InvalidTag):
+        decrypt(header + b"".join(chunks), key)
+
+
+def test_modified_header_is_detected(key):
+    blob = bytearray(encrypt(b"x" * 3000, key))
+    blob[STREAM_HEADER.size - 1] ^= 1  # Последний байт префикса nonce
+    with pytest.raises(InvalidTag):
+        decrypt(bytes(blob), key)
+
@@ -0,0 +1,67 @@
+import json
+import os
+import zipfile
+
+import main
+
+
+def run_backup(config, timestamp, backup_name):
+    plan = main.prepare_backup_plan(config, timestamp)
+    path = main.create_backup(config["source_dir"], config["backup_dir"], plan=plan)
+    main.commit_backup_plan(config, plan, backup_name)
+    with zipfile.ZipFile(path) as zipf:
+        manifest = main.read_archive_manifest(zipf)
+        names = set(zipf.namelist()) - {main.MANIFEST_ARCNAME}
+    os.remove(path)
+    return manifest, names
+
+
+def test_incremental_chain(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "keep.txt").write_text("unchanged")
+    (source / "edit.txt").write_text("v1")
+    (source / "remove.txt").write_text("gone soon")
+    config = {
+        "source_dir": str(source),
+        "backup_dir": str(tmp_path / "backups"),
+        "incremental": {"enabled": True},
+        "schedule": {"full_every": 3},
+    }
+
+    manifest, names = run_backup(config, 1000, "b1")
+    assert manifest["kind"] == "full" and manifest["chain"] == []
+    assert names == {"keep.txt", "edit.txt", "remove.txt"}
+
+    (source / "edit.txt").write_text("version 2")
+    (source / "remove.txt").unlink()
+    (source / "new.txt").write_text("added")
+    manifest, names = run_backup(config, 2000, "b2")
+    assert manifest["kind"] == "incremental" and manifest["chain"] == ["b1"]
+    assert names == {"edit.txt", "new.txt"}
+    assert sorted(manifest["changed"]) == ["edit.txt", "new.txt"]
+    assert manifest["deleted"] == ["remove.txt"]
+    assert set(manifest["files"]) == {"keep.txt", "edit.txt", "new.txt"}
+    assert all("sha256" in manifest["files"][name] for name in names)
+
+    manifest, names = run_backup(config, 3000, "b3")  # Ничего не изменилось
+    assert manifest["kind"] == "incremental" and manifest["chain"] == ["b1", "b2"]
+    assert names == set() and manifest["changed"] == [] and manifest["deleted"] == []
+
+    manifest, names = run_backup(config, 4000, "b4")  # Цепочка достигла full_every
+    assert manifest["kind"] == "full"
+    assert names == {"keep.txt", "edit.txt", "new.txt"}
+    with open(main.manifest_path(config), encoding="utf-8") as f:
+        assert json.load(f)["chain"] == ["b4"]
+
+
+def test_plan_reset_discards_partial_walk(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "a.txt").write_text("a")
+    plan = main.BackupPlan("full", {}, [], 1000)
+    st = os.stat(source / "a.txt")
+    plan.include("a.txt", st)
+    plan.reset()
+    plan.include("a.txt", st)
+    assert plan.changed == ["a.txt"]
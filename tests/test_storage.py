@@ -0,0 +1,110 @@
+import os
+import time
+
+import pytest
+
+import storage
+from storage import LocalStorage, S3Storage, S3_MIN_PART_SIZE, open_storage
+
+
+def write_object(backend, key, data):
+    writer = backend.open_write(key)
+    writer.write(data)
+    writer.commit()
+
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        storage.StorageBackend()
+
+
+def test_local_write_commit_abort_and_range_read(tmp_path):
+    backend = LocalStorage([str(tmp_path / "disk1"), str(tmp_path / "disk2")])
+    write_object(backend, "backups/a.zip", b"0123456789")
+    writer = backend.open_write("backups/b.zip")
+    writer.write(b"partial")
+    writer.abort()
+
+    assert backend.stat("backups/b.zip") is None
+    assert backend.stat("backups/a.zip").size == 10
+    assert b"".join(backend.read("backups/a.zip", 2, 5)) == b"2345"
+    assert [item.key for item in backend.list("backups/")] == ["backups/a.zip"]
+    with pytest.raises(FileNotFoundError):
+        b"".join(backend.read("backups/missing.zip", 0, 1))
+
+
+def test_local_touch_and_delete(tmp_path):
+    backend = LocalStorage([str(tmp_path)])
+    write_object(backend, "chunks/x", b"data")
+    path = backend.local_path("chunks/x")
+    os.utime(path, (0, 0))
+    assert backend.touch("chunks/x")
+    assert backend.stat("chunks/x").mtime > time.time() - 60
+    assert backend.delete("chunks/x")
+    assert not backend.delete("chunks/x")
+    assert not backend.touch("chunks/x")
+
+
+@pytest.fixture
+def s3():
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="backups")
+        yield S3Storage("backups", prefix="server1/", client=client)
+
+
+def test_s3_small_object_round_trip(s3):
+    write_object(s3, "backups/a.zip", b"0123456789")
+    assert s3.stat("backups/a.zip").size == 10
+    assert b"".join(s3.read("backups/a.zip", 3, 6)) == b"3456"
+    assert s3.client.list_objects_v2(Bucket="backups")["Contents"][0]["Key"] == "server1/backups/a.zip"
+
+
+def test_s3_multipart_write(s3):
+    data = os.urandom(2 * S3_MIN_PART_SIZE + 12345)
+    writer = s3.open_write("backups/big.zip")
+    for start in range(0, len(data), 1024 * 1024):
+        writer.write(data[start:start + 1024 * 1024])
+    assert s3.stat("backups/big.zip") is None  # Не виден до commit
+    writer.commit()
+    assert s3.stat("backups/big.zip").size == len(data)
+    assert b"".join(s3.read("backups/big.zip", 0, len(data) - 1)) == data
+    start = S3_MIN_PART_SIZE - 10
+    assert b"".join(s3.read("backups/big.zip", start, start + 99)) == data[start:start + 100]
+
+
+def test_s3_abort_leaves_nothing(s3):
+    writer = s3.open_write("backups/aborted.zip")
+    writer.write(os.urandom(S3_MIN_PART_SIZE + 1))  # Начата multipart-загрузка
+    writer.abort()
+    assert s3.stat("backups/aborted.zip") is None
+    assert not s3.client.list_multipart_uploads(Bucket="backups").get("Uploads")
+
+
+def test_s3_empty_object_and_missing_key(s3):
+    write_object(s3, "chunks/empty", b"")
+    assert s3.stat("chunks/empty").size == 0
+    assert b"".join(s3.read("chunks/empty", 0, -1)) == b""
+    with pytest.raises(FileNotFoundError):
+        b"".join(s3.read("chunks/missing", 0, 10))
+    with pytest.raises(FileNotFoundError):
+        b"".join(s3.read("chunks/missing", 0, -1))
+
+
+def test_s3_list_touch_delete(s3):
+    for key in ("backups/a.zip", "backups/b.zip", "chunks/c"):
+        write_object(s3, key, b"x")
+    assert sorted(item.key for item in s3.list("backups/")) == ["backups/a.zip", "backups/b.zip"]
+    assert s3.touch("chunks/c")
+    assert not s3.touch("chunks/missing")
+    assert s3.delete("chunks/c")
+    assert not s3.delete("chunks/c")
+    assert [item.key for item in s3.list("chunks/")] == []
+
+
+def test_open_storage_s3_requires_boto3(monkeypatch):
+    monkeypatch.setattr(storage, "boto3", None)
+    with pytest.raises(ValueError):
+        open_storage({"type": "s3", "bucket": "backups"}, "unused")
@@ -0,0 +1,139 @@
+import json
+import os
+
+import pytest
+import requests
+
+import main
+from conftest import free_port
+
+PART_SIZE = 64 * 1024
+
+
+def test_upload_resumes_from_acknowledged_parts(tmp_path, server, monkeypatch):
+    url, username, password = server
+    path = tmp_path / "backup_20000101000000.zip"
+    data = os.urandom(5 * PART_SIZE + 1000)
+    path.write_bytes(data)
+    upload = {"part_size": PART_SIZE, "parallel": 1, "retries": 0}
+    upload_part = main._upload_part
+    uploaded = []
+
+    # Первая попытка: часть 3 не доходит до сервера
+    def failing_part(session, upload_url, file_path, number, part_size, retries, limit=None):
+        if number == 3:
+            raise requests.ConnectionError("connection reset")
+        uploaded.append(number)
+        return upload_part(session, upload_url, file_path, number, part_size, retries, limit)
+
+    monkeypatch.setattr(main, "_upload_part", failing_part)
+    assert main.upload_to_server(str(path), url, username, password, 946684800, upload) is None
+    assert os.path.exists(str(path) + ".upload.json")
+    assert sorted(uploaded) == [0, 1, 2, 4, 5]
+
+    # Повтор: отправляется только недостающая часть, сервер сверяет SHA-256 всего файла
+    uploaded.clear()
+    monkeypatch.setattr(main, "_upload_part", lambda *args: uploaded.append(args[3]) or upload_part(*args))
+    name = main.upload_to_server(str(path), url, username, password, 946684800, upload)
+    assert name
+    assert uploaded == [3]
+    assert not os.path.exists(str(path) + ".upload.json")
+
+    downloaded = main.download_backup(url, username, password, name, str(tmp_path / "downloads"))
+    with open(downloaded, "rb") as f:
+        assert f.read() == data
+
+
+def test_upload_restarts_when_session_is_gone(tmp_path, server):
+    url, username, password = server
+    path = tmp_path / "backup_20000101000001.zip"
+    data = os.urandom(2 * PART_SIZE)
+    path.write_bytes(data)
+    with open(str(path) + ".upload.json", "w") as f:  # Сессия, о которой сервер не знает
+        f.write('{"upload_id": "0123456789abcdef", "size": %d, "part_size": %d}' % (len(data), PART_SIZE))
+    name = main.upload_to_server(str(path), url, username, password, 946684801, {"part_size": PART_SIZE})
+    assert name
+    assert not os.path.exists(str(path) + ".upload.json")
+
+
+def backup_config(tmp_path, url, username, password):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "data.txt").write_text("payload " * 1000)
+    return {
+        "source_dir": str(source), "backup_dir": str(tmp_path / "backups"),
+        "server_url": url, "username": username, "password": password,
+        "upload": {"part_size": PART_SIZE, "retries": 0},
+    }
+
+
+def read_report(config):
+    report_dir = os.path.join(config["backup_dir"], "reports")
+    (name,) = os.listdir(report_dir)
+    with open(os.path.join(report_dir, name)) as f:
+        return json.load(f)
+
+
+def test_run_report_records_successful_upload(tmp_path, server):
+    url, username, password = server
+    config = backup_config(tmp_path, url, username, password)
+    main.perform_backup(config)
+    report = read_report(config)
+    assert report["status"] == "ok" and report["mode"] == "file" and report["backup_name"]
+    assert report["stages"]["upload"]["bytes_out"] > 0
+    assert report["stages"]["compress"]["bytes_in"] == 8000
+
+    response = requests.get(f"{url}/metrics", auth=(username, password))
+    assert response.status_code == 200
+    assert "mini_backup_received_bytes_total" in response.text
+
+
+def test_run_report_marks_unsent_backup_as_spooled(tmp_path, server):
+    _, username, password = server
+    config = backup_config(tmp_path, f"http://127.0.0.1:{free_port()}", username, password)
+    main.perform_backup(config)
+    report = read_report(config)
+    assert report["status"] == "spooled" and not report["backup_name"]
+    assert len(os.listdir(os.path.join(config["backup_dir"], main.SPOOL_DIR_NAME))) == 1
+
+
+def test_complete_is_idempotent(tmp_path, server, monkeypatch):
+    url, username, password = server
+    path = tmp_path / "backup_20000101000002.zip"
+    path.write_bytes(os.urandom(2 * PART_SIZE + 10))
+    upload = {"part_size": PART_SIZE, "retries": 0}
+    request_with_retries = main.request_with_retries
+    responses = []
+
+    # Ответ на /complete теряется (как при таймауте прокси), хотя сервер бэкап уже записал
+    def lose_complete(session, method, request_url, *args, **kwargs):
+        response = request_with_retries(session, method, request_url, *args, **kwargs)
+        if request_url.endswith("/complete"):
+            responses.append(response.json())
+            raise requests.ConnectionError("response lost")
+        return response
+
+    monkeypatch.setattr(main, "request_with_retries", lose_complete)
+    assert main.upload_to_server(str(path), url, username, password, 946684804, upload) is None
+    monkeypatch.setattr(main, "request_with_retries", request_with_retries)
+    with open(str(path) + ".upload.json") as f:
+        upload_id = json.load(f)["upload_id"]
+    session = requests.get(f"{url}/uploads/{upload_id}", auth=(username, password)).json()
+    assert session["result"] == responses[0]
+
+    # Повтор не загружает части заново и возвращает тот же бэкап
+    monkeypatch.setattr(main, "_upload_part", lambda *args: pytest.fail("part re-uploaded"))
+    name = main.upload_to_server(str(path), url, username, password, 946684804, upload)
+    assert name == responses[0]["path"].rsplit("/", 1)[-1]
+    response = requests.put(f"{url}/uploads/{upload_id}/parts/0", data=b"x", auth=(username, password))
+    assert response.status_code == 409
+
+
+def test_part_upload_limit_drops_to_admitted_uploads():
+    limit = main.PartUploadLimit(4)
+    with limit.slot(), limit.slot(), limit.slot():
+        limit.throttle()  # Третья загрузка получила 429: сервер принимает две
+        assert limit.limit == 2
+    with limit.slot():
+        limit.throttle()
+    assert limit.limit == 1